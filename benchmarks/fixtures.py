@@ -0,0 +1,148 @@
+import csv
+import io
+import os
+import zipfile
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+# A square street grid in the middle of the configured service area, about
+# 200 m between intersections
+CENTER = (-78.915, 35.98)  # lon, lat
+SPACING = 0.002  # degrees
+
+BUS_HEADWAY_MINUTES = 10
+BUS_MINUTES_PER_STOP = 1.5
+STOP_EVERY = 3  # intersections between bus stops
+
+
+def grid_nodes(size, center=CENTER, spacing=SPACING):
+    # Lon/lat of the intersections, indexed [row, column] from the south-west
+    lons = center[0] + (np.arange(size) - (size - 1) / 2) * spacing
+    lats = center[1] + (np.arange(size) - (size - 1) / 2) * spacing
+    return np.meshgrid(lons, lats)
+
+
+def grid_point(size, row, column):
+    # (lat, lon) of an intersection, the way the app passes coordinates
+    lons, lats = grid_nodes(size)
+    return float(lats[row, column]), float(lons[row, column])
+
+
+def write_osm(path, size):
+    # Residential streets along every row and column of the grid
+    import osmium
+    from osmium.osm.mutable import Node, Way
+
+    lons, lats = grid_nodes(size)
+    node_ids = np.arange(1, size * size + 1).reshape(size, size)
+    with osmium.SimpleWriter(path) as writer:
+        for (row, column), node_id in np.ndenumerate(node_ids):
+            writer.add_node(Node(id=int(node_id), location=(float(lons[row, column]), float(lats[row, column])), version=1))
+        streets = [node_ids[row, :] for row in range(size)] + [node_ids[:, column] for column in range(size)]
+        for way_id, nodes in enumerate(streets, start=1):
+            writer.add_way(Way(id=way_id, nodes=[int(node) for node in nodes], version=1, tags={'highway': 'residential', 'name': f'Street {way_id}'}))
+
+
+def bus_lines(size):
+    # An east-west line along the middle row and a north-south line along the
+    # middle column, crossing at the centre, so some trips need a transfer
+    middle = size // 2
+    stops = list(range(0, size, STOP_EVERY))
+    return {'EW': [(middle, column) for column in stops], 'NS': [(row, middle) for row in stops]}
+
+
+def _csv(rows, columns):
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(columns)
+    writer.writerows(rows)
+    return out.getvalue()
+
+
+def write_gtfs(path, size, today=None):
+    # Buses every BUS_HEADWAY_MINUTES from 05:00 to 23:00 in both directions,
+    # every day from a week ago to a year ahead, with one flat fare
+    today = today or date.today()
+    lons, lats = grid_nodes(size)
+    lines = bus_lines(size)
+
+    stops = {}
+    for nodes in lines.values():
+        for row, column in nodes:
+            stops.setdefault((row, column), f'stop_{row}_{column}')
+    stop_rows = [[stop_id, f'Stop {row}/{column}', f'{lats[row, column]:.6f}', f'{lons[row, column]:.6f}'] for (row, column), stop_id in stops.items()]
+
+    trip_rows, stop_time_rows = [], []
+    for route_id, nodes in lines.items():
+        for direction, ordered in enumerate([nodes, nodes[::-1]]):
+            for start in range(5 * 60, 23 * 60, BUS_HEADWAY_MINUTES):
+                trip_id = f'{route_id}_{direction}_{start}'
+                trip_rows.append([route_id, 'daily', trip_id, direction])
+                for sequence, node in enumerate(ordered):
+                    minutes = start + sequence * BUS_MINUTES_PER_STOP
+                    stop_time = f'{int(minutes // 60):02d}:{int(minutes % 60):02d}:{int(minutes * 60 % 60):02d}'
+                    stop_time_rows.append([trip_id, stop_time, stop_time, stops[node], sequence])
+
+    tables = {
+        'agency.txt': _csv([['bench', 'Benchmark Transit', 'https://example.com', 'America/New_York']], ['agency_id', 'agency_name', 'agency_url', 'agency_timezone']),
+        'stops.txt': _csv(stop_rows, ['stop_id', 'stop_name', 'stop_lat', 'stop_lon']),
+        'routes.txt': _csv([[route_id, 'bench', route_id, 3] for route_id in lines], ['route_id', 'agency_id', 'route_short_name', 'route_type']),
+        'calendar.txt': _csv([['daily'] + [1] * 7 + [(today - timedelta(days=7)).strftime('%Y%m%d'), (today + timedelta(days=365)).strftime('%Y%m%d')]],
+                             ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday', 'start_date', 'end_date']),
+        'trips.txt': _csv(trip_rows, ['route_id', 'service_id', 'trip_id', 'direction_id']),
+        'stop_times.txt': _csv(stop_time_rows, ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence']),
+        'fare_attributes.txt': _csv([['flat', '1.25', 'USD', 0, '', 5400]], ['fare_id', 'price', 'currency_type', 'payment_method', 'transfers', 'transfer_duration']),
+    }
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as feed:
+        for name, content in tables.items():
+            feed.writestr(name, content)
+    return {'stops': len(stop_rows), 'trips': len(trip_rows), 'stop_times': len(stop_time_rows)}
+
+
+def write_dem(path, size, resolution=1 / 10800):
+    # Rolling hills over the grid plus some padding, at the 1/3 arc-second
+    # resolution of the USGS tiles the app normally reads
+    import rasterio
+    from rasterio.transform import from_origin
+
+    lons, lats = grid_nodes(size)
+    padding = 2 * SPACING
+    west, north = lons.min() - padding, lats.max() + padding
+    width = int(np.ceil((lons.max() - lons.min() + 2 * padding) / resolution))
+    height = int(np.ceil((lats.max() - lats.min() + 2 * padding) / resolution))
+    x = np.linspace(0, 6 * np.pi, width)
+    y = np.linspace(0, 4 * np.pi, height)
+    elevation = (100 + 15 * np.sin(x)[None, :] + 10 * np.cos(y)[:, None]).astype(np.float32)
+    with rasterio.open(path, 'w', driver='GTiff', width=width, height=height, count=1, dtype='float32',
+                       crs='EPSG:4326', transform=from_origin(west, north, resolution, resolution), nodata=-9999) as dem:
+        dem.write(elevation, 1)
+    return elevation.shape
+
+
+def synthetic_travel_details(options, segments, seed=0):
+    # Itineraries shaped like r5py's detailed itineraries: every option is a
+    # walk, `segments - 2` transit rides and a walk
+    rng = np.random.default_rng(seed)
+    rows = options * segments
+    position = np.tile(np.arange(segments), options)
+    transit = (position > 0) & (position < segments - 1)
+    return pd.DataFrame({
+        'option': np.repeat(np.arange(options), segments),
+        'segment': position,
+        'travel_time': pd.to_timedelta(rng.integers(60, 1800, rows), unit='s'),
+        'wait_time': pd.to_timedelta(np.where(transit, rng.integers(0, 900, rows), 0), unit='s'),
+        'distance': rng.uniform(50, 5000, rows),
+        'route_id': pd.Series(rng.integers(0, 20, rows)).map('route-{}'.format).where(transit),
+    })
+
+
+def build_fixtures(directory, size=21):
+    os.makedirs(directory, exist_ok=True)
+    paths = {name: os.path.join(directory, file_name) for name, file_name in
+             [('osm', 'grid.osm.pbf'), ('gtfs', 'grid_gtfs.zip'), ('dem', 'grid_dem.tif')]}
+    write_osm(paths['osm'], size)
+    feed = write_gtfs(paths['gtfs'], size)
+    dem_shape = write_dem(paths['dem'], size)
+    return paths, {'grid_size': size, 'spacing_degrees': SPACING, 'dem_shape': list(dem_shape), **feed}
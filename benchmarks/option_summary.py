@@ -0,0 +1,49 @@
+import argparse
+import os
+import sys
+import timeit
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'main'))
+
+from fixtures import synthetic_travel_details  # noqa: E402
+from planner import summarize_options  # noqa: E402
+
+
+def groupby_apply_summary(travel_details):
+    # The option totals as they were computed before summarize_options
+    travel_details = travel_details.copy()
+    travel_details['total_time'] = travel_details['travel_time'] + travel_details['wait_time']
+    walking_biking_time = travel_details.groupby('option', group_keys=False).apply(lambda x: x.iloc[0]['travel_time'] + x.iloc[-1]['travel_time']).reset_index(name='walking_biking_time')
+    travel_details['num_transfers'] = travel_details.groupby('option')['segment'].transform('count') - 3
+    return travel_details.groupby('option').agg(
+        total_time=('total_time', 'sum'),
+        wait_time=('wait_time', 'sum'),
+        num_transfers=('num_transfers', 'first'),
+        distance=('distance', 'sum')
+    ).reset_index().merge(walking_biking_time, on='option')
+
+
+def best_time(function, travel_details, repeat):
+    return min(timeit.repeat(lambda: function(travel_details), number=1, repeat=repeat))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the per-option itinerary totals: groupby.apply against the single grouped sum of planner.summarize_options.')
+    parser.add_argument('--options', type=int, nargs='+', default=[50, 200, 800], help='options per frame')
+    parser.add_argument('--segments', type=int, nargs='+', default=[3, 5, 7], help='segments per option')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement; the fastest is reported')
+    args = parser.parse_args()
+
+    print(f"{'options':>8} {'segments':>8} {'groupby.apply':>14} {'summarize':>10} {'speedup':>8}")
+    for options in args.options:
+        for segments in args.segments:
+            travel_details = synthetic_travel_details(options, segments)
+            before = groupby_apply_summary(travel_details)
+            after = summarize_options(travel_details)
+            pd.testing.assert_frame_equal(before, after[before.columns], check_dtype=False)
+
+            before_time = best_time(groupby_apply_summary, travel_details, args.repeat)
+            after_time = best_time(summarize_options, travel_details, args.repeat)
+            print(f"{options:>8} {segments:>8} {before_time * 1000:>11.2f} ms {after_time * 1000:>7.2f} ms {before_time / after_time:>7.1f}x")
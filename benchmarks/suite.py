@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, time as day_time
+from importlib import metadata
+
+from fixtures import build_fixtures, grid_nodes, grid_point, synthetic_travel_details
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'main')
+
+MODES = ['TRANSIT_WALK', 'TRANSIT_BIKE', 'CAR', 'BICYCLE', 'WALK']
+MODE_BUTTONS = {'TRANSIT_WALK': 'mode-transit-walk', 'TRANSIT_BIKE': 'mode-transit-bike', 'CAR': 'mode-car',
+                'BICYCLE': 'mode-bike', 'SHARED_RIDE': 'mode-shared-ride', 'WALK': 'mode-walk'}
+DEPARTURE_HOUR, DEPARTURE_MINUTE = '08', '00'
+
+
+def timed(function, repeat, setup=None):
+    # Wall time of `repeat` calls in milliseconds, and the last result.
+    # `setup` runs before every call, outside the timing.
+    times = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = function()
+        times.append((time.perf_counter() - start) * 1000)
+    return {'runs': repeat, 'min_ms': min(times), 'median_ms': statistics.median(times), 'max_ms': max(times)}, result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def package_versions():
+    versions = {}
+    for package in ['r5py', 'pandas', 'numpy', 'geopandas', 'shapely', 'dash', 'plotly']:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def layout_values(app):
+    # Initial value of every component property, as the browser would send it
+    values = {}
+    for component in app.layout._traverse():
+        component_id = getattr(component, 'id', None)
+        if isinstance(component_id, str):
+            for prop in component._prop_names:
+                values[f'{component_id}.{prop}'] = getattr(component, prop, None)
+    return values
+
+
+def callback_request(client, app, output_key, values, changed):
+    # POST a callback the way the Dash renderer does. Pattern-matching
+    # (ALL) inputs and outputs match no components here.
+    spec = app.callback_map[output_key]
+
+    def entries(dependencies):
+        return [[] if item['id'].startswith('{') else {'id': item['id'], 'property': item['property'], 'value': values.get(f"{item['id']}.{item['property']}")}
+                for item in dependencies]
+
+    outputs = spec['output'] if isinstance(spec['output'], list) else [spec['output']]
+    outputs = [[] if isinstance(output.component_id, dict) else {'id': output.component_id, 'property': output.component_property.split('@')[0]} for output in outputs]
+    body = {'output': output_key, 'outputs': outputs if isinstance(spec['output'], list) else outputs[0],
+            'inputs': entries(spec['inputs']), 'state': entries(spec['state']), 'changedPropIds': [changed]}
+    response = client.post('/_dash-update-component', json=body)
+    if response.status_code != 200:
+        raise RuntimeError(f"{output_key} returned HTTP {response.status_code}: {response.get_data(as_text=True)[:500]}")
+    return response
+
+
+def callback_key(app, input_id):
+    # Output key of the callback triggered by an input
+    return next(key for key, spec in app.callback_map.items() if any(f"{item['id']}.{item['property']}" == input_id for item in spec['inputs']))
+
+
+def run(fixture_dir, grid_size, repeat):
+    paths, fixture = build_fixtures(fixture_dir, grid_size)
+    # The app reads its inputs from the environment when config is imported,
+    # and relative paths (elevation grid, grade index) from the working directory
+    os.environ.update(GTFS_PATH=paths['gtfs'], OSM_PATH=paths['osm'], DEM_PATH=paths['dem'],
+                      CALLBACK_CACHE_PATH=os.path.join(fixture_dir, 'callback_cache'))
+    os.environ.pop('ROUTING_SERVICE_ADDRESS', None)
+    os.chdir(fixture_dir)
+    sys.path.insert(0, SRC)
+
+    import planner
+    import routing
+    from elevation import DemSampler, ElevationGrid, calculate_route_slopes, clip_dem
+
+    results = {}
+    origin, destination = grid_point(grid_size, grid_size // 2, 1), grid_point(grid_size, grid_size - 2, grid_size // 2)
+    departure = datetime.combine(date.today(), day_time(int(DEPARTURE_HOUR), int(DEPARTURE_MINUTE)))
+
+    # Network build, including hashing the inputs and reading the fares
+    results['network_build'], _ = timed(lambda: (routing.start_network_warmup(paths['osm'], paths['gtfs']), routing.get_transport_network()), 1)
+    transport_network, version = routing.get_transport_network(), routing.get_network_version()
+
+    # One DetailedItinerariesComputer run per mode, without the itinerary cache
+    routed = {}
+    for mode in MODES:
+        results[f'detailed_itineraries.{mode}'], (routed[mode],) = timed(
+            lambda: routing.compute_legs(transport_network, [(origin, destination, departure, mode)], version), repeat, routing.itinerary_cache.clear)
+
+    # Transit option aggregation on the routed options and on a wide departure window's worth
+    fare_table = routing.get_fare_table()
+    results['option_aggregation.routed'], _ = timed(lambda: planner.group_travel_options(routed['TRANSIT_WALK'], fare_table), repeat)
+    wide = synthetic_travel_details(800, 5)
+    results['option_aggregation.800_options'], _ = timed(lambda: planner.group_travel_options(wide), repeat)
+
+    # Slopes of the walking route against the DEM and the clipped elevation grid
+    walk_route = routed['WALK']['geometry'].iloc[0]
+    lons, lats = grid_nodes(grid_size)
+    clip_dem(paths['dem'], os.path.join(fixture_dir, 'grid_dem.npy'), [lons.min(), lats.min(), lons.max(), lats.max()])
+    for name, sampler in [('dem', DemSampler(paths['dem'])), ('elevation_grid', ElevationGrid(os.path.join(fixture_dir, 'grid_dem.npy')))]:
+        results[f'route_slopes.{name}'], _ = timed(lambda: calculate_route_slopes(walk_route, sampler), repeat)
+        sampler.close()
+
+    # The main callback and the routing callback it triggers, over HTTP, with
+    # and without routed legs in the caches
+    import app as trip_app
+    client = trip_app.server.test_client()
+    values = layout_values(trip_app.app)
+    values.update({'input-origin.value': '{}, {}'.format(*origin), 'input-destination.value': '{}, {}'.format(*destination),
+                   'calculate-button.n_clicks': 1, 'session-id.data': 'benchmark', 'trip-mode-radio.value': 'same', 'departure-time-radio.value': 'future',
+                   'departure-date-picker.date': date.today().isoformat(), 'departure-hour.value': DEPARTURE_HOUR,
+                   'departure-minute.value': DEPARTURE_MINUTE})
+    main_key, trip_key = callback_key(trip_app.app, 'mode-walk.n_clicks'), callback_key(trip_app.app, 'route-request.data')
+
+    def plan(mode):
+        button = MODE_BUTTONS[mode]
+        main = callback_request(client, trip_app.app, main_key, {**values, f'{button}.n_clicks': 1}, f'{button}.n_clicks')
+        outputs = main.get_json()['response']
+        if 'route-request' not in outputs:
+            raise RuntimeError(f"{mode} was not routed: {outputs.get('itinerary-data')}")
+        trip = callback_request(client, trip_app.app, trip_key, {**values, 'route-request.data': outputs['route-request']['data']}, 'route-request.data')
+        itinerary = trip.get_json()['response']['itinerary-data']['data']
+        if 'error' in itinerary:
+            raise RuntimeError(f"{mode} failed: {itinerary['error']}")
+        return len(main.get_data()) + len(trip.get_data())
+
+    def clear_caches():
+        routing.itinerary_cache.clear()
+        planner.shared_ride_cache.clear()
+
+    for mode in MODES + ['SHARED_RIDE']:
+        results[f'callback.{mode}.cold'], response_bytes = timed(lambda: plan(mode), repeat, clear_caches)
+        results[f'callback.{mode}.warm'], _ = timed(lambda: plan(mode), repeat)
+        results[f'callback.{mode}.cold']['response_bytes'] = results[f'callback.{mode}.warm']['response_bytes'] = response_bytes
+
+    return {
+        'commit': git_commit(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'packages': package_versions(),
+        'fixture': fixture,
+        'results': results,
+    }
+
+
+def compare(report, baseline):
+    # Median time of every benchmark against a baseline report
+    print(f"{'benchmark':<40} {'baseline':>11} {'current':>11} {'change':>8}")
+    for name, result in report['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            print(f"{name:<40} {'-':>11} {result['median_ms']:>8.1f} ms")
+            continue
+        print(f"{name:<40} {before['median_ms']:>8.1f} ms {result['median_ms']:>8.1f} ms {result['median_ms'] / before['median_ms'] - 1:>+7.0%}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark network build, routing, option aggregation, slopes and the trip callbacks on a synthetic street grid, GTFS feed and DEM.')
+    parser.add_argument('--out', default=None, help='JSON report (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--baseline', default=None, help='earlier JSON report to compare against')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark')
+    parser.add_argument('--grid-size', type=int, default=21, help='intersections per side of the street grid')
+    parser.add_argument('--fixtures', default=None, help='directory for the generated inputs (default: a temporary directory)')
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', f"{git_commit() or 'unknown'}.json"))
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    fixture_dir = os.path.abspath(args.fixtures or tempfile.mkdtemp(prefix='trip-planner-bench-'))
+
+    report = run(fixture_dir, args.grid_size, args.repeat)
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if baseline:
+        with open(baseline) as f:
+            compare(report, json.load(f))
+    else:
+        for name, result in report['results'].items():
+            print(f"{name:<40} {result['median_ms']:>8.1f} ms" + (f" {result['response_bytes']:>10,} bytes" if 'response_bytes' in result else ''))
+    print(f"Wrote {out}")
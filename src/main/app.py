@@ -1,85 +1,330 @@
-from dash import Dash, html, dcc, Input, Output, State, callback_context, ALL, no_update
+from dash import Dash, DiskcacheManager, html, dcc, Input, Output, State, Patch, callback_context, clientside_callback, ClientsideFunction, ALL, no_update
 import plotly.graph_objs as go
-import geopandas as gpd
-from shapely.geometry import Point, LineString
-import r5py
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import numpy as np
 import os
-import rasterio
-
-
-def get_elevation_from_dem(lat, lon, dem_path='path/to/your/dem/file.tif'):
-    with rasterio.open(dem_path) as dem:
-        coords = [(lon, lat)]
-        elevations = list(dem.sample(coords))
-    return elevations[0][0]
-
-def calculate_slope(lat1, lon1, lat2, lon2, dem_path='path/to/your/dem/file.tif'):
-    elevation1 = get_elevation_from_dem(lat1, lon1, dem_path)
-    elevation2 = get_elevation_from_dem(lat2, lon2, dem_path)
-    horizontal_distance = np.sqrt((lat2 - lat1)**2 + (lon2 - lon1)**2) * 111320  # Approx conversion to meters
-    slope = (elevation2 - elevation1) / horizontal_distance
-    return slope
-
-def calculate_route_slopes(line_string, dem_path='path/to/your/dem/file.tif'):
-    slopes = []
-    coords = list(line_string.coords)
-    for i in range(len(coords) - 1):
-        lat1, lon1 = coords[i][1], coords[i][0]
-        lat2, lon2 = coords[i + 1][1], coords[i + 1][0]
-        slope = calculate_slope(lat1, lon1, lat2, lon2, dem_path)
-        slopes.append(slope)
-    return slopes
-
-def summarize_slopes(slopes):
-    mean_slope = np.mean(slopes)
-    max_slope = np.max(slopes)
-    return mean_slope, max_slope
+from config import callback_cache_path, profile_dir, lat_start, lat_end, lon_start, lon_end
+from elevation import open_elevation_sampler
+from grades import open_grade_index, summarize_slopes_along
+from routing import ACCESSIBILITY_MAX_MINUTES, SWEEP_PERCENTILES, TRANSIT_MODES, NoTransitAccess, RequestSuperseded, access_radius, check_superseded, compute_accessibility, compute_departure_sweep, get_network_version, get_stop_index, get_street_index, get_transport_network, network_status, set_latest_request, start_index_warmup, start_network_warmup, transit_access_error
+from planner import leg_slopes, pareto_options, route_compare_legs, route_legs, summarize_leg, summarize_trip
+from cache import DiskLRUCache, LRUCache
+from geometry import encode_array, join_lines, simplify_coords, zoom_tolerance
+from routing_service import RoutingCancelled, RoutingServiceError, connect_routing_service
+from streets import OutsideCoverage
+import uuid
+import flask
+import metrics
+import profiling
+
+
+def summarize_route_slopes(line_string):
+    return summarize_slopes_along(line_string, grade_index, elevation_sampler)
+
+def slope_details(label, line_string):
+    mean_slope, max_slope = summarize_route_slopes(line_string)
+    return [f"{label} Mean Slope: {mean_slope:.2%}", f"{label} Max Slope: {max_slope:.2%}", walking_slope_warning(max_slope)]
+
+def parse_coordinates(coords_str):
+    try:
+        lat, lon = map(float, coords_str.split(','))
+        return lat, lon
+    except Exception as e:
+        return None
+
+def departure_from_inputs(departure_time_radio, departure_date, departure_hour, departure_minute):
+    if departure_time_radio == 'future' and departure_date and departure_hour and departure_minute:
+        return datetime.combine(datetime.fromisoformat(departure_date).date(), datetime.strptime(f'{departure_hour}:{departure_minute}', '%H:%M').time())
+    return datetime.now()
+
+def patch_routes(patch, routes=(), zoom=None):
+    # Walking/biking access legs and main routes, simplified for the zoom
+    # level, each drawn as a single trace
+    tolerance = zoom_tolerance(zoom or DEFAULT_ZOOM)
+    for slot, is_access in [(ACCESS_TRACE, True), (ROUTE_TRACE, False)]:
+        lons, lats = join_lines([simplify_coords(route['coords'], tolerance) for route in routes if (route['kind'] == 'access') == is_access])
+        patch['data'][slot]['lon'] = encode_array(lons)
+        patch['data'][slot]['lat'] = encode_array(lats)
+    return patch
+
+def patch_markers(patch, origin, destination, dynamic_destinations):
+    # Origin, destination and any filled in extra destinations
+    points = [(origin, "Origin"), (destination, "Destination")] + [(dest, f"Destination {i + 1}") for i, dest in enumerate(dynamic_destinations)]
+    points = [(parse_coordinates(coords), text) for coords, text in points if coords]
+    points = [(coords, text) for coords, text in points if coords]
+    patch['data'][MARKER_TRACE]['lon'] = [coords[1] for coords, _ in points]
+    patch['data'][MARKER_TRACE]['lat'] = [coords[0] for coords, _ in points]
+    patch['data'][MARKER_TRACE]['text'] = [text for _, text in points]
+    patch['data'][MARKER_TRACE]['marker']['color'] = (['red'] + ['#93979C'] * len(points))[:len(points)]
+    return patch
+
+def patch_accessibility(patch, accessibility=None):
+    # Travel time from the origin to every reachable grid cell, coloured by
+    # isochrone band
+    minutes = accessibility['minutes'] if accessibility else np.empty(0)
+    patch['data'][REACH_TRACE]['lon'] = encode_array(accessibility['lon'] if accessibility else np.empty(0))
+    patch['data'][REACH_TRACE]['lat'] = encode_array(accessibility['lat'] if accessibility else np.empty(0))
+    patch['data'][REACH_TRACE]['marker']['color'] = encode_array(minutes)
+    patch['data'][REACH_TRACE]['marker']['showscale'] = bool(len(minutes))
+    return patch
+
+def patch_stops(patch, leg_requests=()):
+    # Transit stops within reach of either end of the transit legs, from the
+    # stop index alone
+    stops = get_stop_index()
+    positions = set()
+    for origin_coords, destination_coords, _, mode in leg_requests:
+        if mode in TRANSIT_MODES and stops is not None:
+            for point in (origin_coords, destination_coords):
+                positions.update(stops.within(point, access_radius(mode))[0].tolist())
+    positions = sorted(positions)
+    patch['data'][STOP_TRACE]['lon'] = encode_array(stops.lons[positions] if positions else np.empty(0))
+    patch['data'][STOP_TRACE]['lat'] = encode_array(stops.lats[positions] if positions else np.empty(0))
+    patch['data'][STOP_TRACE]['text'] = stops.names[positions].tolist() if positions else []
+    return patch
 
 def walking_slope_warning(max_slope, threshold=0.07):
     if max_slope > threshold:
         return f"Warning: Walking slope as high as {max_slope:.2%} for some segments"
     return "Slope is comfortable for walking"
 
-# Cost-related functions
-TRANSIT_FARE_PER_RIDE = 1.00  # Global variable for transit fare
-
-def calculate_fare(base_fare, cost_per_mile, cost_per_minute, service_fee, distance, duration, additional_fees=0):
-    fare = base_fare + (cost_per_mile * distance) + (cost_per_minute * duration) + service_fee + additional_fees
-    return fare
-
 app = Dash(__name__, external_stylesheets=['https://codepen.io/chriddyp/pen/bWLwgP.css'], suppress_callback_exceptions=True)
 
-gtfs_path = 'gtfs.zip'
-osm_path = 'durham_new.osm.pbf'
-transport_network = r5py.TransportNetwork(osm_path, [gtfs_path])
-dem_path = 'USGS_13_n36w079_20130911.tif'
-
-# Setup a clickable map
-lat_start, lat_end = 35.88, 36.08
-lon_start, lon_end = -78.98, -78.85
-
-lat_points = np.linspace(lat_start, lat_end, 50)
-lon_points = np.linspace(lon_start, lon_end, 50)
-lat, lon = np.meshgrid(lat_points, lon_points)
-lat = lat.flatten()
-lon = lon.flatten()
-
-fig = go.Figure(go.Scattermapbox(
-    mode='markers',
-    lon=lon,
-    lat=lat,
-    marker={'size': 5, 'opacity': 0},
-    hoverinfo='none',
-    showlegend=False
-))
+elevation_sampler = open_elevation_sampler()
+grade_index = open_grade_index()
+
+# WSGI entry point, e.g. `gunicorn --workers 4 app:server`
+server = app.server
+
+# With ROUTING_SERVICE_ADDRESS set, routing runs in routing_service.py and
+# this process never loads the transport network
+routing_client = connect_routing_service()
+
+# Trips are then routed in Dash background callbacks: a request does not hold
+# a web worker while it waits, and a superseded or cancelled request is
+# dropped. In-process routing stays in the request, as forking a process
+# that runs a JVM is unsafe; it only stops routing the leg groups of a
+# request superseded by a newer one from the same session.
+if routing_client is not None:
+    import diskcache
+    background_callback_manager = DiskcacheManager(diskcache.Cache(os.path.join(callback_cache_path, 'jobs')))
+else:
+    background_callback_manager = None
+
+# Otherwise the transport network is loaded in the background once the server
+# handles its first request (usually a /ready probe), not when app.py is
+# imported. With the routing service only the street and stop indexes are,
+# to check points before sending jobs.
+@server.before_request
+def warm_up_network():
+    if routing_client is None:
+        start_network_warmup()
+    else:
+        start_index_warmup()
+
+def routing_status():
+    if routing_client is not None:
+        try:
+            return routing_client.status()
+        except RoutingServiceError as e:
+            return {'state': 'unavailable', 'error': str(e)}
+    return network_status()
+
+@server.route('/ready')
+def ready():
+    status = routing_status()
+    return status, 200 if status['state'] == 'ready' else 503
+
+# Every callback request is traced: its stages, legs and cache lookups are
+# logged as one JSON line and added to the metrics served on /metrics.
+# Polls of a background callback's job are not, the job traces itself.
+metrics.configure_logging()
+
+@server.before_request
+def begin_request_trace():
+    if flask.request.path.endswith('/_dash-update-component') and not flask.request.args.get('cacheKey'):
+        output = (flask.request.get_json(silent=True) or {}).get('output')
+        callback = getattr(app.callback_map.get(output, {}).get('callback'), '__name__', None)
+        flask.g.request_trace = metrics.begin(callback)
+
+@server.after_request
+def record_response(response):
+    if 'request_trace' in flask.g:
+        flask.g.response_fields = {'http_status': response.status_code, 'response_bytes': response.calculate_content_length() or 0}
+    return response
+
+@server.teardown_request
+def end_request_trace(error=None):
+    if 'request_trace' in flask.g:
+        fields = flask.g.pop('response_fields', {'http_status': 500})
+        status = 'error' if error is not None or fields['http_status'] >= 500 else None
+        metrics.end(*flask.g.pop('request_trace'), status=status, **fields)
+
+@server.route('/metrics')
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# With PROFILE_DIR set, the next routing requests of this process can be
+# profiled: POST /profile?requests=N, or send the X-Profile-Request header
+# with the request that starts the trip
+@server.route('/profile', methods=['POST'])
+def profile_endpoint():
+    if not profiling.enabled():
+        return {'error': 'Set PROFILE_DIR to profile requests'}, 404
+    return {'armed': profiling.arm(flask.request.args.get('requests', 1, type=int)), 'profile_dir': os.path.abspath(profile_dir)}
+
+# Service area: the extent of the loaded street network, or the configured
+# bounding box until the network is ready
+service_area = {'bounds': None}
+
+def service_bounds():
+    if service_area['bounds'] is None:
+        bounds = routing_status().get('bounds')
+        if not bounds:
+            return lon_start, lat_start, lon_end, lat_end
+        service_area['bounds'] = tuple(bounds)
+    return service_area['bounds']
+
+# Origins and destinations are checked against the street network before
+# anything is routed, and the itinerary says when one is far enough from the
+# nearest street for the walk to it to matter
+SNAP_NOTE_METERS = 50
+
+def transit_access_check(leg_requests):
+    # Raises NoTransitAccess for the first transit leg with no stop in reach
+    # of its origin or destination, before anything is routed
+    stops = get_stop_index()
+    for origin_coords, destination_coords, _, mode in leg_requests:
+        reason = transit_access_error(origin_coords, destination_coords, mode, stops)
+        if reason is not None:
+            raise NoTransitAccess(reason)
+
+def point_labels(count):
+    return ['origin', 'destination'] + [f'destination {i + 2}' for i in range(count - 2)]
+
+def snap_distances(points):
+    # Meters from each (lat, lon) point to the nearest street vertex; raises
+    # OutsideCoverage for a point too far from any street
+    streets = get_street_index()
+    if streets is None:
+        return [None] * len(points)
+    _, distances = streets.locate(points, point_labels(len(points)))
+    return distances.tolist()
+
+def plan_legs(leg_requests, session=None, request_id=None):
+    modes = [mode for _, _, _, mode in leg_requests]
+    metrics.record_legs(modes)
+    with metrics.stage('route', modes[0] if len(set(modes)) == 1 else 'MIXED'):
+        if routing_client is not None:
+            return routing_client.route_legs(leg_requests, session=session)
+        return route_legs(get_transport_network(wait=False), get_network_version(wait=False), leg_requests, (session, request_id))
+
+def plan_accessibility(origin, departure, mode, session=None):
+    with metrics.stage('accessibility', mode):
+        if routing_client is not None:
+            return routing_client.compute_accessibility(origin, departure, mode, session=session)
+        return compute_accessibility(get_transport_network(wait=False), get_network_version(wait=False), origin, departure, mode)
+
+def plan_departure_sweep(origin, destination, departure, window, session=None):
+    with metrics.stage('departure_sweep'):
+        if routing_client is not None:
+            return routing_client.compute_departure_sweep(origin, destination, departure, window, session=session)
+        return compute_departure_sweep(get_transport_network(wait=False), get_network_version(wait=False), origin, destination, departure, window)
+
+def plan_compare_legs(leg_requests):
+    metrics.record_legs(['COMPARE'] * len(leg_requests))
+    with metrics.stage('route', 'COMPARE'):
+        if routing_client is not None:
+            return routing_client.route_compare_legs(leg_requests)
+        return route_compare_legs(get_transport_network(wait=False), get_network_version(wait=False), leg_requests)
+
+# Routed legs of each session's latest trip, so the option selection can be
+# changed without routing again, and the full resolution routes currently
+# drawn for each session, simplified again when the map is zoomed. Kept on
+# disk when background callbacks have to see them.
+if background_callback_manager is not None:
+    session_trips = DiskLRUCache(os.path.join(callback_cache_path, 'session_trips'))
+    session_routes = DiskLRUCache(os.path.join(callback_cache_path, 'session_routes'))
+else:
+    session_trips = LRUCache(maxsize=500)
+    session_routes = LRUCache(maxsize=500)
+
+# Setup a clickable map. Clicks only register on a point of the invisible
+# grid, so the grid is regenerated for the visible part of the service area
+# whenever the map is panned or zoomed: precision grows with the zoom level
+# while the number of points stays the same.
+CLICK_GRID_POINTS = 50  # per side of the viewport
+DEFAULT_ZOOM = 11
+MAP_VIEWPORT_PIXELS = (1200, 800)  # used when the browser does not report the viewport corners
+
+def click_grid(viewport, service_bounds, points=CLICK_GRID_POINTS):
+    lon_min, lat_min, lon_max, lat_max = viewport
+    lon_step = (lon_max - lon_min) / (points - 1)
+    lat_step = (lat_max - lat_min) / (points - 1)
+    # Align the grid to multiples of the step so it does not shift while panning
+    lons = np.arange(np.ceil(max(lon_min, service_bounds[0]) / lon_step), np.floor(min(lon_max, service_bounds[2]) / lon_step) + 1) * lon_step
+    lats = np.arange(np.ceil(max(lat_min, service_bounds[1]) / lat_step), np.floor(min(lat_max, service_bounds[3]) / lat_step) + 1) * lat_step
+    lon, lat = np.meshgrid(lons, lats)
+    # About 1 m, far below the grid spacing, and keeps the payload small
+    return np.round(lon.flatten(), 5), np.round(lat.flatten(), 5)
+
+def viewport_bounds(relayout_data):
+    # Visible (lon_min, lat_min, lon_max, lat_max) from the map's relayoutData
+    derived = relayout_data.get('mapbox._derived')
+    if derived and derived.get('coordinates'):
+        corners = np.asarray(derived['coordinates'], dtype=float)
+        return corners[:, 0].min(), corners[:, 1].min(), corners[:, 0].max(), corners[:, 1].max()
+    center = relayout_data.get('mapbox.center')
+    zoom = relayout_data.get('mapbox.zoom')
+    if center is None or zoom is None:
+        return None
+    # Web Mercator: 256 px cover 360 degrees of longitude at zoom 0
+    degrees_per_pixel = 360 / (256 * 2 ** zoom)
+    half_width = degrees_per_pixel * MAP_VIEWPORT_PIXELS[0] / 2
+    half_height = degrees_per_pixel * MAP_VIEWPORT_PIXELS[1] / 2 * np.cos(np.radians(center['lat']))
+    return center['lon'] - half_width, center['lat'] - half_height, center['lon'] + half_width, center['lat'] + half_height
+
+lon, lat = click_grid((lon_start, lat_start, lon_end, lat_end), (lon_start, lat_start, lon_end, lat_end))
+
+# The figure keeps a fixed set of traces that callbacks update in place with
+# Patch, so the click grid never travels back and forth
+GRID_TRACE, REACH_TRACE, STOP_TRACE, ACCESS_TRACE, ROUTE_TRACE, MARKER_TRACE = 0, 1, 2, 3, 4, 5
+
+# Accessibility cells are coloured in four isochrone bands, 15 minutes each
+# up to ACCESSIBILITY_MAX_MINUTES
+ISOCHRONE_COLORS = ['#1a9850', '#91cf60', '#fee08b', '#fc8d59']
+isochrone_colorscale = [[(i + edge) / len(ISOCHRONE_COLORS), color] for i, color in enumerate(ISOCHRONE_COLORS) for edge in (0, 1)]
+
+fig = go.Figure([
+    go.Scattermapbox(
+        mode='markers',
+        lon=lon,
+        lat=lat,
+        marker={'size': 5, 'opacity': 0},
+        hoverinfo='none',
+        showlegend=False
+    ),
+    go.Scattermapbox(
+        mode='markers',
+        lon=[],
+        lat=[],
+        marker={'size': 9, 'opacity': 0.45, 'color': [], 'colorscale': isochrone_colorscale, 'cmin': 0, 'cmax': ACCESSIBILITY_MAX_MINUTES, 'showscale': False,
+                'colorbar': {'title': {'text': 'Minutes'}, 'tickvals': list(range(0, ACCESSIBILITY_MAX_MINUTES + 1, 15))}},
+        hovertemplate='%{marker.color:.0f} minutes<extra></extra>',
+        name='Accessibility',
+        showlegend=False
+    ),
+    go.Scattermapbox(mode='markers', lon=[], lat=[], marker={'size': 6, 'color': '#e08214'}, text=[], hovertemplate='%{text}<extra></extra>', name='Transit Stops', showlegend=False),
+    go.Scattermapbox(mode='lines', lon=[], lat=[], line=dict(width=2, color='lightblue'), name='Walking/Biking Segments', showlegend=False),
+    go.Scattermapbox(mode='lines', lon=[], lat=[], line=dict(width=2, color='blue'), name='Route', showlegend=False),
+    go.Scattermapbox(mode='markers+text', lon=[], lat=[], marker={'size': 10, 'color': []}, text=[], textposition="bottom right", showlegend=False)
+])
 
 fig.update_layout(
     mapbox={
         'style': "carto-positron",
         'center': {'lat': 35.9940, 'lon': -78.8986},
-        'zoom': 11
+        'zoom': DEFAULT_ZOOM
     },
     margin={'l': 0, 'r': 0, 'b': 0, 't': 0},
     clickmode='event+select'
@@ -91,10 +336,28 @@ optimization_options = [
     {'label': 'Total Time', 'value': 'total_time'},
     {'label': 'Number of Transfers', 'value': 'transfers'},
     {'label': 'Wait Time', 'value': 'wait_time'},
-    {'label': 'Walking/Biking Distance', 'value': 'walking_biking_distance'}
+    {'label': 'Walking/Biking Distance', 'value': 'walking_biking_distance'},
+    {'label': 'Cost', 'value': 'cost'}
+]
+window_options = [
+    {'label': '30 minutes', 'value': 30},
+    {'label': '1 hour', 'value': 60},
+    {'label': '2 hours', 'value': 120}
+]
+mode_options = [
+    {'label': 'Transit + Walk 🚶🏻🚌', 'value': 'TRANSIT_WALK'},
+    {'label': 'Transit + Bike 🚲🚌', 'value': 'TRANSIT_BIKE'},
+    {'label': 'Car 🚗', 'value': 'CAR'},
+    {'label': 'Bike 🚲', 'value': 'BICYCLE'},
+    {'label': 'Shared Ride 🚕', 'value': 'SHARED_RIDE'},
+    {'label': 'Walk 🚶🏻', 'value': 'WALK'}
 ]
 
 app.layout = html.Div(style={'backgroundColor': '#ffffff', 'boxSizing': 'border-box', 'padding': '10px'}, children=[
+    dcc.Store(id='session-id', storage_type='session'),
+    dcc.Store(id='itinerary-data'),
+    dcc.Store(id='route-request'),
+    dcc.Store(id='map-zoom', data=DEFAULT_ZOOM),
     html.Div([
         html.H1("Trip Planner", style={'textAlign': 'center', 'color': '#333333', 'padding': '10px', 'background-color': '#f4f4f9'}),
     ], style={'width': '100%', 'display': 'block'}),
@@ -155,8 +418,26 @@ app.layout = html.Div(style={'backgroundColor': '#ffffff', 'boxSizing': 'border-
                 html.Button('Shared Ride 🚕', id='mode-shared-ride', n_clicks=0, style={'margin': '5px', 'background-color': '#1c293a', 'color': 'white'}),
                 html.Button('Walk 🚶🏻', id='mode-walk', n_clicks=0, style={'margin': '5px', 'background-color': '#1c293a', 'color': 'white'}),
             ], style={'display': 'flex', 'flex-wrap': 'wrap'}),
+            html.Button('Compare All Modes', id='compare-button', n_clicks=0, style={'margin': '5px', 'background-color': '#1c293a', 'color': 'white'}),
+            html.Div([
+                html.Span(id='routing-progress', style={'margin': '5px', 'color': '#555555'}),
+                html.Button('Cancel', id='cancel-routing-button', n_clicks=0, style={'display': 'none'})
+            ]),
+            html.Div(id='mode-comparison', style={'padding': '10px', 'background-color': '#f4f4f9', 'color': '#333333', 'text-align': 'left'}),
+            html.Div([
+                dcc.Dropdown(id='accessibility-mode', options=mode_options, value='TRANSIT_WALK', clearable=False, style={'width': '60%', 'display': 'inline-block', 'margin': '5px', 'vertical-align': 'middle'}),
+                html.Button('Accessibility from Origin', id='accessibility-button', n_clicks=0, style={'margin': '5px', 'background-color': '#1c293a', 'color': 'white'})
+            ]),
+            html.Div([
+                dcc.Dropdown(id='sweep-window', options=window_options, value=120, clearable=False, style={'width': '60%', 'display': 'inline-block', 'margin': '5px', 'vertical-align': 'middle'}),
+                html.Button('Departure Window Reliability', id='sweep-button', n_clicks=0, style={'margin': '5px', 'background-color': '#1c293a', 'color': 'white'})
+            ]),
+            html.Div(id='departure-sweep', style={'padding': '10px', 'background-color': '#f4f4f9', 'color': '#333333', 'text-align': 'left'}),
+            html.Div(id='accessibility-summary', style={'padding': '10px', 'background-color': '#f4f4f9', 'color': '#333333', 'text-align': 'left'}),
             html.Div(id='travel-time', style={'padding': '10px', 'background-color': '#f4f4f9', 'color': '#333333', 'text-align': 'left'}),
-            html.Div(id='selected-modes-summary', style={'padding': '10px', 'background-color': '#f4f4f9', 'color': '#333333', 'text-align': 'left'})
+            html.Div(id='selected-modes-summary', style={'padding': '10px', 'background-color': '#f4f4f9', 'color': '#333333', 'text-align': 'left'}),
+            html.Button('Show Pareto Options', id='pareto-button', n_clicks=0, style={'margin': '5px', 'background-color': '#1c293a', 'color': 'white'}),
+            html.Div(id='pareto-options', style={'padding': '10px', 'background-color': '#f4f4f9', 'color': '#333333', 'text-align': 'left'})
         ], style={'width': '50%', 'display': 'inline-block', 'padding': '20px', 'background-color': '#eaeaea', 'boxSizing': 'border-box'}),
     ], id='main-content', style={'display': 'flex', 'flex-wrap': 'wrap', 'height': 'auto', 'boxSizing': 'border-box'}),
     html.Div([
@@ -164,6 +445,15 @@ app.layout = html.Div(style={'backgroundColor': '#ffffff', 'boxSizing': 'border-
     ], style={'width': '100%', 'display': 'block', 'boxSizing': 'border-box'}),
 ])
 
+@app.callback(
+    Output('session-id', 'data'),
+    [Input('session-id', 'data')]
+)
+def assign_session_id(session_id):
+    if session_id:
+        return no_update
+    return uuid.uuid4().hex
+
 @app.callback(
     [Output('add-destination-button', 'style')],
     [Input('input-origin', 'value'),
@@ -211,19 +501,12 @@ def update_segment_mode_dropdowns(trip_mode, n_clicks, origin, destination, dyna
     if trip_mode == 'same' or not origin or not destination:
         return []
 
-    segments = [{'label': 'Transit + Walk 🚶🏻🚌', 'value': 'TRANSIT_WALK'},
-                {'label': 'Transit + Bike 🚲🚌', 'value': 'TRANSIT_BIKE'},
-                {'label': 'Car 🚗', 'value': 'CAR'},
-                {'label': 'Bike 🚲', 'value': 'BICYCLE'},
-                {'label': 'Shared Ride 🚕', 'value': 'SHARED_RIDE'},
-                {'label': 'Walk 🚶🏻', 'value': 'WALK'}]
-
     segment_dropdowns = []
     total_segments = len(dynamic_destinations) + 1  # Origin to first destination, first destination to second, etc.
     for i in range(total_segments):
         segment_dropdowns.append(html.Div([
             html.Label(f'Segment {i + 1} Mode:', style={'margin': '5px', 'color': '#555555'}),
-            dcc.Dropdown(id={'type': 'segment-mode', 'index': i}, options=segments, value='CAR', style={'margin': '5px'})
+            dcc.Dropdown(id={'type': 'segment-mode', 'index': i}, options=mode_options, value='CAR', style={'margin': '5px'})
         ]))
 
     return segment_dropdowns
@@ -233,14 +516,15 @@ def update_segment_mode_dropdowns(trip_mode, n_clicks, origin, destination, dyna
      Output('input-destination', 'value'),
      Output('map-graph', 'figure'),
      Output({'type': 'dynamic-destination', 'index': ALL}, 'value'),
-     Output('travel-time', 'children'),
+     Output('itinerary-data', 'data'),
      Output('mode-transit-walk', 'style'),
      Output('mode-transit-bike', 'style'),
      Output('mode-car', 'style'),
      Output('mode-bike', 'style'),
      Output('mode-shared-ride', 'style'),
      Output('mode-walk', 'style'),
-     Output('selected-modes-summary', 'children')],
+     Output('selected-modes-summary', 'children'),
+     Output('route-request', 'data')],
     [Input('map-graph', 'clickData'),
      Input('calculate-button', 'n_clicks'),
      Input('start-over-button', 'n_clicks'),
@@ -260,15 +544,15 @@ def update_segment_mode_dropdowns(trip_mode, n_clicks, origin, destination, dyna
      State('departure-date-picker', 'date'),
      State('departure-hour', 'value'),
      State('departure-minute', 'value'),
-     State('map-graph', 'figure'),
      State('mode-transit-walk', 'style'),
      State('mode-transit-bike', 'style'),
      State('mode-car', 'style'),
      State('mode-bike', 'style'),
      State('mode-shared-ride', 'style'),
-     State('mode-walk', 'style')]
+     State('mode-walk', 'style'),
+     State('session-id', 'data')]
 )
-def update_inputs_and_calculate_travel_time(clickData, n_clicks, start_over_clicks, transit_walk_clicks, transit_bike_clicks, car_clicks, bike_clicks, shared_ride_clicks, walk_clicks, optimization_criteria, origin, destination, dynamic_destinations, segment_modes, trip_mode, departure_time_radio, departure_date, departure_hour, departure_minute, current_figure, transit_walk_style, transit_bike_style, car_style, bike_style, shared_ride_style, walk_style):
+def update_inputs_and_calculate_travel_time(clickData, n_clicks, start_over_clicks, transit_walk_clicks, transit_bike_clicks, car_clicks, bike_clicks, shared_ride_clicks, walk_clicks, optimization_criteria, origin, destination, dynamic_destinations, segment_modes, trip_mode, departure_time_radio, departure_date, departure_hour, departure_minute, transit_walk_style, transit_bike_style, car_style, bike_style, shared_ride_style, walk_style, session_id):
     ctx = callback_context
     trigger = ctx.triggered[0]['prop_id'].split('.')[0]
 
@@ -281,13 +565,6 @@ def update_inputs_and_calculate_travel_time(clickData, n_clicks, start_over_clic
         'mode-walk': {'margin': '5px', 'background-color': '#1c293a', 'color': 'white'}
     }
 
-    def parse_coordinates(coords_str):
-        try:
-            lat, lon = map(float, coords_str.split(','))
-            return lat, lon
-        except Exception as e:
-            return None
-
     if trigger == 'map-graph' and clickData:
         # Count filled destination boxes
         filled_boxes = len([d for d in dynamic_destinations if d])
@@ -298,36 +575,16 @@ def update_inputs_and_calculate_travel_time(clickData, n_clicks, start_over_clic
             lat, lon = coords['lat'], coords['lon']
             coords_str = f"{lat}, {lon}"
 
-            new_figure = go.Figure(data=current_figure['data'], layout=current_figure['layout'])
-
-            new_figure.add_trace(go.Scattermapbox(
-                mode='markers+text',
-                lon=[lon],
-                lat=[lat],
-                marker={'size': 10, 'color': 'red'},
-                text=["Origin"],
-                textposition="bottom right",
-                showlegend=False
-            ))
-            return coords_str, destination, new_figure, dynamic_destinations, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update
+            new_figure = patch_markers(Patch(), coords_str, destination, dynamic_destinations)
+            return coords_str, destination, new_figure, dynamic_destinations, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update
 
         if not destination:
             coords = clickData['points'][0]
             lat, lon = coords['lat'], coords['lon']
             coords_str = f"{lat}, {lon}"
 
-            new_figure = go.Figure(data=current_figure['data'], layout=current_figure['layout'])
-
-            new_figure.add_trace(go.Scattermapbox(
-                mode='markers+text',
-                lon=[float(origin.split(',')[1]), lon],
-                lat=[float(origin.split(',')[0]), lat],
-                marker={'size': 10, 'color': ['red', '#93979C']},
-                text=["Origin", "Destination"],
-                textposition="bottom right",
-                showlegend=False
-            ))
-            return origin, coords_str, new_figure, dynamic_destinations, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update
+            new_figure = patch_markers(Patch(), origin, coords_str, dynamic_destinations)
+            return origin, coords_str, new_figure, dynamic_destinations, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update
 
         if filled_boxes < len(dynamic_destinations):
             for i in range(len(dynamic_destinations)):
@@ -337,22 +594,16 @@ def update_inputs_and_calculate_travel_time(clickData, n_clicks, start_over_clic
                     coords_str = f"{lat}, {lon}"
 
                     dynamic_destinations[i] = coords_str
-                    new_figure = go.Figure(data=current_figure['data'], layout=current_figure['layout'])
-                    new_figure.add_trace(go.Scattermapbox(
-                        mode='markers+text',
-                        lon=[float(origin.split(',')[1]), float(destination.split(',')[1]), lon],
-                        lat=[float(origin.split(',')[0]), float(destination.split(',')[0]), lat],
-                        marker={'size': 10, 'color': ['red', '#93979C', '#93979C']},
-                        text=["Origin", "Destination", f"Destination {i + 1}"],
-                        textposition="bottom right",
-                        showlegend=False
-                    ))
-                    return origin, destination, new_figure, dynamic_destinations, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update
-
-        return origin, destination, current_figure, dynamic_destinations, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update
+                    new_figure = patch_markers(Patch(), origin, destination, dynamic_destinations)
+                    return origin, destination, new_figure, dynamic_destinations, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update
+
+        return origin, destination, no_update, dynamic_destinations, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update
 
     if trigger == 'start-over-button':
-        return '', '', fig, [], no_update, mode_styles['mode-transit-walk'], mode_styles['mode-transit-bike'], mode_styles['mode-car'], mode_styles['mode-bike'], mode_styles['mode-shared-ride'], mode_styles['mode-walk'], ''
+        if session_id:
+            session_routes.put(session_id, [])
+            set_latest_request(session_id)
+        return '', '', patch_markers(patch_routes(patch_stops(patch_accessibility(Patch()))), '', '', []), [], no_update, mode_styles['mode-transit-walk'], mode_styles['mode-transit-bike'], mode_styles['mode-car'], mode_styles['mode-bike'], mode_styles['mode-shared-ride'], mode_styles['mode-walk'], '', no_update
 
     mode_of_travel = 'TRANSIT_WALK'  # Default to transit walk if none selected
     if trip_mode == 'same':
@@ -409,16 +660,13 @@ def update_inputs_and_calculate_travel_time(clickData, n_clicks, start_over_clic
 
     if trigger in ['calculate-button', 'mode-transit-walk', 'mode-transit-bike', 'mode-car', 'mode-bike', 'mode-shared-ride', 'mode-walk', 'optimization-criteria'] and n_clicks > 0 and origin and destination:
         try:
-            total_travel_time_seconds = 0
-            total_distance_miles = 0
-            total_cost = 0.0
-            all_segments_details = []
-            all_route_traces = []
-            all_slopes = []
-
             coords_list = [origin] + [destination] + dynamic_destinations
             coords_list = [coords for coords in coords_list if coords]
 
+            departure_datetime = departure_from_inputs(departure_time_radio, departure_date, departure_hour, departure_minute)
+
+            leg_modes = [segment_modes[i] if trip_mode == 'different' and i < len(segment_modes) else mode_of_travel for i in range(len(coords_list) - 1)]
+            leg_requests = []
             for i in range(len(coords_list) - 1):
                 origin_coords = parse_coordinates(coords_list[i])
                 destination_coords = parse_coordinates(coords_list[i + 1])
@@ -426,310 +674,26 @@ def update_inputs_and_calculate_travel_time(clickData, n_clicks, start_over_clic
                 if not origin_coords or not destination_coords:
                     raise ValueError("Invalid coordinates")
 
-                origin_lat, origin_lon = origin_coords
-                destination_lat, destination_lon = destination_coords
-                origin_point = Point(origin_lon, origin_lat)
-                destination_point = Point(destination_lon, destination_lat)
-                origins = gpd.GeoDataFrame([{'id': 'origin', 'geometry': origin_point}], crs="EPSG:4326")
-                destinations = gpd.GeoDataFrame([{'id': 'destination', 'geometry': destination_point}], crs="EPSG:4326")
-
-                if departure_time_radio == 'future' and departure_date and departure_hour and departure_minute:
-                    departure_datetime = datetime.combine(datetime.fromisoformat(departure_date).date(), datetime.strptime(f'{departure_hour}:{departure_minute}', '%H:%M').time())
-                else:
-                    departure_datetime = datetime.now()
-
-                current_segment_mode = segment_modes[i] if trip_mode == 'different' and i < len(segment_modes) else mode_of_travel
-
-                if current_segment_mode == 'SHARED_RIDE':
-                    # Compute car travel time
-                    car_itineraries_computer = r5py.DetailedItinerariesComputer(
-                        transport_network,
-                        origins=origins,
-                        destinations=destinations,
-                        departure=departure_datetime,
-                        transport_modes=['CAR']
-                    )
-                    car_travel_details = car_itineraries_computer.compute_travel_details()
-                    min_car_travel_time = car_travel_details['travel_time'].min()
-
-                    # Calculate additional wait time (normally distributed)
-                    wait_time = np.random.normal(loc=8, scale=3)
-                    wait_time = max(1, min(15, wait_time))  # Bound wait time between 1 and 15
-
-                    # Calculate additional travel time (exponentially distributed)
-                    additional_travel_time = np.random.exponential(scale=2)
-                    additional_travel_time = max(1, min(8, additional_travel_time))  # Bound additional travel time between 1 and 8
-
-                    total_segment_travel_time_seconds = min_car_travel_time.total_seconds() + wait_time * 60 + additional_travel_time * 60
-                    total_travel_time_seconds += total_segment_travel_time_seconds
-                    hours = int(total_segment_travel_time_seconds // 3600)
-                    minutes = int((total_segment_travel_time_seconds % 3600) // 60)
-                    seconds = int(total_segment_travel_time_seconds % 60)
-
-                    total_distance_miles += car_travel_details['distance'].sum() * 0.000621371
-
-                    # Calculate shared ride fare
-                    distance_miles = car_travel_details['distance'].sum() * 0.000621371
-                    duration_minutes = total_segment_travel_time_seconds / 60
-                    shared_ride_fare = calculate_fare(base_fare=2.36, cost_per_mile=0.76, cost_per_minute=0.25, service_fee=3.58, distance=distance_miles, duration=duration_minutes)
-                    total_cost += shared_ride_fare
-
-                    all_segments_details.append(
-                        html.Div([
-                            html.Li(f"Segment {i + 1} Travel Time: {hours} hours, {minutes} minutes, and {seconds} seconds", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'margin-bottom': '3px'}),
-                            html.Ul([
-                                html.Li(f"Base Travel Time: {min_car_travel_time}", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'margin-bottom': '3px'}),
-                                html.Li(f"Wait Time: {wait_time:.2f} minutes", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'margin-bottom': '3px'}),
-                                html.Li(f"Additional Travel Time: {additional_travel_time:.2f} minutes", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'margin-bottom': '3px'})
-                                ]),
-                            html.Li(f"Shared Ride Fare: ${shared_ride_fare:.2f}", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'margin-bottom': '3px'})
-                        ])
-                    )
-
-                    route_geometry = car_travel_details.loc[car_travel_details['travel_time'] == min_car_travel_time, 'geometry']
-                    if not route_geometry.empty:
-                        route_coords = list(route_geometry.values[0].coords)
-                        route_lons = [coord[0] for coord in route_coords]
-                        route_lats = [coord[1] for coord in route_coords]
-
-                        route_trace = go.Scattermapbox(
-                            mode='lines',
-                            lon=route_lons,
-                            lat=route_lats,
-                            line=dict(width=2, color='blue'),
-                            name=f'Route {i + 1}'
-                        )
-                        all_route_traces.append(route_trace)
-
-                else:
-                    # Prepare the transport modes for itinerary computation
-                    if current_segment_mode == 'TRANSIT_WALK':
-                        transport_modes = [r5py.TransportMode.TRANSIT]
-                        access_modes = [r5py.TransportMode.WALK]
-                        egress_modes = [r5py.TransportMode.WALK]
-                    elif current_segment_mode == 'TRANSIT_BIKE':
-                        transport_modes = [r5py.TransportMode.TRANSIT, r5py.TransportMode.BICYCLE]
-                        access_modes = [r5py.TransportMode.BICYCLE]
-                        egress_modes = [r5py.TransportMode.BICYCLE]
-                    else:
-                        transport_modes = [r5py.TransportMode[current_segment_mode]]
-                        access_modes = []
-                        egress_modes = []
-
-                    detailed_itineraries_computer = r5py.DetailedItinerariesComputer(
-                        transport_network,
-                        origins=origins,
-                        destinations=destinations,
-                        departure=departure_datetime,
-                        transport_modes=transport_modes,
-                        access_modes=access_modes,
-                        egress_modes=egress_modes
-                    )
-                    travel_details = detailed_itineraries_computer.compute_travel_details()
-
-                    # Filter travel details to ensure it includes both transit and bike segments
-                    if current_segment_mode == 'TRANSIT_BIKE':
-                        travel_details = travel_details[1:]
-
-                    route_trace = None
-
-                    # Conversion functions
-                    def meters_to_miles(meters):
-                        return meters * 0.000621371
-
-                    if current_segment_mode in ['TRANSIT_WALK', 'TRANSIT_BIKE']:
-                        # Group by option and calculate the total travel time
-                        travel_details['total_time'] = travel_details['travel_time'] + travel_details['wait_time']
-
-                        # Calculate walking/biking time as the sum of the first and last segment travel times
-                        walking_biking_time = travel_details.groupby('option', group_keys=False).apply(lambda x: x.iloc[0]['travel_time'] + x.iloc[-1]['travel_time']).reset_index(name='walking_biking_time')
-
-                        # Calculate the number of transfers
-                        travel_details['num_transfers'] = travel_details.groupby('option')['segment'].transform('count') - 3
-
-                        grouped_travel_details = travel_details.groupby('option').agg(
-                            total_time=('total_time', 'sum'),
-                            wait_time=('wait_time', 'sum'),
-                            num_transfers=('num_transfers', 'first'),
-                            distance=('distance', 'sum')
-                        ).reset_index().merge(walking_biking_time, on='option')
-
-                        # Select the best option based on the selected optimization criteria
-                        if optimization_criteria == 'total_time':
-                            min_travel_time_option = grouped_travel_details.loc[grouped_travel_details['total_time'].idxmin()]
-                        elif optimization_criteria == 'transfers':
-                            min_travel_time_option = grouped_travel_details.loc[grouped_travel_details['num_transfers'].idxmin()]
-                        elif optimization_criteria == 'wait_time':
-                            min_travel_time_option = grouped_travel_details.loc[grouped_travel_details['wait_time'].idxmin()]
-                        elif optimization_criteria == 'walking_biking_distance':
-                            min_travel_time_option = grouped_travel_details.loc[grouped_travel_details['distance'].idxmin()]
-                        else:
-                            min_travel_time_option = grouped_travel_details.loc[grouped_travel_details['total_time'].idxmin()]
-
-                        selected_option_details = travel_details[travel_details['option'] == min_travel_time_option['option']]
-
-                        # Calculate total travel time for the selected option
-                        total_segment_travel_time_seconds = selected_option_details['total_time'].sum().total_seconds()
-                        total_wait_time_seconds = selected_option_details['wait_time'].sum().total_seconds()
-                        total_time_seconds = total_segment_travel_time_seconds + total_wait_time_seconds
-
-                        total_distance_meters = selected_option_details['distance'].sum()
-                        total_distance_miles += meters_to_miles(total_distance_meters)
-
-                        total_travel_time_seconds += total_time_seconds
-
-                        first_row = selected_option_details.iloc[0]
-                        last_row = selected_option_details.iloc[-1]
-                        total_walking_biking_distance_meters = first_row['distance'] + last_row['distance']
-                        total_walking_biking_distance_miles = meters_to_miles(total_walking_biking_distance_meters)
-                        total_walking_biking_time = first_row['travel_time'] + last_row['travel_time']
-                        total_out_of_vehicle_time = total_walking_biking_time + selected_option_details['wait_time'].sum()
-
-                        # Calculate transit fare
-                        num_segments = len(selected_option_details)
-                        transit_fare = TRANSIT_FARE_PER_RIDE * (num_segments - 2)  # Subtracting the walk segments
-                        total_cost += transit_fare
-
-                        # Extract and plot the route geometry
-                        first_segment = selected_option_details.iloc[0]
-                        last_segment = selected_option_details.iloc[-1]
-                        transit_segments = selected_option_details.iloc[1:-1]
-
-                        first_segment_coords = list(first_segment['geometry'].coords)
-                        last_segment_coords = list(last_segment['geometry'].coords)
-                        transit_coords = [coord for segment in transit_segments['geometry'] for coord in segment.coords]
-
-                        first_segment_lons = [coord[0] for coord in first_segment_coords]
-                        first_segment_lats = [coord[1] for coord in first_segment_coords]
-                        last_segment_lons = [coord[0] for coord in last_segment_coords]
-                        last_segment_lats = [coord[1] for coord in last_segment_coords]
-                        transit_lons = [coord[0] for coord in transit_coords]
-                        transit_lats = [coord[1] for coord in transit_coords]
-
-                        first_segment_trace = go.Scattermapbox(
-                            mode='lines',
-                            lon=first_segment_lons,
-                            lat=first_segment_lats,
-                            line=dict(width=2, color='lightblue'),
-                            name=f'Segment {i + 1} Walking/Biking Segment'
-                        )
-
-                        transit_trace = go.Scattermapbox(
-                            mode='lines',
-                            lon=transit_lons,
-                            lat=transit_lats,
-                            line=dict(width=2, color='blue'),
-                            name=f'Segment {i + 1} Transit Segment'
-                        )
-
-                        last_segment_trace = go.Scattermapbox(
-                            mode='lines',
-                            lon=last_segment_lons,
-                            lat=last_segment_lats,
-                            line=dict(width=2, color='lightblue'),
-                            name=f'Segment {i + 1} Walking/Biking Segment'
-                        )
-
-                        all_route_traces.extend([first_segment_trace, transit_trace, last_segment_trace])
-
-                        hours = int(total_time_seconds // 3600)
-                        minutes = int((total_time_seconds % 3600) // 60)
-                        seconds = int(total_time_seconds % 60)
-
-                        output = [
-                            html.Li(f"Calculated Travel Time: {hours} hours, {minutes} minutes, and {seconds} seconds", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'margin-bottom': '3px', 'text-align': 'left'}),
-                            html.Li(f"Total Walking/Biking Distance: {total_walking_biking_distance_miles:.2f} miles", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'margin-bottom': '3px', 'text-align': 'left'}),
-                            html.Li(f"Total Out of Vehicle Time: {total_out_of_vehicle_time}", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'margin-bottom': '3px', 'text-align': 'left'}),
-                            html.Li(f"Total Walking/Biking Time: {total_walking_biking_time}", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'margin-bottom': '3px', 'text-align': 'left'})
-                        ]
-                        
-                        all_segments_details.append(
-                            html.Li(f"Segment {i + 1} Travel Time: {hours} hours, {minutes} minutes, and {seconds} seconds", style={'padding': '10px', 'background-color': '#f4f4f9', 'color': 'black', 'margin-bottom': '3px', 'text-align': 'left'}),
-                        )
-                        all_segments_details.extend(output)
-
-                    else:
-                        min_travel_time = travel_details['travel_time'].min()
-                        total_distance_meters = travel_details['distance'].sum()
-                        total_distance_miles += meters_to_miles(total_distance_meters)
-
-                        route_geometry = travel_details.loc[travel_details['travel_time'] == min_travel_time, 'geometry']
-                        if not route_geometry.empty:
-                            route_coords = list(route_geometry.values[0].coords)
-                            route_lons = [coord[0] for coord in route_coords]
-                            route_lats = [coord[1] for coord in route_coords]
-
-                            route_trace = go.Scattermapbox(
-                                mode='lines',
-                                lon=route_lons,
-                                lat=route_lats,
-                                line=dict(width=2, color='blue'),
-                                name=f'Segment {i + 1} Route'
-                            )
-                            all_route_traces.append(route_trace)
-
-                        total_segment_travel_time_seconds = min_travel_time.total_seconds()
-                        total_travel_time_seconds += total_segment_travel_time_seconds
-                        hours = int(total_segment_travel_time_seconds // 3600)
-                        minutes = int((total_segment_travel_time_seconds % 3600) // 60)
-                        seconds = int(total_segment_travel_time_seconds % 60)
-
-                        all_segments_details.append(
-                            html.Li(f"Segment {i + 1} Travel Time: {hours} hours, {minutes} minutes, and {seconds} seconds", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'margin-bottom': '3px', 'text-align': 'left'}),
-                        )
-
-                    # Calculate slope if mode is WALK or BICYCLE
-                    if current_segment_mode in ['WALK', 'BICYCLE']:
-                        try:
-                            line_string = LineString(route_coords)
-                            slopes = calculate_route_slopes(line_string, dem_path)
-                            mean_slope, max_slope = summarize_slopes(slopes)
-                            slope_warning = walking_slope_warning(max_slope)
-                            all_slopes.append(
-                                html.Div([
-                                    html.Li(f"Segment {i + 1} Mean Slope: {mean_slope:.2%}", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'text-align': 'left'}),
-                                    html.Li(f"Segment {i + 1} Max Slope: {max_slope:.2%}", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'text-align': 'left'}),
-                                    html.Li(slope_warning, style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'text-align': 'left'})
-                                ], style={'margin-bottom': '3px'})
-                            )
-                        except Exception as e:
-                            print(f"Error calculating slopes: {e}")
-
-            total_hours = int(total_travel_time_seconds // 3600)
-            total_minutes = int((total_travel_time_seconds % 3600) // 60)
-            total_seconds = int(total_travel_time_seconds % 60)
-
-            total_details = [
-                html.Li(f"Total Travel Time: {total_hours} hours, {total_minutes} minutes, and {total_seconds} seconds", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'margin-bottom': '3px', 'text-align': 'left'}),
-                html.Li(f"Total Distance: {total_distance_miles:.2f} miles", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'margin-bottom': '3px', 'text-align': 'left'}),
-                html.Li(f"Total Cost: ${total_cost:.2f}", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'margin-bottom': '3px', 'text-align': 'left'})
-            ]
-
-            all_details = all_segments_details + total_details + all_slopes
-
-            # Clear existing route traces
-            current_figure = go.Figure(current_figure)
-            current_figure.data = [trace for trace in current_figure.data if trace.mode != 'lines']
-
-            for trace in all_route_traces:
-                current_figure.add_trace(trace)
-
-            # Add origin and destination markers back if they were removed
-            origin_lon, origin_lat = parse_coordinates(origin)
-            destination_lon, destination_lat = parse_coordinates(destination)
-            all_lons = [origin_lon, destination_lon] + [parse_coordinates(dest)[1] for dest in dynamic_destinations if dest]
-            all_lats = [origin_lat, destination_lat] + [parse_coordinates(dest)[0] for dest in dynamic_destinations if dest]
-            all_texts = ["Origin", "Destination"] + [f"Destination {i + 1}" for i in range(len(dynamic_destinations)) if dynamic_destinations[i]]
-
-            current_figure.add_trace(go.Scattermapbox(
-                mode='markers+text',
-                lon=all_lons,
-                lat=all_lats,
-                marker={'size': 10, 'color': ['red'] + ['#93979C'] * (len(all_lons) - 1)},
-                text=all_texts,
-                textposition="bottom right",
-                showlegend=False
-            ))
+                leg_requests.append([origin_coords, destination_coords, departure_datetime.isoformat(), leg_modes[i]])
+
+            with metrics.stage('snap'):
+                distances = snap_distances([parse_coordinates(coords) for coords in coords_list])
+                transit_access_check(leg_requests)
+
+            # Routed by calculate_trip; every request gets a new id so that
+            # repeating the same trip routes it again
+            route_request = {
+                'id': uuid.uuid4().hex,
+                'legs': leg_requests,
+                'key': [coords_list, leg_modes, departure_time_radio, departure_date, departure_hour, departure_minute],
+                'criteria': optimization_criteria,
+                'rerank': trigger == 'optimization-criteria',
+                'snap_distances': distances,
+                'profile': profiling.requested()
+            }
+            if session_id:
+                set_latest_request(session_id, route_request['id'])
+            new_figure = patch_stops(patch_markers(Patch(), origin, destination, dynamic_destinations), leg_requests)
 
             # Update styles for selected mode button
             selected_mode_key = {
@@ -752,12 +716,15 @@ def update_inputs_and_calculate_travel_time(clickData, n_clicks, start_over_clic
                     mode_styles[selected_mode_key]['background-color'] = '#74bf0c'
                     mode_styles[selected_mode_key]['color'] = 'black'
 
-            return origin, destination, current_figure, dynamic_destinations, html.Ul(all_details), mode_styles['mode-transit-walk'], mode_styles['mode-transit-bike'], mode_styles['mode-car'], mode_styles['mode-bike'], mode_styles['mode-shared-ride'], mode_styles['mode-walk'], selected_mode_summary
+            return origin, destination, new_figure, dynamic_destinations, no_update, mode_styles['mode-transit-walk'], mode_styles['mode-transit-bike'], mode_styles['mode-car'], mode_styles['mode-bike'], mode_styles['mode-shared-ride'], mode_styles['mode-walk'], selected_mode_summary, route_request
+
+        except (OutsideCoverage, NoTransitAccess) as e:
+            metrics.set_status('rejected')
+            return origin, destination, no_update, dynamic_destinations, {'error': str(e)}, mode_styles['mode-transit-walk'], mode_styles['mode-transit-bike'], mode_styles['mode-car'], mode_styles['mode-bike'], mode_styles['mode-shared-ride'], mode_styles['mode-walk'], '', no_update
 
         except Exception as e:
-            import traceback
-            print(traceback.format_exc())
-            return origin, destination, current_figure, dynamic_destinations, html.Li(f"Error calculating travel time: {str(e)}", style={'padding': '10px', 'background-color': '#f4f4f9', 'color': 'black', 'margin-bottom': '3px', 'text-align': 'left'}), mode_styles['mode-transit-walk'], mode_styles['mode-transit-bike'], mode_styles['mode-car'], mode_styles['mode-bike'], mode_styles['mode-shared-ride'], mode_styles['mode-walk'], ''
+            metrics.log_exception('callback_error', callback='update_inputs_and_calculate_travel_time')
+            return origin, destination, no_update, dynamic_destinations, {'error': f"Error calculating travel time: {str(e)}"}, mode_styles['mode-transit-walk'], mode_styles['mode-transit-bike'], mode_styles['mode-car'], mode_styles['mode-bike'], mode_styles['mode-shared-ride'], mode_styles['mode-walk'], '', no_update
 
     if trigger in ['mode-transit-walk', 'mode-transit-bike', 'mode-car', 'mode-bike', 'mode-shared-ride', 'mode-walk']:
         # Preserve the origin and destination markers on the map
@@ -767,23 +734,11 @@ def update_inputs_and_calculate_travel_time(clickData, n_clicks, start_over_clic
         if not origin_coords or not destination_coords:
             raise ValueError("Invalid coordinates")
 
-        origin_lon, origin_lat = origin_coords
-        destination_lon, destination_lat = destination_coords
-        all_lons = [origin_lon, destination_lon] + [parse_coordinates(dest)[1] for dest in dynamic_destinations if dest]
-        all_lats = [origin_lat, destination_lat] + [parse_coordinates(dest)[0] for dest in dynamic_destinations if dest]
-        all_texts = ["Origin", "Destination"] + [f"Destination {i + 1}" for i in range(len(dynamic_destinations)) if dynamic_destinations[i]]
-
-        current_figure = go.Figure(data=current_figure['data'], layout=current_figure['layout'])
-        current_figure.data = [trace for trace in current_figure.data if trace.mode != 'lines']
-        current_figure.add_trace(go.Scattermapbox(
-            mode='markers+text',
-            lon=all_lons,
-            lat=all_lats,
-            marker={'size': 10, 'color': ['red'] + ['#93979C'] * (len(all_lons) - 1)},
-            text=all_texts,
-            textposition="bottom right",
-            showlegend=False
-        ))
+        # Clear the previous routes
+        if session_id:
+            session_routes.put(session_id, [])
+            set_latest_request(session_id)
+        new_figure = patch_markers(patch_routes(patch_stops(Patch())), origin, destination, dynamic_destinations)
 
         # Update styles for selected mode button
         selected_mode_key = {
@@ -798,9 +753,398 @@ def update_inputs_and_calculate_travel_time(clickData, n_clicks, start_over_clic
             mode_styles[selected_mode_key]['background-color'] = '#74bf0c'
             mode_styles[selected_mode_key]['color'] = 'black'
 
-        return origin, destination, current_figure, dynamic_destinations, no_update, mode_styles['mode-transit-walk'], mode_styles['mode-transit-bike'], mode_styles['mode-car'], mode_styles['mode-bike'], mode_styles['mode-shared-ride'], mode_styles['mode-walk'], ''
+        return origin, destination, new_figure, dynamic_destinations, no_update, mode_styles['mode-transit-walk'], mode_styles['mode-transit-bike'], mode_styles['mode-car'], mode_styles['mode-bike'], mode_styles['mode-shared-ride'], mode_styles['mode-walk'], '', no_update
+
+    return origin, destination, no_update, dynamic_destinations, no_update, no_update, no_update, no_update, no_update, no_update, no_update, '', no_update
+
+def route_trip(set_progress, route_request, session_id, map_zoom):
+    # Route the trip requested by the main callback and fill in the itinerary
+    # and the route traces. The results of a request superseded in the
+    # meantime are dropped.
+    try:
+        check_superseded((session_id, route_request['id']))
+        total_travel_time_seconds = 0
+        total_distance_miles = 0
+        total_cost = 0.0
+        all_segments_details = []
+        leg_summaries = []
+        all_slopes = []
+
+        stored_trip = session_trips.get(session_id) if session_id else None
+        rerank = route_request['rerank'] and stored_trip is not None and stored_trip['key'] == route_request['key']
+        if route_request['rerank']:
+            metrics.record_cache('session_trips', rerank)
+
+        if rerank:
+            # Only the criteria changed: re-rank the stored option tables
+            legs = stored_trip['legs']
+        else:
+            leg_requests = [(tuple(origin_coords), tuple(destination_coords), datetime.fromisoformat(departure), mode)
+                            for origin_coords, destination_coords, departure, mode in route_request['legs']]
+            set_progress(f"Routing {len(leg_requests)} segment(s)...")
+            legs = plan_legs(leg_requests, session_id, route_request['id'])
+            check_superseded((session_id, route_request['id']))
+            if session_id:
+                session_trips.put(session_id, {'key': route_request['key'], 'legs': legs})
+
+        set_progress("Preparing the itinerary...")
+        for i, leg in enumerate(legs):
+            with metrics.stage('summarize', leg['mode'], leg=i):
+                summary = summarize_leg(leg, route_request['criteria'])
+            current_segment_mode = summary['mode']
+
+            total_segment_travel_time_seconds = summary['travel_time_seconds']
+            total_travel_time_seconds += total_segment_travel_time_seconds
+            total_distance_miles += summary['distance_miles']
+            total_cost += summary['cost']
+            hours = int(total_segment_travel_time_seconds // 3600)
+            minutes = int((total_segment_travel_time_seconds % 3600) // 60)
+            seconds = int(total_segment_travel_time_seconds % 60)
+
+            segment_time = f"Segment {i + 1} Travel Time: {hours} hours, {minutes} minutes, and {seconds} seconds"
+            if current_segment_mode == 'SHARED_RIDE':
+                all_segments_details.append({
+                    'title': segment_time,
+                    'breakdown': [
+                        f"Base Travel Time: {summary['base_travel_time']}",
+                        f"Expected Wait Time: {summary['wait_time']:.2f} minutes",
+                        f"Expected Additional Travel Time: {summary['additional_travel_time']:.2f} minutes",
+                        "Travel Time " + ", ".join(f"p{p}: {seconds / 60:.1f} minutes" for p, seconds in summary['travel_time_percentiles'].items())
+                    ],
+                    'details': [
+                        f"Expected Shared Ride Fare: ${summary['cost']:.2f}",
+                        "Fare " + ", ".join(f"p{p}: ${cost:.2f}" for p, cost in summary['cost_percentiles'].items())
+                    ]
+                })
+
+            elif current_segment_mode in ['TRANSIT_WALK', 'TRANSIT_BIKE']:
+                all_segments_details.append({
+                    'title': segment_time,
+                    'transit': True,
+                    'details': [
+                        f"Calculated Travel Time: {hours} hours, {minutes} minutes, and {seconds} seconds",
+                        f"Total Walking/Biking Distance: {summary['walking_biking_distance_miles']:.2f} miles",
+                        f"Total Out of Vehicle Time: {summary['out_of_vehicle_time']}",
+                        f"Total In Vehicle Time: {summary['in_vehicle_time']}",
+                        f"Total Walking/Biking Time: {summary['walking_biking_time']}"
+                    ]
+                })
+
+            else:
+                all_segments_details.append({'title': segment_time})
+
+            distances = (route_request.get('snap_distances') or [])[i:i + 2]
+            labels = point_labels(len(route_request['legs']) + 1)[i:i + 2]
+            snap_notes = [f"{end} at the nearest street, {distance:.0f} m from the {label}"
+                          for end, label, distance in zip(['Starts', 'Ends'], labels, distances) if distance is not None and distance > SNAP_NOTE_METERS]
+            if snap_notes:
+                all_segments_details[-1]['details'] = all_segments_details[-1].get('details', []) + snap_notes
+
+            leg_summaries.append(summary)
+
+            # Calculate slope if mode is WALK or BICYCLE. With the grade
+            # index, slope lookups are cheap enough to also check the
+            # walking/biking legs of transit trips
+            if current_segment_mode in ['WALK', 'BICYCLE'] or grade_index is not None:
+                for label, segment_geometry in summary['slope_segments']:
+                    try:
+                        with metrics.stage('slopes', current_segment_mode, leg=i):
+                            all_slopes.append(slope_details(f"Segment {i + 1} {label} Walking/Biking Leg" if label else f"Segment {i + 1}", segment_geometry))
+                    except Exception:
+                        metrics.log_exception('slope_error', leg=i, mode=current_segment_mode)
+
+        total_hours = int(total_travel_time_seconds // 3600)
+        total_minutes = int((total_travel_time_seconds % 3600) // 60)
+        total_seconds = int(total_travel_time_seconds % 60)
+
+        # Itinerary as plain data, rendered in the browser (assets/itinerary.js)
+        itinerary = {
+            'segments': all_segments_details,
+            'totals': [
+                f"Total Travel Time: {total_hours} hours, {total_minutes} minutes, and {total_seconds} seconds",
+                f"Total Distance: {total_distance_miles:.2f} miles",
+                f"Total Cost: ${total_cost:.2f}"
+            ],
+            'slopes': all_slopes
+        }
+
+        # Only the route traces change
+        routes = [route for summary in leg_summaries for route in summary['routes']]
+        if session_id:
+            session_routes.put(session_id, routes)
+        with metrics.stage('figure'):
+            return patch_routes(Patch(), routes, map_zoom), itinerary
+
+    except (RoutingCancelled, RequestSuperseded):
+        # A newer request from this session replaced this one
+        metrics.set_status('cancelled')
+        return no_update, no_update
+
+    except (OutsideCoverage, NoTransitAccess) as e:
+        metrics.set_status('rejected')
+        return no_update, {'error': str(e)}
+
+    except Exception as e:
+        metrics.log_exception('callback_error', callback='calculate_trip')
+        return no_update, {'error': f"Error calculating travel time: {str(e)}"}
+
+trip_outputs = [Output('map-graph', 'figure', allow_duplicate=True),
+                Output('itinerary-data', 'data', allow_duplicate=True)]
+trip_states = [State('session-id', 'data'),
+               State('map-zoom', 'data')]
+
+if background_callback_manager is not None:
+    # Runs in a separate process. Dash terminates the job when the request is
+    # repeated or cancelled, and the routing service drops the session's
+    # older jobs.
+    @app.callback(
+        trip_outputs,
+        [Input('route-request', 'data')],
+        trip_states,
+        background=True,
+        manager=background_callback_manager,
+        progress=Output('routing-progress', 'children'),
+        cancel=[Input('cancel-routing-button', 'n_clicks'),
+                Input('start-over-button', 'n_clicks')],
+        running=[(Output('cancel-routing-button', 'style'), {'margin': '5px'}, {'display': 'none'})],
+        interval=500,
+        prevent_initial_call=True
+    )
+    def calculate_trip(set_progress, route_request, session_id, map_zoom):
+        with metrics.trace('calculate_trip') as current, profiling.profiled(current, route_request.get('profile')):
+            return route_trip(set_progress, route_request, session_id, map_zoom)
+else:
+    @app.callback(
+        trip_outputs,
+        [Input('route-request', 'data')],
+        trip_states,
+        running=[(Output('routing-progress', 'children'), "Routing...", "")],
+        prevent_initial_call=True
+    )
+    def calculate_trip(route_request, session_id, map_zoom):
+        with metrics.trace('calculate_trip') as current, profiling.profiled(current, route_request.get('profile')):
+            return route_trip(lambda message: None, route_request, session_id, map_zoom)
+
+@app.callback(
+    [Output('map-graph', 'figure', allow_duplicate=True),
+     Output('map-zoom', 'data')],
+    [Input('map-graph', 'relayoutData')],
+    [State('map-zoom', 'data'),
+     State('session-id', 'data')],
+    prevent_initial_call=True
+)
+def update_map_view(relayout_data, map_zoom, session_id):
+    relayout_data = relayout_data or {}
+    viewport = viewport_bounds(relayout_data)
+    if viewport is None:
+        return no_update, no_update
+    lon, lat = click_grid(viewport, service_bounds())
+    patch = Patch()
+    patch['data'][GRID_TRACE]['lon'] = encode_array(lon)
+    patch['data'][GRID_TRACE]['lat'] = encode_array(lat)
+
+    # Show the routes in more (or less) detail once the zoom level changes
+    zoom = relayout_data.get('mapbox.zoom', map_zoom)
+    routes = session_routes.get(session_id) if session_id else None
+    if routes and zoom_tolerance(zoom) != zoom_tolerance(map_zoom or DEFAULT_ZOOM):
+        patch_routes(patch, routes, zoom)
+    return patch, zoom
+
+clientside_callback(
+    ClientsideFunction(namespace='itinerary', function_name='render'),
+    Output('travel-time', 'children'),
+    Input('itinerary-data', 'data')
+)
 
-    return origin, destination, current_figure, dynamic_destinations, no_update, no_update, no_update, no_update, no_update, no_update, no_update, ''
+@app.callback(
+    Output('pareto-options', 'children'),
+    [Input('pareto-button', 'n_clicks')],
+    [State('session-id', 'data')]
+)
+def show_pareto_options(n_clicks, session_id):
+    if not n_clicks:
+        return no_update
+    stored_trip = session_trips.get(session_id) if session_id else None
+    if stored_trip is None:
+        return html.Li("Calculate a transit trip first to compare its options", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'text-align': 'left'})
+
+    details = []
+    for i, leg in enumerate(stored_trip['legs']):
+        if 'grouped_travel_details' not in leg:
+            continue
+        details.append(html.Li(f"Segment {i + 1} Pareto Options ({leg['mode']}):", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'font-weight': 'bold', 'text-align': 'left'}))
+        for _, option in pareto_options(leg['grouped_travel_details']).iterrows():
+            details.append(html.Li(
+                f"Option {option['option']}: Total Time {option['total_time']}, Transfers {option['num_transfers']}, Wait Time {option['wait_time']}, Distance {option['distance'] * 0.000621371:.2f} miles, Fare ${option['fare']:.2f}",
+                style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'text-align': 'left'}
+            ))
+    if not details:
+        return html.Li("The current trip has no transit segments", style={'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'text-align': 'left'})
+    return html.Ul(details)
+
+@app.callback(
+    Output('mode-comparison', 'children'),
+    [Input('compare-button', 'n_clicks')],
+    [State('input-origin', 'value'),
+     State('input-destination', 'value'),
+     State({'type': 'dynamic-destination', 'index': ALL}, 'value'),
+     State('departure-time-radio', 'value'),
+     State('departure-date-picker', 'date'),
+     State('departure-hour', 'value'),
+     State('departure-minute', 'value'),
+     State('optimization-criteria', 'value')]
+)
+def compare_modes(n_clicks, origin, destination, dynamic_destinations, departure_time_radio, departure_date, departure_hour, departure_minute, optimization_criteria):
+    if not n_clicks:
+        return no_update
+    cell_style = {'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'text-align': 'left'}
+    try:
+        coords_list = [coords for coords in [origin, destination] + dynamic_destinations if coords]
+        if len(coords_list) < 2:
+            raise ValueError("Enter an origin and a destination first")
+        points = [parse_coordinates(coords) for coords in coords_list]
+        if not all(points):
+            raise ValueError("Invalid coordinates")
+        with metrics.stage('snap'):
+            snap_distances(points)
+        departure_datetime = departure_from_inputs(departure_time_radio, departure_date, departure_hour, departure_minute)
+
+        # Every mode of every leg in one batch; shared rides reuse the car routes
+        legs_by_mode = plan_compare_legs([(points[i], points[i + 1], departure_datetime) for i in range(len(points) - 1)])
+
+        rows = []
+        for option in mode_options:
+            errors = [leg['error'] for leg in legs_by_mode[option['value']] if 'error' in leg]
+            if errors:
+                # Transit with no stop in reach, or no itinerary
+                rows.append(html.Tr([html.Td(option['label'], style=cell_style), html.Td(errors[0], colSpan=4, style=cell_style)]))
+                continue
+            leg_summaries = [summarize_leg(leg, optimization_criteria) for leg in legs_by_mode[option['value']]]
+            trip = summarize_trip(leg_summaries)
+            hours = int(trip['travel_time_seconds'] // 3600)
+            minutes = int((trip['travel_time_seconds'] % 3600) // 60)
+
+            max_slopes = [max_slope for summary in leg_summaries for _, _, max_slope in leg_slopes(summary, grade_index, elevation_sampler)]
+            max_slope = f"{max(max_slopes):.2%}" if max_slopes else "-"
+
+            rows.append(html.Tr([
+                html.Td(option['label'], style=cell_style),
+                html.Td(f"{hours} hours, {minutes} minutes", style=cell_style),
+                html.Td(f"{trip['distance_miles']:.2f} miles", style=cell_style),
+                html.Td(f"${trip['cost']:.2f}", style=cell_style),
+                html.Td(max_slope, style=cell_style)
+            ]))
+
+        header = html.Tr([html.Th(column, style=cell_style) for column in ['Mode', 'Travel Time', 'Distance', 'Cost', 'Max Slope']])
+        return html.Table([header] + rows, style={'width': '100%'})
+
+    except OutsideCoverage as e:
+        metrics.set_status('rejected')
+        return html.Li(str(e), style=cell_style)
+
+    except Exception as e:
+        metrics.log_exception('callback_error', callback='compare_modes')
+        return html.Li(f"Error comparing modes: {str(e)}", style=cell_style)
+
+@app.callback(
+    [Output('map-graph', 'figure', allow_duplicate=True),
+     Output('accessibility-summary', 'children')],
+    [Input('accessibility-button', 'n_clicks')],
+    [State('input-origin', 'value'),
+     State('accessibility-mode', 'value'),
+     State('departure-time-radio', 'value'),
+     State('departure-date-picker', 'date'),
+     State('departure-hour', 'value'),
+     State('departure-minute', 'value'),
+     State('session-id', 'data')],
+    prevent_initial_call=True
+)
+def show_accessibility(n_clicks, origin, mode, departure_time_radio, departure_date, departure_hour, departure_minute, session_id):
+    if not n_clicks:
+        return no_update, no_update
+    try:
+        origin_coords = parse_coordinates(origin) if origin else None
+        if not origin_coords:
+            raise ValueError("Enter an origin first")
+        with metrics.stage('snap'):
+            snap_distances([origin_coords])
+        departure_datetime = departure_from_inputs(departure_time_radio, departure_date, departure_hour, departure_minute)
+
+        # One travel time matrix from the origin cell to every grid cell
+        accessibility = plan_accessibility(origin_coords, departure_datetime, mode, f"{session_id}/accessibility" if session_id else None)
+
+        minutes = accessibility['minutes']
+        bands = [f"{np.count_nonzero(minutes <= limit)} cells within {limit} minutes" for limit in range(15, ACCESSIBILITY_MAX_MINUTES + 1, 15)]
+        summary = [html.Li(f"Accessibility by {mode} from {accessibility['origin'][0]:.4f}, {accessibility['origin'][1]:.4f}: {len(minutes)} of {accessibility['cells']} grid cells reachable within {ACCESSIBILITY_MAX_MINUTES} minutes")]
+        summary += [html.Li(band) for band in bands]
+        return patch_accessibility(Patch(), accessibility), html.Ul(summary)
+
+    except RoutingCancelled:
+        metrics.set_status('cancelled')
+        return no_update, no_update
+
+    except OutsideCoverage as e:
+        metrics.set_status('rejected')
+        return no_update, html.Li(str(e))
+
+    except Exception as e:
+        metrics.log_exception('callback_error', callback='show_accessibility')
+        return no_update, html.Li(f"Error calculating accessibility: {str(e)}")
+
+@app.callback(
+    Output('departure-sweep', 'children'),
+    [Input('sweep-button', 'n_clicks')],
+    [State('input-origin', 'value'),
+     State('input-destination', 'value'),
+     State('sweep-window', 'value'),
+     State('departure-time-radio', 'value'),
+     State('departure-date-picker', 'date'),
+     State('departure-hour', 'value'),
+     State('departure-minute', 'value'),
+     State('session-id', 'data')]
+)
+def show_departure_sweep(n_clicks, origin, destination, window_minutes, departure_time_radio, departure_date, departure_hour, departure_minute, session_id):
+    if not n_clicks:
+        return no_update
+    cell_style = {'padding': '3px', 'background-color': '#f4f4f9', 'color': 'black', 'text-align': 'left'}
+    try:
+        origin_coords = parse_coordinates(origin) if origin else None
+        destination_coords = parse_coordinates(destination) if destination else None
+        if not origin_coords or not destination_coords:
+            raise ValueError("Enter an origin and a destination first")
+        with metrics.stage('snap'):
+            snap_distances([origin_coords, destination_coords])
+        departure_datetime = departure_from_inputs(departure_time_radio, departure_date, departure_hour, departure_minute)
+        window = timedelta(minutes=window_minutes)
+
+        # Every departure minute of the window in one computation per transit mode
+        sweep = plan_departure_sweep(origin_coords, destination_coords, departure_datetime, window, f"{session_id}/sweep" if session_id else None)
+
+        def percentiles(values):
+            return " / ".join("-" if np.isnan(values[p]) else f"{values[p]:.0f}" for p in SWEEP_PERCENTILES)
+
+        labels = {option['value']: option['label'] for option in mode_options}
+        rows = [html.Tr([
+            html.Td(labels[mode], style=cell_style),
+            html.Td(percentiles(result['travel_time']), style=cell_style),
+            html.Td(percentiles(result['wait_time']), style=cell_style)
+        ]) for mode, result in sweep.items()]
+        columns = " / ".join(f"p{p}" for p in SWEEP_PERCENTILES)
+        header = html.Tr([html.Th(column, style=cell_style) for column in ['Mode', f'Travel Time, min ({columns})', f'Wait Time, min ({columns})']])
+        title = html.Div(f"Departing {departure_datetime:%H:%M}-{departure_datetime + window:%H:%M}, origin to destination", style={'margin': '5px'})
+        return [title, html.Table([header] + rows, style={'width': '100%'})]
+
+    except RoutingCancelled:
+        metrics.set_status('cancelled')
+        return no_update
+
+    except OutsideCoverage as e:
+        metrics.set_status('rejected')
+        return html.Li(str(e), style=cell_style)
+
+    except Exception as e:
+        metrics.log_exception('callback_error', callback='show_departure_sweep')
+        return html.Li(f"Error calculating departure window: {str(e)}", style=cell_style)
 
 @app.callback(
     Output('departure-time-div', 'style'),
@@ -812,4 +1156,4 @@ def toggle_departure_time_div(radio_value):
     return {'display': 'none'}
 
 if __name__ == '__main__':
-    app.run_server(debug=True)
+    app.run(debug=True)
@@ -0,0 +1,43 @@
+// Renders the itinerary data sent by the main callback into the travel-time
+// panel, so the server does not send one styled html.Li per line
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    itinerary: {
+        render: function (data) {
+            if (!data) {
+                return window.dash_clientside.no_update;
+            }
+
+            function element(type, children, className) {
+                var props = {children: children};
+                if (className) {
+                    props.className = className;
+                }
+                return {type: type, namespace: 'dash_html_components', props: props};
+            }
+
+            function items(lines, className) {
+                return (lines || []).map(function (line) {
+                    return element('Li', line, className);
+                });
+            }
+
+            if (data.error) {
+                return element('Ul', [element('Li', data.error, 'error')], 'itinerary');
+            }
+
+            var children = [];
+            (data.segments || []).forEach(function (segment) {
+                children.push(element('Li', segment.title, segment.transit ? 'transit-segment' : null));
+                if (segment.breakdown) {
+                    children.push(element('Ul', items(segment.breakdown)));
+                }
+                children = children.concat(items(segment.details));
+            });
+            children = children.concat(items(data.totals));
+            (data.slopes || []).forEach(function (slope) {
+                children.push(element('Div', items(slope), 'slopes'));
+            });
+            return element('Ul', children, 'itinerary');
+        }
+    }
+});
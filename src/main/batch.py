@@ -0,0 +1,221 @@
+import argparse
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+import config
+
+INPUT_COLUMNS = ['origin_lat', 'origin_lon', 'destination_lat', 'destination_lon', 'mode']
+
+# Most legs routed in one call. A chunk is sorted by departure and mode
+# first, so a slice holds few groups of legs routed together.
+ROUTE_SLICE = 100
+
+# Set up once per worker process by _init_worker
+_worker = {}
+
+
+def read_chunks(input_path, chunk_size):
+    # Stream the OD pairs without loading the whole input
+    if input_path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(input_path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(input_path, chunksize=chunk_size)
+
+
+def part_path(output_dir, chunk_index):
+    return os.path.join(output_dir, f'part-{chunk_index:05d}.parquet')
+
+
+def _init_worker(osm_path, gtfs_path, optimization_criteria, routing_threads):
+    # r5py starts a JVM, so every worker loads its own transport network.
+    # The workers share the CPUs, so each routes fewer groups at once.
+    from elevation import open_elevation_sampler
+    from grades import open_grade_index
+    from routing import get_network_version, get_transport_network, start_network_warmup
+
+    config.routing_threads = routing_threads
+    start_network_warmup(osm_path, gtfs_path)
+    _worker['transport_network'] = get_transport_network()
+    _worker['network_version'] = get_network_version()
+    _worker['grade_index'] = open_grade_index()
+    _worker['sampler'] = open_elevation_sampler()
+    _worker['optimization_criteria'] = optimization_criteria
+
+
+def _trip_row(trip_id, mode, departure, trip):
+    from shapely.geometry import MultiLineString
+
+    lines = [route['coords'] for leg in trip['legs'] for route in leg['routes'] if len(route['coords']) >= 2]
+    return {
+        'trip_id': trip_id,
+        'mode': mode,
+        'departure': departure,
+        'travel_time_seconds': trip['travel_time_seconds'],
+        'distance_miles': trip['distance_miles'],
+        'cost': trip['cost'],
+        'max_slope': trip['max_slope'],
+        'error': None,
+        'geometry': MultiLineString(lines) if lines else None,
+    }
+
+
+def _error_row(trip_id, mode, departure, error):
+    return {
+        'trip_id': trip_id,
+        'mode': mode,
+        'departure': departure,
+        'travel_time_seconds': float('nan'),
+        'distance_miles': float('nan'),
+        'cost': float('nan'),
+        'max_slope': float('nan'),
+        'error': str(error),
+        'geometry': None,
+    }
+
+
+def plan_chunk(chunk_index, chunk, output_path):
+    # Route one chunk and write it as a GeoParquet part file. The file is
+    # renamed into place only once complete, so a part that exists is done.
+    import geopandas as gpd
+    from planner import COMPARE_MODES, route_legs, summarize_planned_trip
+    from routing import departure_bucket, get_street_index
+    from streets import coverage_error
+
+    legs = [((row.origin_lat, row.origin_lon), (row.destination_lat, row.destination_lon), row.departure, row.mode)
+            for row in chunk.itertuples(index=False)]
+    # Trips starting or ending far from any street fail on their own, so the
+    # rest of the chunk is still routed at once
+    outside = {}
+    streets = get_street_index()
+    if streets is not None and legs:
+        points = np.array([point for leg in legs for point in leg[:2]], dtype=float)
+        _, _, distances = streets.snap(points[:, 0], points[:, 1])
+        for j in np.flatnonzero(distances > config.max_snap_distance):
+            outside.setdefault(j // 2, coverage_error(['origin', 'destination'][j % 2], points[j], distances[j]))
+    valid = [i for i, leg in enumerate(legs) if leg[3] in COMPARE_MODES and i not in outside]
+    valid.sort(key=lambda i: (departure_bucket(legs[i][2]), legs[i][3]))
+    settings = (_worker['optimization_criteria'], _worker['grade_index'], _worker['sampler'])
+
+    # Slices of legs sharing a mode and departure where possible, routed
+    # together; a slice that fails falls back to one leg at a time to find
+    # the legs that fail
+    routed = {}
+    for start in range(0, len(valid), ROUTE_SLICE):
+        batch = valid[start:start + ROUTE_SLICE]
+        try:
+            routed.update(zip(batch, route_legs(_worker['transport_network'], _worker['network_version'], [legs[i] for i in batch])))
+        except Exception:
+            pass
+
+    rows = []
+    for i, (trip_id, leg) in enumerate(zip(chunk['trip_id'], legs)):
+        departure, mode = leg[2], leg[3]
+        try:
+            if mode not in COMPARE_MODES:
+                raise ValueError(f"Unknown mode: {mode}")
+            if i in outside:
+                raise outside[i]
+            routed_leg = routed[i] if i in routed else route_legs(_worker['transport_network'], _worker['network_version'], [leg])[0]
+            rows.append(_trip_row(trip_id, mode, departure, summarize_planned_trip([routed_leg], *settings)))
+        except Exception as e:
+            rows.append(_error_row(trip_id, mode, departure, e))
+
+    results = gpd.GeoDataFrame(rows, geometry='geometry', crs='EPSG:4326')
+    tmp_path = output_path + '.tmp'
+    results.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, output_path)
+    return chunk_index, len(results), int(results['error'].notna().sum())
+
+
+def prepare_chunk(chunk, start, default_departure):
+    missing = [column for column in INPUT_COLUMNS if column not in chunk.columns]
+    if missing:
+        raise ValueError(f"Input is missing columns: {', '.join(missing)}")
+    chunk = chunk.copy()
+    if 'trip_id' not in chunk.columns:
+        chunk['trip_id'] = range(start, start + len(chunk))
+    if 'departure' in chunk.columns:
+        chunk['departure'] = pd.to_datetime(chunk['departure'])
+    elif default_departure is not None:
+        chunk['departure'] = default_departure
+    else:
+        raise ValueError("Input has no departure column; pass --departure")
+    chunk['mode'] = chunk['mode'].str.upper()
+    return chunk[['trip_id', 'departure'] + INPUT_COLUMNS]
+
+
+def check_manifest(output_dir, input_path, chunk_size):
+    # Part files are numbered by chunk, so a run can only be resumed with the
+    # same input and chunk size
+    manifest_path = os.path.join(output_dir, '_manifest.json')
+    manifest = {'input': os.path.abspath(input_path), 'chunk_size': chunk_size}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            existing = json.load(f)
+        if existing != manifest:
+            raise ValueError(f"{output_dir} holds results of another run ({existing}); use a new output directory")
+    else:
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+
+
+def run(input_path, output_dir, chunk_size=1000, workers=None, optimization_criteria='total_time',
+        departure=None, osm_path=config.osm_path, gtfs_path=config.gtfs_path):
+    for path in [osm_path, gtfs_path]:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Network input not found: {path}")
+    os.makedirs(output_dir, exist_ok=True)
+    check_manifest(output_dir, input_path, chunk_size)
+    workers = workers or os.cpu_count()
+    routing_threads = config.routing_threads or max(1, os.cpu_count() // workers)
+
+    pending = set()
+    planned = skipped = 0
+    # Spawn the workers: forking a process that may already run a JVM is unsafe
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'),
+                             initializer=_init_worker, initargs=(osm_path, gtfs_path, optimization_criteria, routing_threads)) as executor:
+        for chunk_index, chunk in enumerate(read_chunks(input_path, chunk_size)):
+            output_path = part_path(output_dir, chunk_index)
+            if os.path.exists(output_path):
+                skipped += 1
+                continue
+            chunk = prepare_chunk(chunk, chunk_index * chunk_size, departure)
+
+            # Keep only a few chunks in flight so memory does not grow with the input
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                planned += report(done)
+            pending.add(executor.submit(plan_chunk, chunk_index, chunk, output_path))
+        planned += report(wait(pending).done)
+    return planned, skipped
+
+
+def report(futures):
+    for future in futures:
+        chunk_index, count, errors = future.result()
+        print(f"part {chunk_index:05d}: {count} trips, {errors} errors")
+    return len(futures)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plan trips for OD pairs read from CSV or Parquet and write the results as GeoParquet part files.')
+    parser.add_argument('input', help='CSV or Parquet with origin_lat, origin_lon, destination_lat, destination_lon, mode and optionally trip_id and departure')
+    parser.add_argument('output', help='output directory; an interrupted run is resumed by running the same command again')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='trips per part file')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--criteria', default='total_time', choices=['total_time', 'transfers', 'wait_time', 'walking_biking_distance', 'cost'], help='optimization criteria for transit options')
+    parser.add_argument('--departure', type=datetime.fromisoformat, default=None, help='departure time (ISO format) for inputs without a departure column')
+    parser.add_argument('--osm', default=config.osm_path, help='OSM extract (.osm.pbf)')
+    parser.add_argument('--gtfs', default=config.gtfs_path, help='GTFS feed (.zip)')
+    args = parser.parse_args()
+
+    planned, skipped = run(args.input, args.output, args.chunk_size, args.workers, args.criteria, args.departure, args.osm, args.gtfs)
+    print(f"Planned {planned} parts, skipped {skipped} already written")
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    # Thread-safe, size-bounded mapping that evicts the least recently used
+    # entry and counts hits and misses
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+
+class DiskLRUCache:
+    # LRUCache counterpart kept in a diskcache directory, for entries shared
+    # by several processes (the web server and its background callbacks).
+    # Bounded by total size rather than entry count.
+
+    def __init__(self, directory, size_limit=2 ** 28):
+        import diskcache
+        self._cache = diskcache.Cache(directory, size_limit=size_limit, eviction_policy='least-recently-used')
+
+    def get(self, key, default=None):
+        return self._cache.get(key, default)
+
+    def put(self, key, value):
+        self._cache.set(key, value)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def __len__(self):
+        return len(self._cache)
+
+    def clear(self):
+        self._cache.clear()
+
+
+def file_digest(path):
+    # SHA-256 of a file's content. The digest is kept next to the file and
+    # reused while its size and modification time are unchanged, so warm
+    # restarts do not re-read multi-GB extracts.
+    stat = os.stat(path)
+    digest_path = path + '.sha256'
+    try:
+        with open(digest_path) as f:
+            cached = json.load(f)
+        if cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['sha256']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    try:
+        with open(digest_path, 'w') as f:
+            json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()}, f)
+    except OSError:
+        pass
+    return digest.hexdigest()
@@ -0,0 +1,56 @@
+import os
+
+# Input data used by the trip planner. The environment variables point the
+# app at other inputs, e.g. the sliced copies written by preprocess.py.
+gtfs_path = os.environ.get('GTFS_PATH', 'gtfs.zip')
+osm_path = os.environ.get('OSM_PATH', 'durham_new.osm.pbf')
+dem_path = os.environ.get('DEM_PATH', 'USGS_13_n36w079_20130911.tif')
+
+# GTFS and OSM inputs trimmed to the service area and dates (see
+# `python preprocess.py --help`)
+sliced_inputs_dir = os.environ.get('SLICED_INPUTS_DIR', 'sliced')
+
+# Elevation grid clipped to the service area (see `python elevation.py --help`)
+dem_grid_path = 'dem_grid.npy'
+
+# Per-edge grades of the walk/bike network (see `python grades.py --help`)
+grade_index_path = 'edge_grades.parquet'
+
+# Origins and destinations farther than this from any street (in meters)
+# are rejected before routing (see streets.py)
+max_snap_distance = float(os.environ.get('MAX_SNAP_DISTANCE', 500))
+
+# Longest walk or bike ride to and from transit, in minutes, at r5py's
+# default speeds. A transit leg is only routed when both ends have a stop
+# within that distance in a straight line (see routing.transit_access_error).
+transit_access_minutes = 20
+walking_speed_kmh = 3.6
+cycling_speed_kmh = 12.0
+
+# Most leg groups (a mode and departure each) one process routes at the same
+# time; each runs its own R5 computation (default: one per CPU)
+routing_threads = int(os.environ.get('ROUTING_THREADS', 0)) or None
+
+# Transit fare per ride when the GTFS feed has no fare for it
+transit_fare_per_ride = 1.00
+
+# Service area
+lat_start, lat_end = 35.88, 36.08
+lon_start, lon_end = -78.98, -78.85
+
+# Routing service (see `python routing_service.py --help`). When the address
+# is set, the app sends routing jobs to the service instead of loading the
+# transport network itself.
+routing_service_address = os.environ.get('ROUTING_SERVICE_ADDRESS')  # host:port
+# Shared secret of the service and the app, required by both. Jobs and
+# results are pickled, so anyone holding the key can run code in the workers.
+routing_service_authkey = os.environ.get('ROUTING_SERVICE_AUTHKEY', '').encode() or None
+routing_timeout = float(os.environ.get('ROUTING_TIMEOUT', 60))  # seconds
+
+# Directory for profiles of single routing requests (see profiling.py).
+# Profiling can only be asked for while it is set.
+profile_dir = os.environ.get('PROFILE_DIR')
+
+# Dash background callback jobs and the session state they share with the
+# web server (only used with the routing service)
+callback_cache_path = os.environ.get('CALLBACK_CACHE_PATH', 'callback_cache')
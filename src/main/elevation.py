@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+import rasterio
+from pyproj import Geod
+from rasterio.windows import Window, from_bounds
+
+import config
+
+WGS84 = Geod(ellps='WGS84')
+
+
+class DemSampler:
+    # Keeps the DEM open for the lifetime of the app and samples whole
+    # coordinate arrays with a single windowed read instead of opening the
+    # raster and calling dem.sample() once per point.
+
+    def __init__(self, dem_path):
+        self.dem_path = dem_path
+        self._dem = rasterio.open(dem_path)
+        self._nodata = self._dem.nodata
+        self._lock = threading.Lock()  # rasterio datasets are not thread safe
+
+    def sample(self, lons, lats):
+        lons = np.asarray(lons, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        if lons.size == 0:
+            return np.full(lons.shape, np.nan)
+
+        # Route vertices are shared between consecutive segments (and often
+        # repeated), so only look up each distinct coordinate once
+        points, inverse = np.unique(np.column_stack([lons.ravel(), lats.ravel()]), axis=0, return_inverse=True)
+        rows, cols = rasterio.transform.rowcol(self._dem.transform, points[:, 0], points[:, 1])
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+
+        inside = (rows >= 0) & (rows < self._dem.height) & (cols >= 0) & (cols < self._dem.width)
+        values = np.full(len(points), np.nan)
+        if inside.any():
+            row_off, col_off = rows[inside].min(), cols[inside].min()
+            window = Window(col_off, row_off, cols[inside].max() - col_off + 1, rows[inside].max() - row_off + 1)
+            with self._lock:
+                block = self._dem.read(1, window=window).astype(float)
+            if self._nodata is not None:
+                block[block == self._nodata] = np.nan
+            values[inside] = block[rows[inside] - row_off, cols[inside] - col_off]
+
+        return values[inverse.reshape(-1)].reshape(lons.shape)
+
+    def close(self):
+        self._dem.close()
+
+
+class ElevationGrid:
+    # Samples a DEM that has been clipped to the service area with clip_dem().
+    # The grid is memory-mapped, so every process serving the app shares the
+    # same page-cached array and no GDAL call happens per request.
+
+    def __init__(self, grid_path):
+        self.grid_path = grid_path
+        self._grid = np.load(grid_path, mmap_mode='r')
+        with open(_metadata_path(grid_path)) as f:
+            metadata = json.load(f)
+        a, b, c, d, e, f = metadata['transform']
+        if b != 0 or d != 0:
+            raise ValueError(f"Rotated elevation grids are not supported: {grid_path}")
+        self._x0, self._dx = c, a
+        self._y0, self._dy = f, e
+        self.crs = metadata['crs']
+
+    @property
+    def shape(self):
+        return self._grid.shape
+
+    def sample(self, lons, lats):
+        lons = np.asarray(lons, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        height, width = self._grid.shape
+
+        # Fractional position relative to the pixel centres
+        x = (lons - self._x0) / self._dx - 0.5
+        y = (lats - self._y0) / self._dy - 0.5
+        inside = (x >= -0.5) & (x <= width - 0.5) & (y >= -0.5) & (y <= height - 0.5)
+
+        col = np.clip(np.floor(x), 0, max(width - 2, 0)).astype(np.intp)
+        row = np.clip(np.floor(y), 0, max(height - 2, 0)).astype(np.intp)
+        fx = np.clip(x - col, 0, 1)
+        fy = np.clip(y - row, 0, 1)
+        col1 = np.minimum(col + 1, width - 1)
+        row1 = np.minimum(row + 1, height - 1)
+
+        top = self._grid[row, col] * (1 - fx) + self._grid[row, col1] * fx
+        bottom = self._grid[row1, col] * (1 - fx) + self._grid[row1, col1] * fx
+        elevations = top * (1 - fy) + bottom * fy
+        return np.where(inside, elevations, np.nan)
+
+    def close(self):
+        self._grid = None
+
+
+def geodesic_distance(lons1, lats1, lons2, lats2):
+    # Distance in meters on the WGS84 ellipsoid, element-wise
+    _, _, distances = WGS84.inv(np.asarray(lons1, dtype=float), np.asarray(lats1, dtype=float),
+                                np.asarray(lons2, dtype=float), np.asarray(lats2, dtype=float))
+    return np.asarray(distances, dtype=float)
+
+
+def segment_lengths(lons, lats):
+    # Geodesic length in meters of each segment of a polyline
+    lons = np.asarray(lons, dtype=float)
+    lats = np.asarray(lats, dtype=float)
+    return geodesic_distance(lons[:-1], lats[:-1], lons[1:], lats[1:])
+
+
+def calculate_route_slopes(line_string, sampler):
+    coords = np.asarray(line_string.coords)[:, :2]
+    # Sample every vertex once; each interior vertex is shared by two segments
+    elevations = sampler.sample(coords[:, 0], coords[:, 1])
+    horizontal_distance = segment_lengths(coords[:, 0], coords[:, 1])
+    moving = horizontal_distance > 0
+    slopes = np.diff(elevations)[moving] / horizontal_distance[moving]
+    return slopes
+
+
+def summarize_slopes(slopes):
+    mean_slope = np.nanmean(slopes)
+    max_slope = np.nanmax(slopes)
+    return mean_slope, max_slope
+
+
+def _metadata_path(grid_path):
+    return os.path.splitext(grid_path)[0] + '.json'
+
+
+def clip_dem(dem_path, grid_path, bounds, padding=0.01):
+    # Cut the service area (plus some padding so interpolation works right up
+    # to the edge) out of a DEM tile and store it as a .npy array next to a
+    # .json file holding its affine transform
+    lon_min, lat_min, lon_max, lat_max = bounds
+    with rasterio.open(dem_path) as dem:
+        window = from_bounds(lon_min - padding, lat_min - padding, lon_max + padding, lat_max + padding, dem.transform)
+        window = window.round_offsets().round_lengths().intersection(Window(0, 0, dem.width, dem.height))
+        grid = dem.read(1, window=window).astype(np.float32)
+        if dem.nodata is not None:
+            grid[grid == dem.nodata] = np.nan
+        transform = dem.window_transform(window)
+        crs = dem.crs.to_string() if dem.crs else None
+
+    np.save(grid_path, grid)
+    with open(_metadata_path(grid_path), 'w') as f:
+        json.dump({'transform': list(transform)[:6], 'crs': crs, 'source': os.path.basename(dem_path)}, f)
+    return grid.shape
+
+
+def open_elevation_sampler(grid_path=config.dem_grid_path, dem_path=config.dem_path):
+    # Prefer the preprocessed grid, fall back to reading the DEM directly
+    if os.path.exists(grid_path) and os.path.exists(_metadata_path(grid_path)):
+        return ElevationGrid(grid_path)
+    if os.path.exists(dem_path):
+        return DemSampler(dem_path)
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Clip a DEM to the service area and store it as a memory-mapped elevation grid.')
+    parser.add_argument('--dem', default=config.dem_path, help='input DEM GeoTIFF')
+    parser.add_argument('--out', default=config.dem_grid_path, help='output .npy grid (a .json transform is written next to it)')
+    parser.add_argument('--bbox', nargs=4, type=float, metavar=('LON_MIN', 'LAT_MIN', 'LON_MAX', 'LAT_MAX'),
+                        default=[config.lon_start, config.lat_start, config.lon_end, config.lat_end])
+    parser.add_argument('--padding', type=float, default=0.01, help='padding around the bbox in degrees')
+    args = parser.parse_args()
+
+    shape = clip_dem(args.dem, args.out, args.bbox, args.padding)
+    print(f"Wrote {shape[0]}x{shape[1]} elevation grid to {args.out}")
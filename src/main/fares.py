@@ -0,0 +1,217 @@
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import config
+
+
+def read_gtfs_table(feed, name):
+    # A GTFS table as strings with empty fields as NaN, or None when the feed
+    # does not have it
+    if name not in feed.namelist():
+        return None
+    with feed.open(name) as f:
+        table = pd.read_csv(f, dtype=str, skipinitialspace=True)
+    table.columns = table.columns.str.strip()
+    return table if len(table) else None
+
+
+def _column(table, name):
+    return table[name] if name in table.columns else pd.Series(np.nan, index=table.index, dtype=object)
+
+
+def _known_ids(ids, known):
+    # r5py may report ids with a "feed:" prefix; use the plain id when only
+    # that one is known
+    ids = ids.astype(object)
+    plain = ids.map(lambda value: value.split(':', 1)[-1] if isinstance(value, str) else value)
+    return ids.where(ids.isin(known) | ~plain.isin(known), plain)
+
+
+def _lookup(mapping, ids):
+    return _known_ids(ids, mapping.index).map(mapping)
+
+
+def _matching_rules(rides, rules, conditions):
+    # Cross the rides with the (small) rule table and keep the pairs where
+    # every non-empty rule field equals one of its ride columns
+    candidates = rides.merge(rules, how='cross')
+    matches = np.ones(len(candidates), dtype=bool)
+    for ride_columns, rule_column in conditions:
+        field = candidates[rule_column]
+        matches &= (field.isna() | np.logical_or.reduce([field == candidates[column] for column in ride_columns])).to_numpy()
+    return candidates[matches]
+
+
+def _cheapest(candidates, price_column):
+    # The cheapest candidate rule of each ride, among the rules with a price
+    # (a rule may name a fare the feed does not define)
+    candidates = candidates.dropna(subset=[price_column])
+    return candidates.loc[candidates.groupby('ride')[price_column].idxmin()].set_index('ride')
+
+
+class FareTable:
+    # Fares of a GTFS feed as lookup tables, parsed once when the network is
+    # loaded. Fares v2 (fare_leg_rules.txt) is used when the feed has it,
+    # otherwise fare_attributes.txt and fare_rules.txt. Rides without a
+    # matching fare cost `default_fare`.
+
+    def __init__(self, default_fare=0.0, fares=None, rules=None, stop_zones=None,
+                 leg_rules=None, transfer_rules=None, route_networks=None, stop_areas=None):
+        self.default_fare = default_fare
+        self.fares = fares
+        self.rules = rules
+        self.stop_zones = stop_zones if stop_zones is not None else pd.Series(dtype=object)
+        self.leg_rules = leg_rules
+        self.transfer_rules = transfer_rules
+        self.route_networks = route_networks if route_networks is not None else pd.Series(dtype=object)
+        self.stop_areas = stop_areas if stop_areas is not None else pd.Series(dtype=object)
+
+    @property
+    def version(self):
+        if self.leg_rules is not None:
+            return 2
+        return 1 if self.fares is not None else None
+
+    def ride_fares(self, rides):
+        # Price of every ride of a DataFrame with option, route_id,
+        # start_stop_id, end_stop_id and departure_time columns, in the order
+        # the rides are taken within each option
+        rides = rides.reset_index(drop=True).assign(ride=lambda df: np.arange(len(df)))
+        if self.version == 2:
+            return self._ride_fares_v2(rides)
+        if self.version == 1:
+            return self._ride_fares_v1(rides)
+        return pd.Series(self.default_fare, index=rides.index, dtype=float)
+
+    def _ride_fares_v1(self, rides):
+        rides['origin_zone'] = _lookup(self.stop_zones, rides['start_stop_id'])
+        rides['destination_zone'] = _lookup(self.stop_zones, rides['end_stop_id'])
+        rides['route'] = _known_ids(rides['route_id'], self.rules['route_id'].dropna())
+        # Zones passed through are not known, so contains_id is matched
+        # against the zones the ride starts and ends in
+        candidates = _matching_rules(rides[['ride', 'route', 'origin_zone', 'destination_zone']], self.rules.join(self.fares, on='fare_id'), [
+            (['route'], 'route_id'),
+            (['origin_zone'], 'origin_id'),
+            (['destination_zone'], 'destination_id'),
+            (['origin_zone', 'destination_zone'], 'contains_id'),
+        ])
+        matched = _cheapest(candidates, 'price')
+        rides = rides.join(matched[['fare_id', 'price', 'transfers', 'transfer_duration']], on='ride')
+        rides['price'] = rides['price'].fillna(self.default_fare)
+
+        # A fare covers up to `transfers` further rides on the same fare
+        # within `transfer_duration` of its first ride
+        same_fare = rides.groupby(['option', 'fare_id'], dropna=False)
+        transfer_number = same_fare.cumcount()
+        elapsed = (rides['departure_time'] - same_fare['departure_time'].transform('first')).dt.total_seconds()
+        free = rides['fare_id'].notna() & (transfer_number >= 1) & (transfer_number <= rides['transfers']) & (elapsed <= rides['transfer_duration'])
+        return rides['price'].where(~free, 0.0)
+
+    def _ride_fares_v2(self, rides):
+        rides['network'] = _lookup(self.route_networks, rides['route_id'])
+        rides['from_area'] = _lookup(self.stop_areas, rides['start_stop_id'])
+        rides['to_area'] = _lookup(self.stop_areas, rides['end_stop_id'])
+        candidates = _matching_rules(rides[['ride', 'network', 'from_area', 'to_area']], self.leg_rules, [
+            (['network'], 'network_id'),
+            (['from_area'], 'from_area_id'),
+            (['to_area'], 'to_area_id'),
+        ])
+        matched = _cheapest(candidates, 'amount')
+        rides = rides.join(matched[['leg_group_id', 'amount']], on='ride')
+        rides['amount'] = rides['amount'].fillna(self.default_fare)
+        if self.transfer_rules is None:
+            return rides['amount']
+
+        # Transfers between consecutive rides of an option. fare_transfer_type
+        # 0 charges the first leg plus the transfer, 1 both legs plus the
+        # transfer and 2 the transfer alone.
+        previous = rides.groupby('option')[['ride', 'leg_group_id', 'departure_time']].shift()
+        rides['previous_group'] = previous['leg_group_id']
+        rides['since_previous'] = (rides['departure_time'] - previous['departure_time']).dt.total_seconds()
+        candidates = _matching_rules(rides.loc[previous['departure_time'].notna(), ['ride', 'previous_group', 'leg_group_id', 'since_previous']], self.transfer_rules, [
+            (['previous_group'], 'from_leg_group_id'),
+            (['leg_group_id'], 'to_leg_group_id'),
+        ])
+        transfers = _cheapest(candidates[candidates['since_previous'] <= candidates['duration_limit']], 'transfer_amount')
+        rides = rides.join(transfers[['fare_transfer_type', 'transfer_amount']], on='ride')
+
+        amount = rides['amount'].copy()
+        transfer_type = rides['fare_transfer_type']
+        amount[transfer_type == 0] = rides['transfer_amount']
+        amount[transfer_type == 1] = rides['amount'] + rides['transfer_amount']
+        # Type 2 deducts what the previous ride was charged, after its own
+        # transfer, so they run in ride order
+        for ride in np.flatnonzero(transfer_type == 2):
+            amount[ride] = rides['transfer_amount'][ride] - amount[int(previous['ride'][ride])]
+        return amount
+
+    def option_fares(self, travel_details):
+        # Total fare of every option of a transit itinerary table. Transit
+        # rides are the segments with a route_id, however many walking or
+        # biking segments surround them.
+        rides = travel_details[travel_details['route_id'].notna()]
+        fares = pd.Series(self.ride_fares(rides).to_numpy(float), index=rides.index)
+        return fares.groupby(rides['option']).sum().reindex(travel_details['option'].unique(), fill_value=0.0)
+
+
+def _number(values, empty):
+    return pd.to_numeric(values, errors='coerce').fillna(empty)
+
+
+def load_fare_table(gtfs_path=config.gtfs_path, default_fare=0.0):
+    with zipfile.ZipFile(gtfs_path) as feed:
+        leg_rules = read_gtfs_table(feed, 'fare_leg_rules.txt')
+        if leg_rules is not None:
+            # Without fare products no rule has a price, and rides cost the default
+            products = read_gtfs_table(feed, 'fare_products.txt')
+            if products is not None:
+                amounts = _number(products['amount'], np.nan).groupby(products['fare_product_id']).min()
+            else:
+                amounts = pd.Series(dtype=float)
+            leg_rules = leg_rules.assign(network_id=_column(leg_rules, 'network_id'), from_area_id=_column(leg_rules, 'from_area_id'),
+                                         to_area_id=_column(leg_rules, 'to_area_id'), leg_group_id=_column(leg_rules, 'leg_group_id'))
+            leg_rules['amount'] = leg_rules['fare_product_id'].map(amounts)
+
+            transfer_rules = read_gtfs_table(feed, 'fare_transfer_rules.txt')
+            if transfer_rules is not None:
+                transfer_rules = transfer_rules.assign(
+                    from_leg_group_id=_column(transfer_rules, 'from_leg_group_id'),
+                    to_leg_group_id=_column(transfer_rules, 'to_leg_group_id'),
+                    duration_limit=_number(_column(transfer_rules, 'duration_limit'), np.inf),
+                    fare_transfer_type=_number(_column(transfer_rules, 'fare_transfer_type'), 0).astype(int),
+                    transfer_amount=_column(transfer_rules, 'fare_product_id').map(amounts).fillna(0.0))
+
+            # A route's network comes from route_networks.txt or routes.txt
+            route_networks = read_gtfs_table(feed, 'route_networks.txt')
+            if route_networks is None:
+                route_networks = read_gtfs_table(feed, 'routes.txt')
+            route_networks = route_networks.dropna(subset=['network_id']).set_index('route_id')['network_id'] if 'network_id' in route_networks.columns else None
+
+            # Stops in several areas keep the first one
+            stop_areas = read_gtfs_table(feed, 'stop_areas.txt')
+            stop_areas = stop_areas.drop_duplicates('stop_id').set_index('stop_id')['area_id'] if stop_areas is not None else None
+            return FareTable(default_fare, leg_rules=leg_rules, transfer_rules=transfer_rules,
+                             route_networks=route_networks, stop_areas=stop_areas)
+
+        fares = read_gtfs_table(feed, 'fare_attributes.txt')
+        if fares is None:
+            return FareTable(default_fare)
+        fares = pd.DataFrame({
+            'price': _number(fares['price'], 0.0).to_numpy(),
+            # An empty transfers field allows unlimited transfers
+            'transfers': _number(_column(fares, 'transfers'), np.inf).to_numpy(),
+            'transfer_duration': _number(_column(fares, 'transfer_duration'), np.inf).to_numpy(),
+        }, index=fares['fare_id'])
+
+        rules = read_gtfs_table(feed, 'fare_rules.txt')
+        if rules is None:
+            # Without rules every fare applies to every ride
+            rules = pd.DataFrame({'fare_id': fares.index})
+        for column in ['route_id', 'origin_id', 'destination_id', 'contains_id']:
+            rules[column] = _column(rules, column)
+
+        stops = read_gtfs_table(feed, 'stops.txt')
+        stop_zones = stops.dropna(subset=['zone_id']).set_index('stop_id')['zone_id'] if stops is not None and 'zone_id' in stops.columns else None
+        return FareTable(default_fare, fares=fares, rules=rules[['fare_id', 'route_id', 'origin_id', 'destination_id', 'contains_id']], stop_zones=stop_zones)
@@ -0,0 +1,50 @@
+import base64
+import hashlib
+
+import numpy as np
+import shapely
+
+from cache import LRUCache
+
+# Simplified copies of route coordinates, per route and tolerance
+simplified_cache = LRUCache(maxsize=1024)
+
+
+def zoom_tolerance(zoom):
+    # Half a screen pixel in degrees at a (whole) web map zoom level; anything
+    # smaller than that cannot be seen
+    return 360 / (256 * 2 ** int(round(zoom))) / 2
+
+
+def simplify_coords(coords, tolerance):
+    # Douglas-Peucker simplification of an (n, 2) lon/lat array. The full
+    # resolution array is left untouched for export and slope analysis.
+    coords = np.asarray(coords, dtype=float)
+    if len(coords) < 3 or tolerance <= 0:
+        return coords
+    key = (hashlib.blake2b(coords.tobytes(), digest_size=16).digest(), tolerance)
+    simplified = simplified_cache.get(key)
+    if simplified is None:
+        simplified = shapely.get_coordinates(shapely.simplify(shapely.linestrings(coords), tolerance, preserve_topology=False))
+        simplified_cache.put(key, simplified)
+    return simplified
+
+
+def join_lines(lines):
+    # Lon and lat arrays of several lines drawn as one trace, with NaN gaps
+    # between them
+    parts = []
+    for coords in lines:
+        if len(coords):
+            parts.extend([coords, np.full((1, 2), np.nan)])
+    if not parts:
+        return np.empty(0), np.empty(0)
+    joined = np.concatenate(parts)
+    return joined[:, 0], joined[:, 1]
+
+
+def encode_array(values, dtype='f4'):
+    # Plotly's typed array format: base64 of the raw little-endian values.
+    # float32 keeps lon/lat to under a meter at a third of the JSON size.
+    values = np.ascontiguousarray(values, dtype=np.dtype(dtype).newbyteorder('<'))
+    return {'dtype': dtype, 'bdata': base64.b64encode(values.tobytes()).decode('ascii')}
@@ -0,0 +1,246 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import config
+from elevation import calculate_route_slopes, geodesic_distance, open_elevation_sampler, summarize_slopes
+
+# OSM highway types that can be walked or cycled on
+WALK_BIKE_HIGHWAYS = {
+    'primary', 'primary_link', 'secondary', 'secondary_link', 'tertiary', 'tertiary_link',
+    'unclassified', 'residential', 'living_street', 'service', 'road', 'track',
+    'pedestrian', 'footway', 'path', 'cycleway', 'bridleway', 'steps', 'crossing',
+}
+
+FIXED_FACTOR = 10_000_000  # R5 and OSM store coordinates as 1e-7 degree integers
+
+
+def _to_fixed(degrees):
+    return np.round(np.asarray(degrees, dtype=float) * FIXED_FACTOR).astype(np.int64)
+
+
+def _coordinate_keys(lon_fixed, lat_fixed):
+    # Pack a fixed-point coordinate into a single int64
+    lon_fixed = np.asarray(lon_fixed, dtype=np.int64)
+    lat_fixed = np.asarray(lat_fixed, dtype=np.int64)
+    return (lon_fixed << 32) | (lat_fixed & 0xFFFFFFFF)
+
+
+def read_walk_bike_segments(osm_path):
+    # One row per pair of consecutive nodes on every walkable/bikeable way
+    import osmium
+
+    class WayHandler(osmium.SimpleHandler):
+        def __init__(self):
+            super().__init__()
+            self.way_ids, self.node_ids, self.lons, self.lats = [], [], [], []
+
+        def way(self, w):
+            if w.tags.get('highway') not in WALK_BIKE_HIGHWAYS or w.tags.get('access') in ('no', 'private'):
+                return
+            nodes = [n for n in w.nodes if n.location.valid()]
+            if len(nodes) < 2:
+                return
+            self.way_ids.append(np.full(len(nodes) - 1, w.id, dtype=np.int64))
+            self.node_ids.append(np.array([n.ref for n in nodes], dtype=np.int64))
+            self.lons.append(np.array([n.lon for n in nodes]))
+            self.lats.append(np.array([n.lat for n in nodes]))
+
+    handler = WayHandler()
+    handler.apply_file(osm_path, locations=True)
+
+    segments = pd.DataFrame({
+        'way_id': np.concatenate(handler.way_ids),
+        'u': np.concatenate([ids[:-1] for ids in handler.node_ids]),
+        'v': np.concatenate([ids[1:] for ids in handler.node_ids]),
+        'u_lon': np.concatenate([lons[:-1] for lons in handler.lons]),
+        'u_lat': np.concatenate([lats[:-1] for lats in handler.lats]),
+        'v_lon': np.concatenate([lons[1:] for lons in handler.lons]),
+        'v_lat': np.concatenate([lats[1:] for lats in handler.lats]),
+    })
+    return segments.drop_duplicates(['u', 'v']).reset_index(drop=True)
+
+
+def compute_segment_grades(segments, sampler, spacing=10.0):
+    # Sample the DEM every `spacing` meters along each segment and reduce the
+    # samples to a net (mean) grade, steepest up/down grades and total climb
+    # and descent. Everything is done on flat arrays, one entry per sample.
+    lengths = np.asarray(segments['length_m'], dtype=float)
+    steps = np.maximum(1, np.ceil(lengths / spacing)).astype(np.int64)
+    starts = np.concatenate([[0], np.cumsum(steps + 1)[:-1]])
+
+    owner = np.repeat(np.arange(len(segments)), steps + 1)
+    t = (np.arange(owner.size) - starts[owner]) / steps[owner]
+    u_lon, u_lat = segments['u_lon'].to_numpy(), segments['u_lat'].to_numpy()
+    v_lon, v_lat = segments['v_lon'].to_numpy(), segments['v_lat'].to_numpy()
+    lons = u_lon[owner] + t * (v_lon[owner] - u_lon[owner])
+    lats = u_lat[owner] + t * (v_lat[owner] - u_lat[owner])
+    elevations = sampler.sample(lons, lats)
+
+    # Differences between consecutive samples of the same segment
+    rises = np.diff(elevations)
+    same_segment = owner[1:] == owner[:-1]
+    rises = rises[same_segment]
+    rise_owner = owner[1:][same_segment]
+    step_length = np.where(lengths > 0, lengths / steps, np.nan)
+    step_grades = rises / step_length[rise_owner]
+
+    step_starts = starts - np.arange(len(segments))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        max_grade = np.maximum.reduceat(step_grades, step_starts)
+        min_grade = np.minimum.reduceat(step_grades, step_starts)
+        climb = np.add.reduceat(np.where(rises > 0, rises, 0), step_starts)
+        descent = np.add.reduceat(np.where(rises < 0, -rises, 0), step_starts)
+        mean_grade = (elevations[starts + steps] - elevations[starts]) / np.where(lengths > 0, lengths, np.nan)
+
+    grades = pd.DataFrame({
+        'mean_grade': mean_grade,
+        'max_grade': max_grade,
+        'min_grade': min_grade,
+        'climb_m': climb,
+        'descent_m': descent,
+    }).fillna({'climb_m': 0, 'descent_m': 0})
+    # Zero-length segments are flat by definition
+    grades.loc[lengths == 0, ['mean_grade', 'max_grade', 'min_grade']] = 0.0
+    return grades
+
+
+def build_grade_index(osm_path, index_path, sampler, spacing=10.0):
+    segments = read_walk_bike_segments(osm_path)
+    segments['length_m'] = geodesic_distance(segments['u_lon'], segments['u_lat'], segments['v_lon'], segments['v_lat'])
+    grades = compute_segment_grades(segments, sampler, spacing)
+
+    index = pd.DataFrame({
+        'u': segments['u'],
+        'v': segments['v'],
+        'way_id': segments['way_id'],
+        'u_lon': _to_fixed(segments['u_lon']).astype(np.int32),
+        'u_lat': _to_fixed(segments['u_lat']).astype(np.int32),
+        'v_lon': _to_fixed(segments['v_lon']).astype(np.int32),
+        'v_lat': _to_fixed(segments['v_lat']).astype(np.int32),
+        'length_m': segments['length_m'].astype(np.float32),
+    })
+    index = pd.concat([index, grades.astype(np.float32)], axis=1)
+    index.to_parquet(index_path, index=False, compression='zstd')
+    return index
+
+
+class GradeIndex:
+    # Looks up the precomputed grades of the OSM segments a route runs along.
+    # Route geometries returned by R5 reuse the OSM node coordinates, so each
+    # pair of consecutive route vertices identifies one segment (u, v) or its
+    # reverse; vertices created by snapping origin/destination onto an edge
+    # do not match and are sampled from the DEM instead.
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        edges = pd.read_parquet(index_path)
+
+        u_keys = _coordinate_keys(edges['u_lon'], edges['u_lat'])
+        v_keys = _coordinate_keys(edges['v_lon'], edges['v_lat'])
+        self._nodes = pd.Index(np.unique(np.concatenate([u_keys, v_keys])))
+        node_count = len(self._nodes)
+        u_pos = self._nodes.get_indexer(u_keys)
+        v_pos = self._nodes.get_indexer(v_keys)
+
+        # Every segment can be travelled in both directions
+        keys = np.concatenate([u_pos * node_count + v_pos, v_pos * node_count + u_pos])
+        rows = np.tile(np.arange(len(edges)), 2)
+        forward = np.repeat([True, False], len(edges))
+        first = ~pd.Index(keys).duplicated()
+        self._segments = pd.Index(keys[first])
+        self._rows = rows[first]
+        self._forward = forward[first]
+
+        self._length = edges['length_m'].to_numpy(dtype=float)
+        self._mean_grade = edges['mean_grade'].to_numpy(dtype=float)
+        self._max_grade = edges['max_grade'].to_numpy(dtype=float)
+        self._min_grade = edges['min_grade'].to_numpy(dtype=float)
+        self._climb = edges['climb_m'].to_numpy(dtype=float)
+        self._descent = edges['descent_m'].to_numpy(dtype=float)
+
+    def __len__(self):
+        return len(self._length)
+
+    def segment_grades(self, line_string, sampler=None):
+        # Grades of every segment of `line_string` in the direction of travel
+        coords = np.asarray(line_string.coords)[:, :2]
+        node_pos = self._nodes.get_indexer(_coordinate_keys(_to_fixed(coords[:, 0]), _to_fixed(coords[:, 1])))
+        start, end = node_pos[:-1], node_pos[1:]
+        keys = np.where((start >= 0) & (end >= 0), start * len(self._nodes) + end, -1)
+        found = self._segments.get_indexer(keys)
+        found[keys < 0] = -1
+        matched = found >= 0
+
+        rows = self._rows[found[matched]]
+        forward = self._forward[found[matched]]
+        count = len(coords) - 1
+        grades = pd.DataFrame({
+            'length_m': np.full(count, np.nan),
+            'mean_grade': np.full(count, np.nan),
+            'max_grade': np.full(count, np.nan),
+            'climb_m': np.full(count, np.nan),
+            'descent_m': np.full(count, np.nan),
+            'indexed': matched,
+        })
+        grades.loc[matched, 'length_m'] = self._length[rows]
+        grades.loc[matched, 'mean_grade'] = np.where(forward, self._mean_grade[rows], -self._mean_grade[rows])
+        grades.loc[matched, 'max_grade'] = np.where(forward, self._max_grade[rows], -self._min_grade[rows])
+        grades.loc[matched, 'climb_m'] = np.where(forward, self._climb[rows], self._descent[rows])
+        grades.loc[matched, 'descent_m'] = np.where(forward, self._descent[rows], self._climb[rows])
+
+        missing = ~matched
+        if missing.any() and sampler is not None:
+            lons, lats = coords[:, 0], coords[:, 1]
+            elevations = sampler.sample(lons, lats)
+            lengths = geodesic_distance(lons[:-1][missing], lats[:-1][missing], lons[1:][missing], lats[1:][missing])
+            rises = (elevations[1:] - elevations[:-1])[missing]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                segment_grade = np.where(lengths > 0, rises / lengths, 0.0)
+            grades.loc[missing, 'length_m'] = lengths
+            grades.loc[missing, 'mean_grade'] = segment_grade
+            grades.loc[missing, 'max_grade'] = segment_grade
+            grades.loc[missing, 'climb_m'] = np.clip(rises, 0, None)
+            grades.loc[missing, 'descent_m'] = np.clip(-rises, 0, None)
+        return grades
+
+    def summarize(self, line_string, sampler=None):
+        # Length-weighted mean grade and steepest uphill grade of a route
+        grades = self.segment_grades(line_string, sampler).dropna(subset=['mean_grade'])
+        if grades.empty or grades['length_m'].sum() <= 0:
+            raise ValueError("No grade data available for this route")
+        mean_slope = np.average(grades['mean_grade'], weights=grades['length_m'])
+        max_slope = grades['max_grade'].max()
+        return mean_slope, max_slope
+
+
+def open_grade_index(index_path=config.grade_index_path):
+    if os.path.exists(index_path):
+        return GradeIndex(index_path)
+    return None
+
+
+def summarize_slopes_along(line_string, grade_index=None, sampler=None):
+    # Mean and max slope of a route: use the precomputed edge grades when
+    # available, otherwise sample the DEM
+    if grade_index is not None:
+        return grade_index.summarize(line_string, sampler)
+    if sampler is None:
+        raise FileNotFoundError(f"DEM file not found: {config.dem_path}")
+    return summarize_slopes(calculate_route_slopes(line_string, sampler))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the grade of every walkable/bikeable OSM segment.')
+    parser.add_argument('--osm', default=config.osm_path, help='OSM extract (.osm.pbf)')
+    parser.add_argument('--out', default=config.grade_index_path, help='output Parquet file')
+    parser.add_argument('--spacing', type=float, default=10.0, help='DEM sampling interval along each segment, in meters')
+    args = parser.parse_args()
+
+    sampler = open_elevation_sampler()
+    if sampler is None:
+        parser.error(f"No elevation data found ({config.dem_grid_path} or {config.dem_path})")
+    index = build_grade_index(args.osm, args.out, sampler, args.spacing)
+    print(f"Wrote grades of {len(index)} segments to {args.out}")
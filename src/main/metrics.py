@@ -0,0 +1,249 @@
+import bisect
+import contextvars
+import json
+import logging
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Histogram buckets in seconds, from a cache hit to a slow transit search
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 3e5, 1e6, 3e6, 1e7)
+
+logger = logging.getLogger('trip_planner')
+
+# Metrics of this process, rendered by render(). Every web server or worker
+# process keeps its own, like Prometheus client libraries do by default.
+_registry = []
+
+# Stages, legs and cache lookups of the request being handled, see trace()
+_trace = contextvars.ContextVar('trip_planner_trace', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(list(zip(self.labels, key)))} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, tuple(labels), tuple(buckets)
+        # Per label set: the count of each bucket (not cumulative, the last
+        # one is +Inf), the sum and the count
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                pairs = list(zip(self.labels, key))
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{_labels(pairs + [("le", bound)])} {cumulative}')
+                lines.append(f'{self.name}_sum{_labels(pairs)} {total}')
+                lines.append(f'{self.name}_count{_labels(pairs)} {cumulative}')
+        return lines
+
+
+def counter(name, help, labels=()):
+    metric = Counter(name, help, labels)
+    _registry.append(metric)
+    return metric
+
+
+def histogram(name, help, labels=(), buckets=SECONDS_BUCKETS):
+    metric = Histogram(name, help, labels, buckets)
+    _registry.append(metric)
+    return metric
+
+
+def render():
+    # Prometheus text exposition format
+    return '\n'.join(line for metric in _registry for line in metric.render()) + '\n'
+
+
+request_seconds = histogram('trip_planner_request_seconds', 'Time to answer a request, including serialization', ['callback', 'status'])
+response_bytes = histogram('trip_planner_response_bytes', 'Size of the response body', ['callback'], BYTES_BUCKETS)
+stage_seconds = histogram('trip_planner_stage_seconds', 'Time spent in each stage of routing and summarizing trips', ['stage', 'mode'])
+legs_total = counter('trip_planner_legs_total', 'Trip legs requested', ['mode'])
+cache_lookups_total = counter('trip_planner_cache_lookups_total', 'Cache lookups', ['cache', 'result'])
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line; fields passed with `extra={'fields': {...}}`
+    # are merged in
+
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                 'level': record.levelname.lower(), 'event': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['error'] = f"{record.exc_info[0].__name__}: {record.exc_info[1]}"
+            entry['traceback'] = ''.join(traceback.format_exception(*record.exc_info))
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level=logging.INFO):
+    # JSON lines on stderr, unless the host application configured the logger
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(JsonFormatter())
+        logger.addHandler(handler)
+        logger.setLevel(level)
+        logger.propagate = False
+
+
+def log_event(event, level=logging.INFO, **fields):
+    logger.log(level, event, extra={'fields': fields})
+
+
+def log_exception(event, **fields):
+    # Log the exception being handled and mark the current request as failed
+    current = _trace.get()
+    if current is not None:
+        current['status'] = 'error'
+        current['error'] = str(sys.exc_info()[1])
+        fields.setdefault('request_id', current['request_id'])
+    logger.exception(event, extra={'fields': fields})
+
+
+def begin(callback):
+    # Start collecting a request's stages; end() with the returned token
+    current = {'request_id': f'{time.time_ns():x}', 'callback': callback, 'started': time.perf_counter(),
+               'status': 'ok', 'stages': [], 'legs': 0, 'modes': [], 'cache': {}}
+    return current, _trace.set(current)
+
+
+def end(current, token, status=None, **fields):
+    _trace.reset(token)
+    seconds = time.perf_counter() - current['started']
+    status = status or current['status']
+    request_seconds.observe(seconds, callback=current['callback'], status=status)
+    if 'response_bytes' in fields:
+        response_bytes.observe(fields['response_bytes'], callback=current['callback'])
+    stage_totals = {}
+    for entry in current['stages']:
+        stage_totals[entry['stage']] = stage_totals.get(entry['stage'], 0) + entry['ms']
+    if 'callback' in stage_totals and 'http_status' in fields:
+        # The rest of a web request is Dash's dispatching and JSON serialization
+        fields['dispatch_ms'] = round(seconds * 1000 - stage_totals['callback'], 1)
+    log_event('request', request_id=current['request_id'], callback=current['callback'], status=status,
+              duration_ms=round(seconds * 1000, 1), legs=current['legs'], modes=current['modes'], cache=current['cache'],
+              stage_totals_ms={name: round(ms, 1) for name, ms in stage_totals.items()}, stages=current['stages'],
+              **({'error': current['error']} if 'error' in current else {}), **fields)
+
+
+@contextmanager
+def trace(callback):
+    # Time a callback as its request's 'callback' stage. Outside of the web
+    # server's request hooks (e.g. in a background callback process) it
+    # traces a request of its own.
+    current = _trace.get()
+    token = None
+    if current is None:
+        current, token = begin(callback)
+    current['callback'] = current['callback'] or callback
+    try:
+        with stage('callback'):
+            yield current
+    except BaseException:
+        current['status'] = 'error'
+        raise
+    finally:
+        if token is not None:
+            end(current, token)
+
+
+@contextmanager
+def stage(name, mode=None, leg=None):
+    # Time a stage of the current request, e.g. stage('r5', 'CAR')
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        stage_seconds.observe(seconds, stage=name, mode=mode or '')
+        current = _trace.get()
+        if current is not None:
+            entry = {'stage': name, 'ms': round(seconds * 1000, 2)}
+            if mode:
+                entry['mode'] = mode
+            if leg is not None:
+                entry['leg'] = leg
+            current['stages'].append(entry)
+
+
+def set_status(status):
+    # e.g. 'cancelled' for a request that was superseded
+    current = _trace.get()
+    if current is not None:
+        current['status'] = status
+
+
+def record_legs(modes):
+    for mode in modes:
+        legs_total.inc(mode=mode)
+    current = _trace.get()
+    if current is not None:
+        current['legs'] += len(modes)
+        current['modes'] = sorted(set(current['modes']) | set(modes))
+
+
+def record_cache(cache, hit):
+    result = 'hit' if hit else 'miss'
+    cache_lookups_total.inc(cache=cache, result=result)
+    current = _trace.get()
+    if current is not None:
+        counts = current['cache'].setdefault(cache, {'hit': 0, 'miss': 0})
+        counts[result] += 1
+
+
+def in_current_trace(function):
+    # Wrap `function` for a worker thread, so the stages it times are added
+    # to the request that submitted it, and profiled with it if it is being
+    # profiled (see profiling.profiled())
+    current = _trace.get()
+
+    def run(*args, **kwargs):
+        token = _trace.set(current)
+        try:
+            if current is not None and 'profile' in current:
+                return current['profile'].run(function, *args, **kwargs)
+            return function(*args, **kwargs)
+        finally:
+            _trace.reset(token)
+    return run
@@ -0,0 +1,300 @@
+import numpy as np
+import pandas as pd
+
+import config
+import metrics
+from cache import LRUCache
+from grades import summarize_slopes_along
+from routing import TRANSIT_MODES, NoTransitAccess, compute_legs, get_fare_table, transit_access_error
+
+# Column of the grouped option table each optimization criterion minimizes
+OPTIMIZATION_COLUMNS = {
+    'total_time': 'total_time',
+    'transfers': 'num_transfers',
+    'wait_time': 'wait_time',
+    'walking_biking_distance': 'walking_biking_distance',
+    'cost': 'fare',
+}
+
+# Every mode a trip can be compared across
+COMPARE_MODES = ['TRANSIT_WALK', 'TRANSIT_BIKE', 'CAR', 'BICYCLE', 'SHARED_RIDE', 'WALK']
+
+MILES_PER_METER = 0.000621371
+
+# Cost-related functions
+TRANSIT_FARE_PER_RIDE = config.transit_fare_per_ride  # when the feed's fares are not loaded
+
+
+def calculate_fare(base_fare, cost_per_mile, cost_per_minute, service_fee, distance, duration, additional_fees=0):
+    fare = base_fare + (cost_per_mile * distance) + (cost_per_minute * duration) + service_fee + additional_fees
+    return fare
+
+
+def shared_ride_fare(distance_miles, duration_minutes):
+    return calculate_fare(base_fare=2.36, cost_per_mile=0.76, cost_per_minute=0.25, service_fee=3.58, distance=distance_miles, duration=duration_minutes)
+
+
+# Shared ride model: the car route plus a pickup wait ~ N(8, 3) minutes,
+# bounded to 1-15, and a detour ~ Exp(2) minutes, bounded to 1-8
+SHARED_RIDE_SAMPLES = 5000
+SHARED_RIDE_SEED = 20240601
+SHARED_RIDE_PERCENTILES = (10, 50, 90)
+
+# Simulated travel time statistics per base car travel time (in seconds)
+shared_ride_cache = LRUCache(maxsize=1024)
+
+
+def simulate_shared_ride(base_travel_time_seconds, samples=SHARED_RIDE_SAMPLES):
+    # Expected wait, detour and total travel time (minutes) of a shared ride,
+    # and percentiles of the total, from samples drawn in one go. The
+    # generator is seeded with the base car time, so a trip always gets the
+    # same answer.
+    base_seconds = int(round(base_travel_time_seconds))
+    key = (base_seconds, samples)
+    simulated = shared_ride_cache.get(key)
+    metrics.record_cache('shared_ride', simulated is not None)
+    if simulated is None:
+        rng = np.random.default_rng([SHARED_RIDE_SEED, base_seconds])
+        wait_time = np.clip(rng.normal(loc=8, scale=3, size=samples), 1, 15)
+        additional_travel_time = np.clip(rng.exponential(scale=2, size=samples), 1, 8)
+        travel_time = base_seconds / 60 + wait_time + additional_travel_time
+        simulated = {
+            'wait_time': wait_time.mean(),
+            'additional_travel_time': additional_travel_time.mean(),
+            'travel_time': travel_time.mean(),
+            'travel_time_percentiles': dict(zip(SHARED_RIDE_PERCENTILES, np.percentile(travel_time, SHARED_RIDE_PERCENTILES))),
+        }
+        shared_ride_cache.put(key, simulated)
+    return simulated
+
+
+def summarize_options(travel_details):
+    # Totals of every option in a single grouped sum over the segments. The
+    # first and last segments of an option are the walking/biking ones and
+    # the segments with a route are the transit rides.
+    option = travel_details['option']
+    first_or_last = ~option.duplicated() | ~option.duplicated(keep='last')
+    ride = travel_details['route_id'].notna()
+    travel_time = travel_details['travel_time']
+    no_time = pd.Timedelta(0)
+    options = pd.DataFrame({
+        'option': option,
+        'total_time': travel_time + travel_details['wait_time'],
+        'wait_time': travel_details['wait_time'],
+        'num_transfers': 1,
+        'distance': travel_details['distance'],
+        'walking_biking_time': travel_time.where(first_or_last, no_time),
+        'walking_biking_distance': travel_details['distance'].where(first_or_last, 0.0),
+        'in_vehicle_time': travel_time.where(ride, no_time),
+        'rides': ride.astype(int),
+    }).groupby('option').sum().reset_index()
+    # Segments beyond the walk-transit-walk of a direct ride
+    options['num_transfers'] -= 3
+    return options
+
+
+def group_travel_options(travel_details, fare_table=None):
+    grouped_travel_details = summarize_options(travel_details)
+
+    # Fare of every option at once, from the feed's fares when available
+    if fare_table is not None:
+        fares = fare_table.option_fares(travel_details)
+        grouped_travel_details['fare'] = grouped_travel_details['option'].map(fares).fillna(0.0).astype(float)
+    else:
+        grouped_travel_details['fare'] = grouped_travel_details['rides'] * TRANSIT_FARE_PER_RIDE
+    return grouped_travel_details
+
+
+def select_option(grouped_travel_details, optimization_criteria):
+    # Select the best option based on the selected optimization criteria
+    column = OPTIMIZATION_COLUMNS.get(optimization_criteria, 'total_time')
+    return grouped_travel_details.loc[grouped_travel_details[column].idxmin()]
+
+
+def _criteria_values(grouped_travel_details):
+    columns = []
+    for column in OPTIMIZATION_COLUMNS.values():
+        values = grouped_travel_details[column]
+        if pd.api.types.is_timedelta64_dtype(values):
+            values = values.dt.total_seconds()
+        columns.append(values.to_numpy(dtype=float))
+    return np.column_stack(columns)
+
+
+def pareto_options(grouped_travel_details):
+    # Options no other option beats on every optimization criterion at once
+    values = _criteria_values(grouped_travel_details)
+    no_worse = (values[:, None, :] <= values[None, :, :]).all(axis=2)
+    better = (values[:, None, :] < values[None, :, :]).any(axis=2)
+    dominated = (no_worse & better).any(axis=0)
+    return grouped_travel_details[~dominated].sort_values('total_time')
+
+
+def prepare_leg(mode, travel_details, fare_table=None):
+    # Keep everything needed to render a routed leg again without re-routing
+    # (e.g. when only the optimization criteria change)
+    leg = {'mode': mode}
+
+    if mode in TRANSIT_MODES:
+        # Only the options that ride transit; R5 also returns the trip made
+        # by walking or biking all the way
+        rides = travel_details['route_id'].notna().groupby(travel_details['option']).transform('any')
+        travel_details = travel_details[rides]
+        if travel_details.empty:
+            leg['error'] = "No transit itinerary found between the origin and the destination"
+            return leg
+        with metrics.stage('aggregate', mode):
+            leg['grouped_travel_details'] = group_travel_options(travel_details, fare_table)
+    leg['travel_details'] = travel_details
+    return leg
+
+
+def route_legs(transport_network, network_version, legs, request=None):
+    # Route all (origin, destination, departure, mode) legs of a trip in one
+    # batch; shared rides are routed (and cached) as car legs. Transit legs
+    # with no stop in reach of an end are not routed and come back with an
+    # 'error' instead. `request` is passed on to compute_legs.
+    errors = [transit_access_error(origin, destination, mode) for origin, destination, _, mode in legs]
+    routable = [leg for leg, error in zip(legs, errors) if error is None]
+    routed = iter(compute_legs(transport_network, routable, network_version, request) if routable else [])
+    fare_table = get_fare_table()
+    prepared = []
+    for (_, _, _, mode), error in zip(legs, errors):
+        if error is None:
+            prepared.append(prepare_leg(mode, next(routed), fare_table))
+        else:
+            prepared.append({'mode': mode, 'error': error})
+    return prepared
+
+
+def route_compare_legs(transport_network, network_version, legs):
+    # Route every (origin, destination, departure) leg of a trip in every
+    # mode with a single batch. Shared rides share the cache key of the car
+    # legs, so compute_legs routes the car itineraries once for both.
+    requests = [(origin, destination, departure, mode) for mode in COMPARE_MODES for origin, destination, departure in legs]
+    routed = route_legs(transport_network, network_version, requests)
+    return {mode: routed[i * len(legs):(i + 1) * len(legs)] for i, mode in enumerate(COMPARE_MODES)}
+
+
+def _line_coords(geometry):
+    # (n, 2) lon/lat array at full resolution
+    return np.asarray(geometry.coords, dtype=float).reshape(-1, geometry.has_z + 2)[:, :2]
+
+
+def summarize_leg(leg, optimization_criteria):
+    # Plain totals of a routed leg for the selected option, plus the
+    # coordinate arrays to draw ('kind' is 'route', 'transit' or 'access') and
+    # the walking/biking geometries whose slope is worth checking
+    if 'error' in leg:
+        raise NoTransitAccess(leg['error'])
+    mode = leg['mode']
+    travel_details = leg['travel_details']
+    summary = {'mode': mode, 'routes': [], 'slope_segments': []}
+
+    if mode == 'SHARED_RIDE':
+        min_car_travel_time = travel_details['travel_time'].min()
+        simulated = simulate_shared_ride(min_car_travel_time.total_seconds())
+        distance_miles = travel_details['distance'].sum() * MILES_PER_METER
+        # The fare is linear in the duration, so the expected fare and its
+        # percentiles follow from those of the travel time
+        summary.update(
+            travel_time_seconds=simulated['travel_time'] * 60,
+            distance_miles=distance_miles,
+            cost=shared_ride_fare(distance_miles, simulated['travel_time']),
+            base_travel_time=min_car_travel_time,
+            wait_time=simulated['wait_time'],
+            additional_travel_time=simulated['additional_travel_time'],
+            travel_time_percentiles={p: minutes * 60 for p, minutes in simulated['travel_time_percentiles'].items()},
+            cost_percentiles={p: shared_ride_fare(distance_miles, minutes) for p, minutes in simulated['travel_time_percentiles'].items()},
+        )
+        route_geometry = travel_details.loc[travel_details['travel_time'] == min_car_travel_time, 'geometry']
+        if not route_geometry.empty:
+            summary['routes'].append({'kind': 'route', 'coords': _line_coords(route_geometry.values[0])})
+        return summary
+
+    if mode in TRANSIT_MODES:
+        selected_option = select_option(leg['grouped_travel_details'], optimization_criteria)
+        # The totals come from the option table; only the geometries are
+        # read from the segments
+        geometries = travel_details.loc[travel_details['option'] == selected_option['option'], 'geometry'].to_numpy()
+        walking_biking_time = selected_option['walking_biking_time']
+
+        summary.update(
+            travel_time_seconds=(selected_option['total_time'] + selected_option['wait_time']).total_seconds(),
+            distance_miles=selected_option['distance'] * MILES_PER_METER,
+            cost=float(selected_option['fare']),
+            option=selected_option['option'],
+            walking_biking_distance_miles=selected_option['walking_biking_distance'] * MILES_PER_METER,
+            walking_biking_time=walking_biking_time,
+            out_of_vehicle_time=walking_biking_time + selected_option['wait_time'],
+            in_vehicle_time=selected_option['in_vehicle_time'],
+        )
+        summary['routes'] = [
+            {'kind': 'access', 'coords': _line_coords(geometries[0])},
+            {'kind': 'transit', 'coords': np.concatenate([_line_coords(segment) for segment in geometries[1:-1]] or [np.empty((0, 2))])},
+            {'kind': 'access', 'coords': _line_coords(geometries[-1])},
+        ]
+        summary['slope_segments'] = [('First', geometries[0]), ('Last', geometries[-1])]
+        return summary
+
+    min_travel_time = travel_details['travel_time'].min()
+    summary.update(
+        travel_time_seconds=min_travel_time.total_seconds(),
+        distance_miles=travel_details['distance'].sum() * MILES_PER_METER,
+        cost=0.0,
+    )
+    route_geometry = travel_details.loc[travel_details['travel_time'] == min_travel_time, 'geometry']
+    if not route_geometry.empty:
+        summary['routes'].append({'kind': 'route', 'coords': _line_coords(route_geometry.values[0])})
+        if mode in ['WALK', 'BICYCLE']:
+            summary['slope_segments'] = [(None, route_geometry.values[0])]
+    return summary
+
+
+def summarize_trip(leg_summaries):
+    # Totals of a whole (multi-stop) trip
+    return {
+        'travel_time_seconds': sum(summary['travel_time_seconds'] for summary in leg_summaries),
+        'distance_miles': sum(summary['distance_miles'] for summary in leg_summaries),
+        'cost': sum(summary['cost'] for summary in leg_summaries),
+    }
+
+
+def leg_slopes(summary, grade_index=None, sampler=None):
+    # (label, mean slope, max slope) of the walking/biking parts of a leg.
+    # Walk and bike legs are always checked; the access/egress parts of
+    # transit legs only when the grade index makes the lookup cheap.
+    if summary['mode'] not in ['WALK', 'BICYCLE'] and grade_index is None:
+        return []
+    slopes = []
+    for label, geometry in summary['slope_segments']:
+        try:
+            mean_slope, max_slope = summarize_slopes_along(geometry, grade_index, sampler)
+        except (ValueError, FileNotFoundError):
+            continue
+        slopes.append((label, mean_slope, max_slope))
+    return slopes
+
+
+def summarize_planned_trip(legs, optimization_criteria='total_time', grade_index=None, sampler=None):
+    # Trip totals plus per-leg summaries (with slopes) of routed legs
+    leg_summaries = [summarize_leg(leg, optimization_criteria) for leg in legs]
+    for summary in leg_summaries:
+        summary['slopes'] = leg_slopes(summary, grade_index, sampler)
+    trip = summarize_trip(leg_summaries)
+    max_slopes = [max_slope for summary in leg_summaries for _, _, max_slope in summary['slopes']]
+    trip['max_slope'] = max(max_slopes) if max_slopes else np.nan
+    trip['legs'] = leg_summaries
+    return trip
+
+
+def plan_trip(transport_network, network_version, stops, departure, modes, optimization_criteria='total_time', grade_index=None, sampler=None):
+    # Plan a trip through `stops` ((lat, lon) tuples) without the UI. `modes`
+    # is one mode for the whole trip or one mode per leg.
+    if isinstance(modes, str):
+        modes = [modes] * (len(stops) - 1)
+    if len(modes) != len(stops) - 1:
+        raise ValueError(f"Expected {len(stops) - 1} modes, got {len(modes)}")
+    legs = route_legs(transport_network, network_version,
+                      [(stops[i], stops[i + 1], departure, modes[i]) for i in range(len(stops) - 1)])
+    return summarize_planned_trip(legs, optimization_criteria, grade_index, sampler)
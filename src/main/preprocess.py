@@ -0,0 +1,192 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import zipfile
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+import config
+from cache import file_digest
+from fares import read_gtfs_table
+
+GTFS_DATE_FORMAT = '%Y%m%d'
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+# GTFS tables that are filtered; every other file of the feed is copied as is
+SLICED_TABLES = ['calendar.txt', 'calendar_dates.txt', 'stops.txt', 'trips.txt', 'stop_times.txt', 'routes.txt',
+                 'shapes.txt', 'frequencies.txt', 'transfers.txt', 'fare_rules.txt', 'stop_areas.txt', 'route_networks.txt']
+
+
+def padded_bounds(bounds, padding):
+    lon_min, lat_min, lon_max, lat_max = bounds
+    return [lon_min - padding, lat_min - padding, lon_max + padding, lat_max + padding]
+
+
+def sliced_path(out_dir, path, suffix, **parameters):
+    # Sliced copies are named after the content of their input and the
+    # slicing parameters, so they are reused until either changes
+    digest = hashlib.sha256(file_digest(path).encode())
+    digest.update(json.dumps(parameters, sort_keys=True, default=str).encode())
+    name = os.path.basename(path).split('.')[0]
+    return os.path.join(out_dir, f'{name}-{digest.hexdigest()[:16]}{suffix}')
+
+
+def active_services(calendar, calendar_dates, start_date, end_date):
+    # Service ids running on at least one day between the two dates
+    days = pd.date_range(start_date, end_date)
+    running = pd.DataFrame({'service_id': pd.Series(dtype=object), 'date': pd.Series(dtype='datetime64[ns]')})
+    if calendar is not None:
+        starts = pd.to_datetime(calendar['start_date'], format=GTFS_DATE_FORMAT).to_numpy()
+        ends = pd.to_datetime(calendar['end_date'], format=GTFS_DATE_FORMAT).to_numpy()
+        weekly = calendar[WEEKDAYS].astype(int).to_numpy() == 1
+        # Services by days of the window
+        runs = weekly[:, days.weekday] & (days.to_numpy() >= starts[:, None]) & (days.to_numpy() <= ends[:, None])
+        services, day_index = np.nonzero(runs)
+        running = pd.DataFrame({'service_id': calendar['service_id'].to_numpy()[services], 'date': days[day_index]})
+
+    if calendar_dates is not None:
+        exceptions = calendar_dates.assign(date=pd.to_datetime(calendar_dates['date'], format=GTFS_DATE_FORMAT))
+        exceptions = exceptions[exceptions['date'].between(days[0], days[-1])]
+        removed = pd.MultiIndex.from_frame(exceptions.loc[exceptions['exception_type'] == '2', ['service_id', 'date']])
+        running = running[~pd.MultiIndex.from_frame(running[['service_id', 'date']]).isin(removed)]
+        running = pd.concat([running, exceptions.loc[exceptions['exception_type'] == '1', ['service_id', 'date']]])
+    return set(running['service_id'])
+
+
+def _trip_spans(stop_times, inside):
+    # Cut each trip down to its stops from the last timed stop before it
+    # first reaches the area to the first timed stop after it last leaves;
+    # a trip has to start and end with a time
+    stop_times = stop_times.assign(sequence=pd.to_numeric(stop_times['stop_sequence'])).sort_values(['trip_id', 'sequence'])
+    trips = stop_times['trip_id']
+    position = stop_times.groupby('trip_id').cumcount()
+    timed = stop_times['arrival_time'].notna() & stop_times['departure_time'].notna()
+    in_area = position.where(stop_times['stop_id'].isin(inside))
+    first_in = in_area.groupby(trips).transform('min')
+    last_in = in_area.groupby(trips).transform('max')
+    start = position.where(timed & (position <= first_in)).groupby(trips).transform('max')
+    end = position.where(timed & (position >= last_in)).groupby(trips).transform('min')
+    return stop_times[(position >= start) & (position <= end)].drop(columns='sequence')
+
+
+def slice_gtfs(gtfs_path, out_path, start_date, end_date, bounds):
+    # Copy of a GTFS feed with only the trips running between the two dates
+    # and serving stops inside the bounds, cut down to that part of the trip
+    lon_min, lat_min, lon_max, lat_max = bounds
+    with zipfile.ZipFile(gtfs_path) as feed:
+        tables = {name: read_gtfs_table(feed, name) for name in SLICED_TABLES}
+        services = active_services(tables['calendar.txt'], tables['calendar_dates.txt'], start_date, end_date)
+
+        stops = tables['stops.txt']
+        lons = pd.to_numeric(stops['stop_lon'], errors='coerce')
+        lats = pd.to_numeric(stops['stop_lat'], errors='coerce')
+        inside = stops['stop_id'][lons.between(lon_min, lon_max) & lats.between(lat_min, lat_max)]
+
+        trips = tables['trips.txt']
+        trips = trips[trips['service_id'].isin(services)]
+        stop_times = tables['stop_times.txt']
+        stop_times = _trip_spans(stop_times[stop_times['trip_id'].isin(trips['trip_id'])], inside)
+        # A trip needs two stops left to be ridden at all
+        stop_counts = stop_times['trip_id'].value_counts()
+        kept_trips = stop_counts.index[stop_counts >= 2]
+        stop_times = stop_times[stop_times['trip_id'].isin(kept_trips)]
+        trips = trips[trips['trip_id'].isin(kept_trips)]
+
+        used_stops = stops['stop_id'].isin(stop_times['stop_id'])
+        if 'parent_station' in stops.columns:
+            used_stops |= stops['stop_id'].isin(stops.loc[used_stops, 'parent_station'].dropna())
+        stops = stops[used_stops]
+
+        sliced = {'stops.txt': stops, 'trips.txt': trips, 'stop_times.txt': stop_times}
+        routes = tables['routes.txt']
+        sliced['routes.txt'] = routes[routes['route_id'].isin(trips['route_id'])]
+        for name, table in [('calendar.txt', tables['calendar.txt']), ('calendar_dates.txt', tables['calendar_dates.txt'])]:
+            if table is not None:
+                sliced[name] = table[table['service_id'].isin(trips['service_id'])]
+        if tables['shapes.txt'] is not None and 'shape_id' in trips.columns:
+            sliced['shapes.txt'] = tables['shapes.txt'][tables['shapes.txt']['shape_id'].isin(trips['shape_id'])]
+        if tables['frequencies.txt'] is not None:
+            sliced['frequencies.txt'] = tables['frequencies.txt'][tables['frequencies.txt']['trip_id'].isin(trips['trip_id'])]
+        if tables['transfers.txt'] is not None:
+            transfers = tables['transfers.txt']
+            # Transfers between trips rather than stops have no stop ids
+            kept = [transfers[column].isna() | transfers[column].isin(stops['stop_id']) for column in ['from_stop_id', 'to_stop_id']]
+            sliced['transfers.txt'] = transfers[kept[0] & kept[1]]
+        if tables['fare_rules.txt'] is not None and 'route_id' in tables['fare_rules.txt'].columns:
+            fare_rules = tables['fare_rules.txt']
+            sliced['fare_rules.txt'] = fare_rules[fare_rules['route_id'].isna() | fare_rules['route_id'].isin(sliced['routes.txt']['route_id'])]
+        if tables['stop_areas.txt'] is not None:
+            sliced['stop_areas.txt'] = tables['stop_areas.txt'][tables['stop_areas.txt']['stop_id'].isin(stops['stop_id'])]
+        if tables['route_networks.txt'] is not None:
+            sliced['route_networks.txt'] = tables['route_networks.txt'][tables['route_networks.txt']['route_id'].isin(sliced['routes.txt']['route_id'])]
+
+        # Written next to the output and renamed into place once complete
+        tmp_path = out_path + '.tmp'
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as out:
+            for name in feed.namelist():
+                if name in sliced:
+                    out.writestr(name, sliced[name].to_csv(index=False))
+                else:
+                    out.writestr(name, feed.read(name))
+    os.replace(tmp_path, out_path)
+    return {'trips': len(trips), 'stops': len(stops), 'stop_times': len(stop_times)}
+
+
+def clip_osm(osm_path, out_path, bounds):
+    # Cut the OSM extract to the bounds with osmium-tool. Ways crossing the
+    # edge are kept whole, so roads leaving the area are not cut mid-segment.
+    osmium = shutil.which('osmium')
+    if osmium is None:
+        raise RuntimeError("Clipping the OSM extract needs osmium-tool (https://osmcode.org/osmium-tool/) on the PATH")
+    tmp_path = out_path + '.tmp'
+    subprocess.run([osmium, 'extract', '--bbox', ','.join(str(value) for value in bounds), '--strategy', 'complete_ways',
+                    '--output-format', 'pbf', '--overwrite', '--output', tmp_path, osm_path], check=True)
+    os.replace(tmp_path, out_path)
+
+
+def preprocess(gtfs_path=config.gtfs_path, osm_path=config.osm_path, out_dir=config.sliced_inputs_dir,
+               start_date=None, end_date=None, bounds=None, padding=0.02):
+    # Sliced GTFS and OSM paths, written only when there is no copy for the
+    # same inputs and parameters yet
+    start_date = start_date or date.today()
+    end_date = end_date or start_date + timedelta(days=13)
+    bounds = padded_bounds(bounds or [config.lon_start, config.lat_start, config.lon_end, config.lat_end], padding)
+    os.makedirs(out_dir, exist_ok=True)
+
+    gtfs_out = sliced_path(out_dir, gtfs_path, '.zip', bounds=bounds, start_date=start_date, end_date=end_date)
+    if os.path.exists(gtfs_out):
+        print(f"Reusing {gtfs_out}")
+    else:
+        counts = slice_gtfs(gtfs_path, gtfs_out, start_date, end_date, bounds)
+        print(f"Wrote {counts['trips']} trips, {counts['stops']} stops and {counts['stop_times']} stop times to {gtfs_out}")
+
+    osm_out = sliced_path(out_dir, osm_path, '.osm.pbf', bounds=bounds)
+    if os.path.exists(osm_out):
+        print(f"Reusing {osm_out}")
+    else:
+        clip_osm(osm_path, osm_out, bounds)
+        print(f"Wrote {osm_out}")
+    return gtfs_out, osm_out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Trim the GTFS feed to the service dates and area and clip the OSM extract to the area, so the transport network builds faster and uses less memory.')
+    parser.add_argument('--gtfs', default=config.gtfs_path, help='GTFS feed (.zip)')
+    parser.add_argument('--osm', default=config.osm_path, help='OSM extract (.osm.pbf)')
+    parser.add_argument('--out', default=config.sliced_inputs_dir, help='output directory; sliced copies are named by input content and parameters and reused')
+    parser.add_argument('--start', type=date.fromisoformat, default=None, help='first service date, YYYY-MM-DD (default: today)')
+    parser.add_argument('--days', type=int, default=14, help='number of service dates to keep')
+    parser.add_argument('--bbox', nargs=4, type=float, metavar=('LON_MIN', 'LAT_MIN', 'LON_MAX', 'LAT_MAX'),
+                        default=[config.lon_start, config.lat_start, config.lon_end, config.lat_end])
+    parser.add_argument('--padding', type=float, default=0.02, help='padding around the bbox in degrees')
+    args = parser.parse_args()
+
+    start_date = args.start or date.today()
+    gtfs_out, osm_out = preprocess(args.gtfs, args.osm, args.out, start_date, start_date + timedelta(days=args.days - 1), args.bbox, args.padding)
+    print("Run the app on the sliced inputs with:")
+    print(f"  export GTFS_PATH={gtfs_out} OSM_PATH={osm_out}")
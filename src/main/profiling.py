@@ -0,0 +1,174 @@
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import flask
+
+import config
+import metrics
+
+# Header that asks for a routing request to be profiled
+PROFILE_HEADER = 'X-Profile-Request'
+
+# Java calls made through JPype are not seen by cProfile: their time is the
+# own time of the r5py and JPype frames that made them
+JVM_PACKAGES = {'r5py', 'jpype', '_jpype'}
+
+# Built-ins that block on another thread or process, e.g. a worker thread
+# routing a mode or the routing service answering
+WAIT_FUNCTIONS = ("'acquire' of '_thread.", 'time.sleep', 'select.', "'poll' of", 'recv')
+
+TOP_FUNCTIONS = 30
+
+# Requests to profile next, armed on /profile (per process)
+_armed = {'requests': 0}
+_armed_lock = threading.Lock()
+
+
+def enabled():
+    return config.profile_dir is not None
+
+
+def arm(requests=1):
+    with _armed_lock:
+        _armed['requests'] = max(requests, 0)
+        return _armed['requests']
+
+
+def requested():
+    # Whether the routing request made by the current web request should be
+    # profiled: it has the header or a request was armed on /profile
+    if not enabled():
+        return False
+    if flask.has_request_context() and flask.request.headers.get(PROFILE_HEADER):
+        return True
+    with _armed_lock:
+        if _armed['requests'] > 0:
+            _armed['requests'] -= 1
+            return True
+    return False
+
+
+class Profile:
+    # cProfile of one request, across the threads that work for it
+
+    def __init__(self):
+        self.profilers = []
+        self._lock = threading.Lock()
+
+    def run(self, function, *args, **kwargs):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ allows one profiler at a time, and it sees every thread
+            return function(*args, **kwargs)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profiler.disable()
+            with self._lock:
+                self.profilers.append((threading.current_thread().name, profiler))
+
+
+def _category(function):
+    filename, _, name = function
+    if filename == '~':
+        if 'jpype' in name:
+            return 'jvm'
+        if any(pattern in name for pattern in WAIT_FUNCTIONS):
+            return 'waiting'
+        return 'python'
+    if JVM_PACKAGES & set(os.path.normpath(filename).split(os.sep)):
+        return 'jvm'
+    return 'python'
+
+
+def time_split(stats):
+    # Seconds of own time spent in the JVM, waiting and in Python
+    split = {'jvm': 0.0, 'waiting': 0.0, 'python': 0.0}
+    for function, (_, _, own_time, _, _) in stats.stats.items():
+        split[_category(function)] += own_time
+    return split
+
+
+def _top(stats, sort, count=TOP_FUNCTIONS):
+    out = io.StringIO()
+    stats.stream = out
+    stats.sort_stats(sort).print_stats(count)
+    return out.getvalue()
+
+
+def save(profile, current, wall_seconds):
+    # Write the request's profile (.prof, for pstats or snakeviz) and a text
+    # summary of where its time went, and return their paths
+    os.makedirs(config.profile_dir, exist_ok=True)
+    name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{current['callback']}-{current['request_id']}"
+    path = os.path.join(config.profile_dir, name)
+
+    threads = []
+    combined = None
+    for thread, profiler in profile.profilers:
+        stats = pstats.Stats(profiler)
+        threads.append((thread, stats.total_tt, time_split(stats)))
+        if combined is None:
+            combined = stats
+        else:
+            combined.add(stats)
+    combined.dump_stats(path + '.prof')
+
+    stage_totals = {}
+    for entry in current['stages']:
+        stage_totals[entry['stage']] = stage_totals.get(entry['stage'], 0) + entry['ms']
+    lines = [f"{current['callback']} request {current['request_id']}: {wall_seconds * 1000:.1f} ms wall time, modes {', '.join(current['modes']) or '-'}",
+             "",
+             "Own time per thread (ms). Worker threads run alongside the request thread, which waits for them:",
+             f"{'thread':<28} {'total':>10} {'jvm':>10} {'waiting':>10} {'python':>10}"]
+    for thread, total, split in threads:
+        lines.append(f"{thread:<28} {total * 1000:>10.1f} {split['jvm'] * 1000:>10.1f} {split['waiting'] * 1000:>10.1f} {split['python'] * 1000:>10.1f}")
+    lines += ["", "Stages (ms): " + ", ".join(f"{stage} {ms:.1f}" for stage, ms in stage_totals.items()),
+              "", "Top functions by cumulative time:", _top(combined, 'cumulative'),
+              "Top functions by own time:", _top(combined, 'tottime')]
+    with open(path + '.txt', 'w') as f:
+        f.write('\n'.join(lines))
+    return path + '.prof', path + '.txt', threads
+
+
+@contextmanager
+def profiled(current, enabled):
+    # Run the rest of the request traced by `current` under cProfile when
+    # `enabled`; worker threads started with metrics.in_current_trace() are
+    # profiled as well
+    if not enabled or current is None:
+        yield
+        return
+    profile = Profile()
+    current['profile'] = profile
+    start = time.perf_counter()
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        metrics.log_event('profile_skipped', request_id=current['request_id'], reason='another profile is running')
+        current.pop('profile')
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.disable()
+        wall_seconds = time.perf_counter() - start
+        current.pop('profile')
+        profile.profilers.insert(0, ('request', profiler))
+        try:
+            prof_path, summary_path, threads = save(profile, current, wall_seconds)
+            metrics.log_event('profile', request_id=current['request_id'], callback=current['callback'], wall_ms=round(wall_seconds * 1000, 1),
+                              profile=prof_path, summary=summary_path,
+                              threads={thread: {category: round(seconds * 1000, 1) for category, seconds in split.items()} for thread, _, split in threads})
+        except Exception:
+            metrics.log_exception('profile_error', request_id=current['request_id'])
@@ -0,0 +1,481 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import r5py
+from shapely.geometry import Point
+
+import config
+import metrics
+from cache import LRUCache, file_digest
+from fares import FareTable, load_fare_table
+from stops import open_stop_index
+from streets import open_street_index
+
+COORDINATE_PRECISION = 4  # decimal places, about 10 m
+DEPARTURE_BUCKET_MINUTES = 5
+
+# Accessibility grid: cell size in degrees (about 250 m), the most cells
+# routed at once, and how far travel times are computed
+ACCESSIBILITY_GRID_STEP = 0.0025
+ACCESSIBILITY_MAX_CELLS = 20000
+ACCESSIBILITY_MAX_MINUTES = 60
+
+# Travel time percentiles reported for a departure window. The 1st
+# percentile stands in for the fastest departure, see compute_departure_sweep()
+SWEEP_PERCENTILES = (10, 50, 90)
+TRANSIT_MODES = ('TRANSIT_WALK', 'TRANSIT_BIKE')
+SWEEP_MODES = TRANSIT_MODES
+
+itinerary_cache = LRUCache(maxsize=256)
+accessibility_cache = LRUCache(maxsize=64)
+sweep_cache = LRUCache(maxsize=256)
+
+# Latest routing request of each session routed in this process, so the
+# legs of an older request still being routed are skipped (see compute_legs)
+session_requests = LRUCache(maxsize=1000)
+
+
+# State of the lazily loaded transport network, see get_transport_network()
+_network = {'state': 'idle', 'stage': None, 'started': None, 'finished': None, 'error': None,
+            'transport_network': None, 'version': None, 'bounds': None, 'inputs': None, 'fares': None, 'streets': None, 'stops': None}
+_network_lock = threading.Lock()
+_network_loaded = threading.Event()
+
+
+class NetworkNotReady(RuntimeError):
+    pass
+
+
+class NoTransitAccess(ValueError):
+    # A transit leg with no stop in reach of its origin or destination
+    pass
+
+
+class RequestSuperseded(RuntimeError):
+    # A newer routing request from the same session replaced this one
+    pass
+
+
+def network_version(*paths):
+    # Identifies the content of the network inputs so cached itineraries are
+    # not reused after the OSM or GTFS files change
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(file_digest(path).encode())
+    return digest.hexdigest()[:16]
+
+
+def _load_network(osm_path, gtfs_path):
+    try:
+        _network['stage'] = 'hashing inputs'
+        version = network_version(osm_path, gtfs_path)
+        # r5py keeps a snapshot of every network it builds, keyed by the
+        # input files, and loads it instead of building again on restarts
+        _network['stage'] = 'building network'
+        transport_network = r5py.TransportNetwork(osm_path, [gtfs_path])
+        # Lon/lat bounding box of the street network, i.e. the service area
+        bounds = [float(value) for value in transport_network.extent.bounds]
+        _network['stage'] = 'reading fares'
+        try:
+            fares = load_fare_table(gtfs_path, config.transit_fare_per_ride)
+        except Exception:
+            # Fares are optional: a malformed fares table costs every ride the
+            # flat fare instead of keeping the network down
+            metrics.log_exception('fares_error', gtfs_path=gtfs_path)
+            fares = FareTable(config.transit_fare_per_ride)
+        _network['stage'] = 'indexing streets'
+        streets = open_street_index(osm_path)
+        _network['stage'] = 'indexing stops'
+        stops = open_stop_index(gtfs_path)
+        _network.update(state='ready', stage=None, transport_network=transport_network, version=version, bounds=bounds, fares=fares, streets=streets, stops=stops)
+    except Exception as e:
+        _network.update(state='failed', stage=None, error=str(e))
+    finally:
+        _network['finished'] = time.time()
+        _network_loaded.set()
+
+
+def start_network_warmup(osm_path=None, gtfs_path=None):
+    # Load the network in the background; a failed load is retried with the
+    # same inputs unless others are given (the config's by default)
+    with _network_lock:
+        if _network['state'] in ('loading', 'ready'):
+            return
+        inputs = _network['inputs'] or (config.osm_path, config.gtfs_path)
+        osm_path, gtfs_path = osm_path or inputs[0], gtfs_path or inputs[1]
+        _network.update(state='loading', stage=None, started=time.time(), finished=None, error=None, inputs=(osm_path, gtfs_path))
+        _network_loaded.clear()
+        threading.Thread(target=_load_network, args=(osm_path, gtfs_path), name='network-warmup', daemon=True).start()
+
+
+# Street and stop indexes of a process that checks points without loading
+# the network, i.e. the app when routing runs in the routing service
+_indexes = {'state': 'idle', 'streets': None, 'stops': None}
+
+
+def _load_indexes(osm_path, gtfs_path):
+    try:
+        _indexes['streets'] = open_street_index(osm_path)
+        _indexes['stops'] = open_stop_index(gtfs_path)
+        _indexes['state'] = 'ready'
+    except Exception:
+        metrics.log_exception('index_error', osm_path=osm_path, gtfs_path=gtfs_path)
+        _indexes['state'] = 'failed'
+
+
+def start_index_warmup(osm_path=config.osm_path, gtfs_path=config.gtfs_path):
+    # Load only the indexes, in the background like the network: building
+    # the street index parses the whole extract when it is not saved yet.
+    # Points are not checked until they are loaded.
+    with _network_lock:
+        if _indexes['state'] != 'idle':
+            return
+        _indexes['state'] = 'loading'
+    threading.Thread(target=_load_indexes, args=(osm_path, gtfs_path), name='index-warmup', daemon=True).start()
+
+
+def network_status():
+    status = {'state': _network['state'], 'stage': _network['stage'], 'version': _network['version'],
+              'bounds': _network['bounds'], 'error': _network['error']}
+    if _network['started'] is not None:
+        status['elapsed_seconds'] = round((_network['finished'] or time.time()) - _network['started'], 1)
+    return status
+
+
+def _wait_for_network(wait, timeout):
+    start_network_warmup()
+    if not wait and not _network_loaded.is_set():
+        raise NetworkNotReady(f"The routing network is still loading ({_network['stage']}, {network_status()['elapsed_seconds']:.0f} s)")
+    if not _network_loaded.wait(timeout):
+        raise NetworkNotReady("Timed out waiting for the routing network")
+    if _network['state'] != 'ready':
+        raise RuntimeError(f"The routing network failed to load: {_network['error']}")
+
+
+def get_transport_network(wait=True, timeout=None):
+    # The network is only built on first use, not when the app is imported.
+    # With wait=False a NetworkNotReady error is raised while it is loading.
+    _wait_for_network(wait, timeout)
+    return _network['transport_network']
+
+
+def get_network_version(wait=True, timeout=None):
+    _wait_for_network(wait, timeout)
+    return _network['version']
+
+
+def get_fare_table():
+    # Fares of the GTFS feed the network was built from, None until it is loaded
+    return _network['fares']
+
+
+def get_street_index():
+    # Street vertices of the network's OSM extract, None until it is loaded
+    # or when there is no index (see streets.open_street_index())
+    return _network['streets'] if _network['state'] == 'ready' else _indexes['streets']
+
+
+def get_stop_index():
+    # Stops of the network's GTFS feed, None until it is loaded
+    return _network['stops'] if _network['state'] == 'ready' else _indexes['stops']
+
+
+def access_radius(mode):
+    # Farthest a transit stop can be, in meters, from where a trip of a
+    # transit mode starts or ends
+    speed = config.cycling_speed_kmh if mode == 'TRANSIT_BIKE' else config.walking_speed_kmh
+    return speed * 1000 / 60 * config.transit_access_minutes
+
+
+def transit_access_error(origin, destination, mode, stops=None):
+    # Why a leg of a transit mode cannot be ridden, without routing it: no
+    # stop within the access radius of its origin or destination. None when
+    # it may be, or when there is no stop index to tell.
+    stops = _network['stops'] if stops is None else stops
+    if mode not in TRANSIT_MODES or stops is None:
+        return None
+    radius = access_radius(mode)
+    for label, point in [('origin', origin), ('destination', destination)]:
+        if not stops.any_within(point, radius):
+            travel = 'bike ride' if mode == 'TRANSIT_BIKE' else 'walk'
+            return f"No transit stop within a {config.transit_access_minutes} minute {travel} ({radius / 1000:.1f} km) of the {label}"
+    return None
+
+
+def transit_settings(mode):
+    # Access and egress limits of the transit modes. R5 would otherwise walk
+    # or ride up to the whole trip's max_time to reach a stop, and
+    # transit_access_error() relies on them.
+    if mode not in TRANSIT_MODES:
+        return {}
+    limit = timedelta(minutes=config.transit_access_minutes)
+    return {'max_time_walking': limit, 'max_time_cycling': limit,
+            'speed_walking': config.walking_speed_kmh, 'speed_cycling': config.cycling_speed_kmh}
+
+
+def set_latest_request(session, request_id=None):
+    # The session's routing request whose results are still wanted; None
+    # when none is (e.g. the user started over)
+    session_requests.put(session, request_id)
+
+
+def check_superseded(request):
+    # Raises RequestSuperseded when a (session, request id) pair is no longer
+    # its session's latest request. Sessions this process has not seen are
+    # never superseded.
+    if request is not None and request[0] and session_requests.get(request[0], request[1]) != request[1]:
+        raise RequestSuperseded("Superseded by a newer request")
+
+
+def snap_points(points, labels):
+    # Street vertices nearest to (lat, lon) points, which are routed from and
+    # cached under instead of the points themselves. Points far from any
+    # street fail here, before R5 is called.
+    streets = _network['streets']
+    if streets is None or not points:
+        return points
+    snapped, _ = streets.locate(points, labels)
+    return snapped
+
+
+def mode_settings(mode):
+    # Transport, access and egress modes used to route a trip mode
+    if mode == 'TRANSIT_WALK':
+        return [r5py.TransportMode.TRANSIT], [r5py.TransportMode.WALK], [r5py.TransportMode.WALK]
+    if mode == 'TRANSIT_BIKE':
+        return [r5py.TransportMode.TRANSIT, r5py.TransportMode.BICYCLE], [r5py.TransportMode.BICYCLE], [r5py.TransportMode.BICYCLE]
+    if mode == 'SHARED_RIDE':
+        # Shared rides follow the car route
+        return [r5py.TransportMode.CAR], [], []
+    return [r5py.TransportMode[mode]], [], []
+
+
+def departure_bucket(departure, minutes=DEPARTURE_BUCKET_MINUTES):
+    return departure.replace(second=0, microsecond=0) - timedelta(minutes=departure.minute % minutes)
+
+
+def leg_cache_key(origin, destination, departure, transport_modes, access_modes, egress_modes, version):
+    return (
+        tuple(round(value, COORDINATE_PRECISION) for value in origin),
+        tuple(round(value, COORDINATE_PRECISION) for value in destination),
+        departure_bucket(departure).isoformat(),
+        tuple(sorted(mode.name for mode in transport_modes)),
+        tuple(sorted(mode.name for mode in access_modes)),
+        tuple(sorted(mode.name for mode in egress_modes)),
+        version,
+    )
+
+
+def _route_group(transport_network, requests, departure, transport_modes, access_modes, egress_modes, **settings):
+    # Route several legs that share their modes and departure time with a
+    # single computer; origins and destinations are paired one-to-one
+    origins = gpd.GeoDataFrame(
+        [{'id': f'o{i}', 'geometry': Point(origin[1], origin[0])} for i, (origin, _) in enumerate(requests)], crs="EPSG:4326")
+    destinations = gpd.GeoDataFrame(
+        [{'id': f'd{i}', 'geometry': Point(destination[1], destination[0])} for i, (_, destination) in enumerate(requests)], crs="EPSG:4326")
+    detailed_itineraries_computer = r5py.DetailedItinerariesComputer(
+        transport_network,
+        origins=origins,
+        destinations=destinations,
+        departure=departure,
+        transport_modes=transport_modes,
+        access_modes=access_modes,
+        egress_modes=egress_modes,
+        **settings
+    )
+    travel_details = detailed_itineraries_computer.compute_travel_details()
+    return [travel_details[travel_details['from_id'] == f'o{i}'].reset_index(drop=True) for i in range(len(requests))]
+
+
+def compute_legs(transport_network, legs, version, request=None):
+    # Raw DetailedItinerariesComputer output for each (origin, destination,
+    # departure, mode) leg. `origin` and `destination` are (lat, lon) tuples,
+    # routed from their nearest street vertices (see snap_points()).
+    # Legs found in the itinerary cache are not routed again; the rest are
+    # grouped by their modes and departure, each group is routed as one
+    # batch, and independent groups run concurrently, at most
+    # config.routing_threads at a time. With a (session, request id)
+    # `request`, RequestSuperseded is raised before a group is routed once a
+    # newer request of the session came in.
+    keys = []
+    seen = set()
+    results = {}
+    groups = {}
+    snapped = snap_points([point for leg in legs for point in leg[:2]], ['origin', 'destination'] * len(legs))
+    legs = [(snapped[2 * i], snapped[2 * i + 1], departure, mode) for i, (_, _, departure, mode) in enumerate(legs)]
+    for origin, destination, departure, mode in legs:
+        transport_modes, access_modes, egress_modes = mode_settings(mode)
+        key = leg_cache_key(origin, destination, departure, transport_modes, access_modes, egress_modes, version)
+        keys.append(key)
+        # Looked up once per distinct leg, e.g. a shared ride shares its car leg
+        if key in seen:
+            continue
+        seen.add(key)
+        cached = itinerary_cache.get(key)
+        metrics.record_cache('itinerary', cached is not None)
+        if cached is not None:
+            results[key] = cached
+            continue
+        group = groups.setdefault(key[2:6], {'departure': departure, 'mode': mode, 'modes': (transport_modes, access_modes, egress_modes), 'requests': {}})
+        group['requests'].setdefault(key, (origin, destination))
+
+    def route(group):
+        check_superseded(request)
+        requests = list(group['requests'].items())
+        with metrics.stage('r5', group['mode']):
+            frames = _route_group(transport_network, [request for _, request in requests], group['departure'], *group['modes'], **transit_settings(group['mode']))
+        for (key, _), travel_details in zip(requests, frames):
+            itinerary_cache.put(key, travel_details)
+        return dict(zip([key for key, _ in requests], frames))
+
+    if len(groups) == 1:
+        results.update(route(next(iter(groups.values()))))
+    elif groups:
+        with ThreadPoolExecutor(max_workers=min(len(groups), config.routing_threads or os.cpu_count())) as executor:
+            for routed in executor.map(metrics.in_current_trace(route), groups.values()):
+                results.update(routed)
+
+    # Callers add columns and slice the frames, keep the cached ones intact
+    return [results[key].copy() for key in keys]
+
+
+def accessibility_grid(bounds, step=ACCESSIBILITY_GRID_STEP):
+    # Cell centres of a regular grid over the (lon_min, lat_min, lon_max,
+    # lat_max) bounds, aligned to multiples of the step. The step is doubled
+    # until the grid has at most ACCESSIBILITY_MAX_CELLS cells.
+    lon_min, lat_min, lon_max, lat_max = bounds
+    while ((lon_max - lon_min) / step + 1) * ((lat_max - lat_min) / step + 1) > ACCESSIBILITY_MAX_CELLS:
+        step *= 2
+    lons = (np.arange(np.floor(lon_min / step), np.ceil(lon_max / step)) + 0.5) * step
+    lats = (np.arange(np.floor(lat_min / step), np.ceil(lat_max / step)) + 0.5) * step
+    lon, lat = np.meshgrid(lons, lats)
+    return lon.flatten(), lat.flatten(), step
+
+
+def grid_cell(point, step):
+    # Centre of the grid cell containing a (lat, lon) point
+    return tuple(round((np.floor(value / step) + 0.5) * step, 6) for value in point)
+
+
+def compute_accessibility(transport_network, version, origin, departure, mode, bounds=None):
+    # Travel time in minutes from the grid cell of `origin` to every grid cell
+    # of the service area, from a single TravelTimeMatrixComputer run. Cells
+    # not reachable within ACCESSIBILITY_MAX_MINUTES are left out. Results
+    # are cached per origin cell, mode and departure bucket.
+    # Only a coverage check: an origin far from any street raises
+    # OutsideCoverage. Routing starts from the cell's centre, not from the
+    # snapped origin, so every origin in a cell shares its result.
+    streets = _network['streets']
+    if streets is not None:
+        streets.locate([origin], ['origin'])
+    bounds = tuple(bounds or _network['bounds'])
+    lons, lats, step = accessibility_grid(bounds)
+    origin_cell = grid_cell(origin, step)
+    key = (origin_cell, departure_bucket(departure).isoformat(), mode, bounds, step, version)
+    cached = accessibility_cache.get(key)
+    metrics.record_cache('accessibility', cached is not None)
+    if cached is not None:
+        return cached
+
+    transport_modes, access_modes, egress_modes = mode_settings(mode)
+    origins = gpd.GeoDataFrame([{'id': 0, 'geometry': Point(origin_cell[1], origin_cell[0])}], crs="EPSG:4326")
+    destinations = gpd.GeoDataFrame({'id': np.arange(len(lons)), 'geometry': gpd.points_from_xy(lons, lats)}, crs="EPSG:4326")
+    travel_time_matrix_computer = r5py.TravelTimeMatrixComputer(
+        transport_network,
+        origins=origins,
+        destinations=destinations,
+        departure=departure,
+        transport_modes=transport_modes,
+        access_modes=access_modes,
+        egress_modes=egress_modes,
+        max_time=timedelta(minutes=ACCESSIBILITY_MAX_MINUTES),
+        **transit_settings(mode)
+    )
+    with metrics.stage('r5_travel_time_matrix', mode):
+        travel_times = travel_time_matrix_computer.compute_travel_times()
+    minutes = np.full(len(lons), np.nan)
+    minutes[travel_times['to_id'].to_numpy(int)] = pd.to_numeric(travel_times['travel_time'], errors='coerce').to_numpy(float)
+    reachable = minutes <= ACCESSIBILITY_MAX_MINUTES
+
+    accessibility = {'origin': origin_cell, 'step': step, 'cells': len(lons),
+                     'lon': lons[reachable], 'lat': lats[reachable], 'minutes': minutes[reachable]}
+    accessibility_cache.put(key, accessibility)
+    return accessibility
+
+
+def _unreachable_sweep():
+    return {'travel_time': dict.fromkeys(SWEEP_PERCENTILES, np.nan), 'wait_time': dict.fromkeys(SWEEP_PERCENTILES, np.nan)}
+
+
+def _sweep_mode(transport_network, origin, destination, departure, window, mode):
+    transport_modes, access_modes, egress_modes = mode_settings(mode)
+    percentiles = (1,) + SWEEP_PERCENTILES
+    travel_time_matrix_computer = r5py.TravelTimeMatrixComputer(
+        transport_network,
+        origins=gpd.GeoDataFrame([{'id': 0, 'geometry': Point(origin[1], origin[0])}], crs="EPSG:4326"),
+        destinations=gpd.GeoDataFrame([{'id': 1, 'geometry': Point(destination[1], destination[0])}], crs="EPSG:4326"),
+        departure=departure,
+        departure_time_window=window,
+        percentiles=list(percentiles),
+        transport_modes=transport_modes,
+        access_modes=access_modes,
+        egress_modes=egress_modes,
+        **transit_settings(mode)
+    )
+    with metrics.stage('r5_travel_time_matrix', mode):
+        travel_times = travel_time_matrix_computer.compute_travel_times()
+    # One travel_time_pNN column per percentile, in the order requested.
+    # No row, or no times, when no departure of the window gets there.
+    travel_times = travel_times.filter(regex='^travel_time').apply(pd.to_numeric, errors='coerce')
+    if travel_times.empty or travel_times.iloc[0].isna().all():
+        return _unreachable_sweep()
+    row = travel_times.iloc[0].to_numpy(float)
+    fastest = row[0]
+    return {
+        'travel_time': dict(zip(SWEEP_PERCENTILES, row[1:])),
+        'wait_time': dict(zip(SWEEP_PERCENTILES, row[1:] - fastest)),
+    }
+
+
+def compute_departure_sweep(transport_network, version, origin, destination, departure, window, modes=SWEEP_MODES):
+    # Travel time percentiles (minutes) over every departure minute of
+    # [departure, departure + window), from one TravelTimeMatrixComputer run
+    # per mode instead of one route per minute. r5py does not report waiting
+    # separately; the wait time is the time lost against the fastest
+    # departure of the window, which is mostly waiting for the first vehicle.
+    # Unreachable trips are NaN, and so are the modes with no stop in reach of
+    # the origin or destination, which are not routed.
+    origin, destination = snap_points([origin, destination], ['origin', 'destination'])
+    results = {}
+    pending = []
+    for mode in modes:
+        if transit_access_error(origin, destination, mode) is not None:
+            results[mode] = _unreachable_sweep()
+            continue
+        key = (tuple(round(value, COORDINATE_PRECISION) for value in origin),
+               tuple(round(value, COORDINATE_PRECISION) for value in destination),
+               departure_bucket(departure).isoformat(), window.total_seconds(), mode, version)
+        cached = sweep_cache.get(key)
+        metrics.record_cache('departure_sweep', cached is not None)
+        if cached is not None:
+            results[mode] = cached
+        else:
+            pending.append((key, mode))
+
+    def sweep(request):
+        key, mode = request
+        result = _sweep_mode(transport_network, origin, destination, departure, window, mode)
+        sweep_cache.put(key, result)
+        return mode, result
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            results.update(executor.map(metrics.in_current_trace(sweep), pending))
+    return {mode: results[mode] for mode in modes}
@@ -0,0 +1,305 @@
+import argparse
+import itertools
+import os
+import queue
+import threading
+import time
+from multiprocessing import get_context
+from multiprocessing.connection import Client, Listener
+
+import config
+
+# Jobs the workers can run, by name
+JOBS = ('route_legs', 'route_compare_legs', 'compute_accessibility', 'compute_departure_sweep')
+
+# Cancellation flags shared with the workers, indexed by job id modulo the
+# number of slots. Far more slots than jobs can be queued or running at once.
+CANCEL_SLOTS = 4096
+
+
+class RoutingServiceError(RuntimeError):
+    pass
+
+
+class RoutingBusy(RoutingServiceError):
+    # The job queue is full; the caller should back off instead of waiting
+    pass
+
+
+class RoutingTimeout(RoutingServiceError):
+    pass
+
+
+class RoutingCancelled(RoutingServiceError):
+    # A newer job from the same session replaced this one, or its client left
+    pass
+
+
+def require_authkey(authkey):
+    if not authkey:
+        raise RoutingServiceError("Set ROUTING_SERVICE_AUTHKEY to the same secret for the routing service and the app")
+    return authkey
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def _worker_loop(index, jobs, results, cancelled, osm_path, gtfs_path):
+    # Runs in a worker process: load the network once, then run jobs until
+    # a None job arrives
+    import metrics
+    from planner import route_compare_legs, route_legs
+    from routing import compute_accessibility, compute_departure_sweep, get_network_version, get_transport_network, network_status, start_network_warmup
+
+    # Every job is logged with its stages as a JSON line
+    metrics.configure_logging()
+    start_network_warmup(osm_path, gtfs_path)
+    try:
+        transport_network = get_transport_network()
+        version = get_network_version()
+    except Exception as e:
+        results.put(('failed', index, str(e)))
+        return
+    results.put(('ready', index, {'version': version, 'bounds': network_status()['bounds']}))
+
+    functions = {'route_legs': route_legs, 'route_compare_legs': route_compare_legs, 'compute_accessibility': compute_accessibility,
+                 'compute_departure_sweep': compute_departure_sweep}
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        job_id, name, args, deadline = job
+        if time.time() > deadline:
+            # Nobody is waiting for the result any more
+            results.put(('expired', job_id, None))
+            continue
+        if cancelled[job_id % CANCEL_SLOTS]:
+            results.put(('cancelled', job_id, None))
+            continue
+        try:
+            with metrics.trace(name):
+                result = functions[name](transport_network, version, *args)
+            results.put(('done', job_id, result))
+        except Exception as e:
+            results.put(('error', job_id, f"{type(e).__name__}: {e}"))
+
+
+class RoutingService:
+    # N worker processes, each holding its own transport network, fed from a
+    # bounded queue. Jobs that do not fit in the queue are rejected right
+    # away so the web tier sees backpressure instead of piling up requests.
+
+    def __init__(self, address, workers=2, queue_size=8, authkey=config.routing_service_authkey,
+                 osm_path=config.osm_path, gtfs_path=config.gtfs_path):
+        self.address = address
+        self.authkey = require_authkey(authkey)
+        self.worker_count = workers
+        # Workers are spawned: forking a process that runs a JVM is unsafe
+        context = get_context('spawn')
+        self._jobs = context.Queue(maxsize=queue_size)
+        self._results = context.Queue()
+        self._cancelled = context.Array('b', CANCEL_SLOTS, lock=False)
+        self._workers = [context.Process(target=_worker_loop, args=(i, self._jobs, self._results, self._cancelled, osm_path, gtfs_path), daemon=True)
+                         for i in range(workers)]
+        self._job_ids = itertools.count()
+        self._waiting = {}
+        # Latest job of each session; submitting a new one cancels it
+        self._session_jobs = {}
+        self._lock = threading.Lock()
+        self._ready = {}
+        self._failed = {}
+        self.version = None
+        self.bounds = None
+
+    def _queued(self):
+        try:
+            return self._jobs.qsize()
+        except NotImplementedError:  # macOS
+            return None
+
+    def status(self):
+        return {
+            'state': 'ready' if self._ready else ('failed' if len(self._failed) == self.worker_count else 'loading'),
+            'workers': self.worker_count,
+            'ready_workers': len(self._ready),
+            'queued': self._queued(),
+            'version': self.version,
+            'bounds': self.bounds,
+            'errors': list(self._failed.values()),
+        }
+
+    def _collect_results(self):
+        while True:
+            kind, key, payload = self._results.get()
+            if kind == 'ready':
+                self._ready[key] = payload
+                self.version = payload['version']
+                self.bounds = payload['bounds']
+                continue
+            if kind == 'failed':
+                self._failed[key] = payload
+                continue
+            with self._lock:
+                waiter = self._waiting.pop(key, None)
+            if waiter is not None:
+                waiter['result'] = (kind, payload)
+                waiter['event'].set()
+
+    def _cancel(self, job_id, reason):
+        # Queued jobs are skipped by the workers. A job that is already
+        # running cannot be interrupted, but its result is dropped and its
+        # client answered right away.
+        self._cancelled[job_id % CANCEL_SLOTS] = 1
+        with self._lock:
+            waiter = self._waiting.pop(job_id, None)
+        if waiter is not None:
+            waiter['result'] = ('cancelled', reason)
+            waiter['event'].set()
+
+    def submit(self, name, args, timeout, session=None, connection=None):
+        if name not in JOBS:
+            return ('error', f"Unknown job: {name}")
+        if not self._ready:
+            return ('busy', "The routing workers are still loading the network")
+        job_id = next(self._job_ids)
+        deadline = time.time() + timeout
+        waiter = {'event': threading.Event(), 'result': None}
+        self._cancelled[job_id % CANCEL_SLOTS] = 0
+        with self._lock:
+            self._waiting[job_id] = waiter
+            superseded = self._session_jobs.get(session) if session else None
+            if session:
+                self._session_jobs[session] = job_id
+        if superseded is not None:
+            self._cancel(superseded, "Superseded by a newer request")
+        try:
+            self._jobs.put_nowait((job_id, name, args, deadline))
+        except queue.Full:
+            with self._lock:
+                self._waiting.pop(job_id, None)
+            return ('busy', "The routing queue is full")
+
+        try:
+            while not waiter['event'].wait(0.25):
+                if time.time() > deadline:
+                    with self._lock:
+                        self._waiting.pop(job_id, None)
+                    return ('timeout', f"No result within {timeout:.0f} s")
+                # The client never sends anything while it waits, so a
+                # readable connection means it was closed
+                if connection is not None and connection.poll():
+                    self._cancel(job_id, "The client went away")
+            return waiter['result']
+        finally:
+            with self._lock:
+                if session and self._session_jobs.get(session) == job_id:
+                    del self._session_jobs[session]
+
+    def _handle(self, connection):
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    return
+                if request[0] == 'status':
+                    response = ('done', self.status())
+                else:
+                    _, name, args, timeout, session = request
+                    response = self.submit(name, args, timeout, session, connection)
+                try:
+                    connection.send(response)
+                except OSError:
+                    # The client gave up waiting
+                    return
+
+    def serve_forever(self):
+        for worker in self._workers:
+            worker.start()
+        threading.Thread(target=self._collect_results, name='routing-results', daemon=True).start()
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f"Routing service listening on {self.address[0]}:{self.address[1]} with {self.worker_count} workers")
+            while True:
+                connection = listener.accept()
+                threading.Thread(target=self._handle, args=(connection,), daemon=True).start()
+
+
+class RoutingClient:
+    # Thin client used by the Dash callbacks. Every call opens its own
+    # connection, so one client can be shared by all request threads.
+
+    def __init__(self, address, authkey=config.routing_service_authkey, timeout=config.routing_timeout):
+        self.address = address
+        self.authkey = require_authkey(authkey)
+        self.timeout = timeout
+
+    def _request(self, request, timeout):
+        try:
+            connection = Client(self.address, authkey=self.authkey)
+        except OSError as e:
+            raise RoutingServiceError(f"Routing service unavailable at {self.address[0]}:{self.address[1]}: {e}")
+        with connection:
+            connection.send(request)
+            # The service answers once the job is done or its timeout passed
+            if not connection.poll(timeout + 5):
+                raise RoutingTimeout(f"No answer from the routing service within {timeout:.0f} s")
+            kind, payload = connection.recv()
+        if kind == 'done':
+            return payload
+        if kind == 'busy':
+            raise RoutingBusy(payload)
+        if kind in ('timeout', 'expired'):
+            raise RoutingTimeout(payload)
+        if kind == 'cancelled':
+            raise RoutingCancelled(payload)
+        raise RoutingServiceError(payload)
+
+    def status(self):
+        return self._request(('status',), self.timeout)
+
+    # With a session key, a newer job from the same session cancels this one
+    def route_legs(self, legs, timeout=None, session=None):
+        timeout = timeout or self.timeout
+        return self._request(('job', 'route_legs', (legs,), timeout, session), timeout)
+
+    def route_compare_legs(self, legs, timeout=None, session=None):
+        timeout = timeout or self.timeout
+        return self._request(('job', 'route_compare_legs', (legs,), timeout, session), timeout)
+
+    def compute_accessibility(self, origin, departure, mode, timeout=None, session=None):
+        timeout = timeout or self.timeout
+        return self._request(('job', 'compute_accessibility', (origin, departure, mode), timeout, session), timeout)
+
+    def compute_departure_sweep(self, origin, destination, departure, window, timeout=None, session=None):
+        timeout = timeout or self.timeout
+        return self._request(('job', 'compute_departure_sweep', (origin, destination, departure, window), timeout, session), timeout)
+
+
+def connect_routing_service(address=config.routing_service_address):
+    # None when the app should route in-process
+    if not address:
+        return None
+    return RoutingClient(parse_address(address))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run routing workers that each hold the transport network and serve jobs to the app.')
+    parser.add_argument('--address', default=config.routing_service_address or '127.0.0.1:8765', help='host:port to listen on')
+    parser.add_argument('--workers', type=int, default=2, help='worker processes, each with its own copy of the network')
+    parser.add_argument('--queue-size', type=int, default=8, help='jobs that may wait for a worker before new ones are rejected')
+    parser.add_argument('--osm', default=config.osm_path, help='OSM extract (.osm.pbf)')
+    parser.add_argument('--gtfs', default=config.gtfs_path, help='GTFS feed (.zip)')
+    args = parser.parse_args()
+
+    for path in [args.osm, args.gtfs]:
+        if not os.path.exists(path):
+            parser.error(f"Network input not found: {path}")
+    if not config.routing_service_authkey:
+        parser.error("ROUTING_SERVICE_AUTHKEY is not set; use the same secret for the app")
+    # Save the street index next to the extract once, before the workers and
+    # the app look for it
+    from streets import open_street_index
+    open_street_index(args.osm)
+    RoutingService(parse_address(args.address), args.workers, args.queue_size, osm_path=args.osm, gtfs_path=args.gtfs).serve_forever()
@@ -0,0 +1,73 @@
+import os
+import threading
+import zipfile
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from elevation import geodesic_distance
+from fares import read_gtfs_table
+
+# Less than a degree of latitude is long anywhere, so searching the index
+# with it never misses a stop
+METERS_PER_DEGREE = 110_000
+
+
+class StopIndex:
+    # The GTFS stops riders board and alight at, indexed like the street
+    # vertices (see streets.StreetIndex) to find the stops near a point
+
+    def __init__(self, stop_ids, names, lons, lats):
+        self.stop_ids = np.asarray(stop_ids, dtype=object)
+        self.names = np.asarray(names, dtype=object)
+        self.lons = np.asarray(lons, dtype=float)
+        self.lats = np.asarray(lats, dtype=float)
+        self._scale = np.cos(np.radians((self.lats.min() + self.lats.max()) / 2))
+        self._tree = shapely.STRtree(shapely.points(self.lons * self._scale, self.lats))
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+    def within(self, point, radius):
+        # Positions of the stops at most `radius` meters from a (lat, lon)
+        # point, nearest first, and their distances
+        lat, lon = point
+        # Candidates from the tree, then the exact distances
+        candidates = self._tree.query(shapely.Point(lon * self._scale, lat), predicate='dwithin', distance=radius / METERS_PER_DEGREE)
+        distances = geodesic_distance(np.full(len(candidates), lon), np.full(len(candidates), lat), self.lons[candidates], self.lats[candidates])
+        order = np.argsort(distances)
+        near = order[distances[order] <= radius]
+        return candidates[near], distances[near]
+
+    def any_within(self, point, radius):
+        return len(self.within(point, radius)[0]) > 0
+
+
+def read_stops(gtfs_path):
+    # Stops and platforms with a location; stations and entrances are not boarded
+    with zipfile.ZipFile(gtfs_path) as feed:
+        stops = read_gtfs_table(feed, 'stops.txt')
+    if stops is None:
+        return None
+    if 'location_type' in stops.columns:
+        stops = stops[stops['location_type'].isna() | (stops['location_type'] == '0')]
+    lons = pd.to_numeric(stops['stop_lon'], errors='coerce')
+    lats = pd.to_numeric(stops['stop_lat'], errors='coerce')
+    located = lons.notna() & lats.notna()
+    names = stops['stop_name'] if 'stop_name' in stops.columns else stops['stop_id']
+    return stops.loc[located, 'stop_id'], names[located].fillna(''), lons[located], lats[located]
+
+
+# Indexes opened by this process, by GTFS feed
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def open_stop_index(gtfs_path):
+    # Index of the feed's stops, None without the feed or without stops
+    with _indexes_lock:
+        if gtfs_path not in _indexes:
+            stops = read_stops(gtfs_path) if os.path.exists(gtfs_path) else None
+            _indexes[gtfs_path] = StopIndex(*stops) if stops is not None and len(stops[0]) else None
+        return _indexes[gtfs_path]
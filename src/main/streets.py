@@ -0,0 +1,161 @@
+import argparse
+import os
+import threading
+
+import numpy as np
+import shapely
+
+import config
+from cache import file_digest
+from elevation import geodesic_distance
+
+# OSM highway values that are mapped as ways but cannot be travelled on
+NON_ROUTABLE_HIGHWAYS = {'proposed', 'construction', 'abandoned', 'disused', 'razed', 'platform', 'raceway', 'bus_stop',
+                         'elevator', 'emergency_access_point', 'rest_area', 'services'}
+
+# Largest gap in meters between indexed points along a street
+VERTEX_SPACING = 50
+
+
+class OutsideCoverage(ValueError):
+    # A point too far from any street to be routed from or to
+    pass
+
+
+def read_street_vertices(osm_path, spacing=VERTEX_SPACING):
+    # Lon/lat of every node of the ways R5 can route on, plus points every
+    # `spacing` meters between them, without duplicates. Without the extra
+    # points a point next to a long straight road could be far from any node.
+    import osmium
+
+    class WayHandler(osmium.SimpleHandler):
+        def __init__(self):
+            super().__init__()
+            self.lons, self.lats = [], []
+
+        def way(self, w):
+            highway = w.tags.get('highway')
+            if highway is None or highway in NON_ROUTABLE_HIGHWAYS:
+                return
+            nodes = [n for n in w.nodes if n.location.valid()]
+            if len(nodes) < 2:
+                return
+            self.lons.append(np.array([n.lon for n in nodes]))
+            self.lats.append(np.array([n.lat for n in nodes]))
+
+    handler = WayHandler()
+    handler.apply_file(osm_path, locations=True)
+    if not handler.lons:
+        return np.empty(0), np.empty(0)
+
+    u_lon = np.concatenate([lons[:-1] for lons in handler.lons])
+    u_lat = np.concatenate([lats[:-1] for lats in handler.lats])
+    v_lon = np.concatenate([lons[1:] for lons in handler.lons])
+    v_lat = np.concatenate([lats[1:] for lats in handler.lats])
+    # Each segment split into `steps` parts, with the points at its start and end
+    steps = np.maximum(1, np.ceil(geodesic_distance(u_lon, u_lat, v_lon, v_lat) / spacing)).astype(np.int64)
+    starts = np.concatenate([[0], np.cumsum(steps + 1)[:-1]])
+    owner = np.repeat(np.arange(len(steps)), steps + 1)
+    t = (np.arange(owner.size) - starts[owner]) / steps[owner]
+    lons = u_lon[owner] + t * (v_lon[owner] - u_lon[owner])
+    lats = u_lat[owner] + t * (v_lat[owner] - u_lat[owner])
+    # Rounded to OSM's precision so the points shared by segments are merged
+    vertices = np.unique(np.round(np.column_stack([lons, lats]), 7), axis=0)
+    return vertices[:, 0], vertices[:, 1]
+
+
+def street_index_path(osm_path):
+    return osm_path + '.streets.npz'
+
+
+def build_street_index(osm_path, index_path=None, spacing=VERTEX_SPACING):
+    lons, lats = read_street_vertices(osm_path, spacing)
+    # Written under another name first, so a process never reads a partial index
+    index_path = index_path or street_index_path(osm_path)
+    with open(index_path + '.tmp', 'wb') as f:
+        np.savez(f, lons=lons, lats=lats, osm_sha256=file_digest(osm_path))
+    os.replace(index_path + '.tmp', index_path)
+    return lons, lats
+
+
+class StreetIndex:
+    # Nearest street vertex of a coordinate, among the nodes and the points
+    # added along the streets. They are indexed in a plane where longitudes
+    # are scaled by the cosine of the area's middle latitude, so the nearest
+    # vertex in the plane is the nearest one on the ground; the distance
+    # reported is the geodesic one.
+
+    def __init__(self, lons, lats):
+        self.lons = np.asarray(lons, dtype=float)
+        self.lats = np.asarray(lats, dtype=float)
+        self._scale = np.cos(np.radians((self.lats.min() + self.lats.max()) / 2))
+        self._tree = shapely.STRtree(shapely.points(self.lons * self._scale, self.lats))
+
+    def __len__(self):
+        return len(self.lons)
+
+    def snap(self, lats, lons):
+        # Lat/lon of the nearest vertex of each point, and the distance to it in meters
+        lats = np.atleast_1d(np.asarray(lats, dtype=float))
+        lons = np.atleast_1d(np.asarray(lons, dtype=float))
+        points, vertices = self._tree.query_nearest(shapely.points(lons * self._scale, lats), all_matches=False)
+        nearest = np.empty(len(lats), dtype=np.int64)
+        nearest[points] = vertices
+        return self.lats[nearest], self.lons[nearest], geodesic_distance(lons, lats, self.lons[nearest], self.lats[nearest])
+
+    def locate(self, points, labels=None, max_distance=None):
+        # Nearest vertices of (lat, lon) points and the distances to them.
+        # Points farther than `max_distance` meters from any street are
+        # rejected: the first one raises OutsideCoverage.
+        max_distance = config.max_snap_distance if max_distance is None else max_distance
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        lats, lons, distances = self.snap(points[:, 0], points[:, 1])
+        outside = np.flatnonzero(distances > max_distance)
+        if len(outside):
+            i = outside[0]
+            raise coverage_error(labels[i] if labels else 'point', points[i], distances[i])
+        return list(zip(lats.tolist(), lons.tolist())), distances
+
+
+def coverage_error(label, point, distance):
+    return OutsideCoverage(f"The {label} ({point[0]:.5f}, {point[1]:.5f}) is {distance / 1000:.1f} km from the nearest street, outside the area the planner covers")
+
+
+# Indexes opened by this process, by OSM extract
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def open_street_index(osm_path=config.osm_path):
+    # Index of the extract's street vertices, read from the file next to the
+    # extract or built on first use. None without the extract, or when the
+    # index has to be built and pyosmium is not installed.
+    with _indexes_lock:
+        if osm_path in _indexes:
+            return _indexes[osm_path]
+        lons = lats = None
+        if os.path.exists(osm_path):
+            index_path = street_index_path(osm_path)
+            if os.path.exists(index_path):
+                with np.load(index_path) as stored:
+                    if str(stored['osm_sha256']) == file_digest(osm_path):
+                        lons, lats = stored['lons'], stored['lats']
+            if lons is None:
+                try:
+                    lons, lats = build_street_index(osm_path, index_path)
+                except ImportError:
+                    pass
+        index = StreetIndex(lons, lats) if lons is not None and len(lons) else None
+        _indexes[osm_path] = index
+        return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index the vertices of the routable OSM ways, used to snap origins and destinations to the street network.')
+    parser.add_argument('--osm', default=config.osm_path, help='OSM extract (.osm.pbf)')
+    parser.add_argument('--out', default=None, help='output .npz file (default: next to the extract, where the app looks for it)')
+    parser.add_argument('--spacing', type=float, default=VERTEX_SPACING, help='largest gap between indexed points along a street, in meters')
+    args = parser.parse_args()
+
+    lons, _ = build_street_index(args.osm, args.out, args.spacing)
+    print(f"Indexed {len(lons)} street vertices in {args.out or street_index_path(args.osm)}")
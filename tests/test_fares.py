@@ -0,0 +1,87 @@
+import zipfile
+
+import pandas as pd
+import pytest
+
+from fares import load_fare_table
+
+DEFAULT_FARE = 1.0
+
+STOPS = "stop_id,stop_name,stop_lat,stop_lon,zone_id\nS1,One,0,0,Z1\nS2,Two,0,0,Z1\nS3,Three,0,0,Z2\n"
+
+V1_FEED = {
+    'stops.txt': STOPS,
+    'fare_attributes.txt': "fare_id,price,currency_type,payment_method,transfers,transfer_duration\n"
+                           "LOCAL,2.00,USD,0,1,3600\nZONE,3.50,USD,0,0,\n",
+    # MISSING has no fare_attributes row
+    'fare_rules.txt': "fare_id,route_id,origin_id,destination_id,contains_id\n"
+                      "LOCAL,R1,,,\nMISSING,R1,,,\nMISSING,R3,,,\nZONE,R2,Z1,Z2,\n",
+}
+
+V2_FEED = {
+    'stops.txt': STOPS,
+    'routes.txt': "route_id,route_type,network_id\nR1,3,BUS\nR2,3,EXPRESS\nR3,3,LOOP\nR4,3,FREE\n",
+    'fare_products.txt': "fare_product_id,amount,currency\nBUS,2.00,USD\nEXPRESS,4.00,USD\nLOOP,1.50,USD\n"
+                         "TO_EXPRESS,3.00,USD\nLOOP_PASS,2.50,USD\n",
+    # FREE names a fare product the feed does not define
+    'fare_leg_rules.txt': "leg_group_id,network_id,fare_product_id\nBUS,BUS,BUS\nEXPRESS,EXPRESS,EXPRESS\nLOOP,LOOP,LOOP\nFREE,FREE,NOPE\n",
+    'fare_transfer_rules.txt': "from_leg_group_id,to_leg_group_id,fare_product_id,duration_limit,duration_limit_type,fare_transfer_type\n"
+                               "BUS,BUS,,3600,0,0\nBUS,EXPRESS,TO_EXPRESS,,,1\nLOOP,LOOP,LOOP_PASS,,,2\n",
+}
+
+# Leg rules whose fare products are missing
+V2_NO_PRODUCTS_FEED = {name: text for name, text in V2_FEED.items() if name != 'fare_products.txt'}
+
+
+def rides(*legs):
+    # (option, route_id, start_stop_id, end_stop_id, minutes after 8:00)
+    return pd.DataFrame([{'option': option, 'route_id': route, 'start_stop_id': start, 'end_stop_id': end,
+                          'departure_time': pd.Timestamp('2026-10-19 08:00') + pd.Timedelta(minutes=minutes)}
+                         for option, route, start, end, minutes in legs])
+
+
+@pytest.fixture(scope='module')
+def feeds(tmp_path_factory):
+    paths = {}
+    for name, tables in [('v1', V1_FEED), ('v2', V2_FEED), ('v2_no_products', V2_NO_PRODUCTS_FEED)]:
+        path = tmp_path_factory.mktemp(name) / 'gtfs.zip'
+        with zipfile.ZipFile(path, 'w') as feed:
+            for table, text in tables.items():
+                feed.writestr(table, text)
+        paths[name] = str(path)
+    return paths
+
+
+CASES = [
+    # Fares v1
+    ('v1', 'route fare, ignoring a rule without a fare', [(0, 'R1', 'S1', 'S2', 0)], [2.0]),
+    ('v1', 'only a rule without a fare', [(0, 'R3', 'S1', 'S2', 0)], [DEFAULT_FARE]),
+    ('v1', 'no rule', [(0, 'R9', 'S1', 'S2', 0)], [DEFAULT_FARE]),
+    ('v1', 'zone fare', [(0, 'R2', 'S1', 'S3', 0)], [3.5]),
+    ('v1', 'zone fare in the other direction', [(0, 'R2', 'S3', 'S1', 0)], [DEFAULT_FARE]),
+    ('v1', 'one free transfer', [(0, 'R1', 'S1', 'S2', 0), (0, 'R1', 'S2', 'S1', 30), (0, 'R1', 'S1', 'S2', 40)], [2.0, 0.0, 2.0]),
+    ('v1', 'transfer after the transfer duration', [(0, 'R1', 'S1', 'S2', 0), (0, 'R1', 'S2', 'S1', 90)], [2.0, 2.0]),
+    ('v1', 'transfers within an option only', [(0, 'R1', 'S1', 'S2', 0), (1, 'R1', 'S2', 'S1', 10)], [2.0, 2.0]),
+    # Fares v2
+    ('v2', 'network fare', [(0, 'R2', 'S1', 'S2', 0)], [4.0]),
+    ('v2', 'leg rule without a product', [(0, 'R4', 'S1', 'S2', 0)], [DEFAULT_FARE]),
+    ('v2', 'transfer type 0 without a product', [(0, 'R1', 'S1', 'S2', 0), (0, 'R1', 'S2', 'S1', 30)], [2.0, 0.0]),
+    ('v2', 'transfer type 0 past the duration limit', [(0, 'R1', 'S1', 'S2', 0), (0, 'R1', 'S2', 'S1', 90)], [2.0, 2.0]),
+    ('v2', 'transfer type 1', [(0, 'R1', 'S1', 'S2', 0), (0, 'R2', 'S2', 'S3', 20)], [2.0, 7.0]),
+    ('v2', 'transfer type 2', [(0, 'R3', 'S1', 'S2', 0), (0, 'R3', 'S2', 'S1', 20)], [1.5, 1.0]),
+    ('v2', 'transfer type 2 after a transfer', [(0, 'R3', 'S1', 'S2', 0), (0, 'R3', 'S2', 'S1', 20), (0, 'R3', 'S1', 'S2', 40)], [1.5, 1.0, 1.5]),
+    ('v2_no_products', 'no fare products', [(0, 'R1', 'S1', 'S2', 0), (0, 'R2', 'S2', 'S3', 20)], [DEFAULT_FARE, DEFAULT_FARE]),
+]
+
+
+@pytest.mark.parametrize('version, case, legs, expected', CASES, ids=[case for _, case, _, _ in CASES])
+def test_ride_fares(feeds, version, case, legs, expected):
+    table = load_fare_table(feeds[version], DEFAULT_FARE)
+    assert table.version == int(version[1])
+    assert table.ride_fares(rides(*legs)).tolist() == pytest.approx(expected)
+
+
+def test_option_fares(feeds):
+    table = load_fare_table(feeds['v1'], DEFAULT_FARE)
+    travel_details = rides((0, None, None, None, 0), (0, 'R1', 'S1', 'S2', 5), (0, 'R1', 'S2', 'S1', 20), (1, None, None, None, 0), (1, 'R2', 'S1', 'S3', 5))
+    assert table.option_fares(travel_details).to_dict() == {0: 2.0, 1: 3.5}